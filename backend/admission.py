@@ -0,0 +1,184 @@
+"""
+Admission control for API routes.
+
+Ingest routes (car enter/exit) are rate limited per device with token buckets, other
+writes (WRITE, e.g. credit purchases) per client with their own buckets, and every
+DB-bound route takes a slot from a shared concurrency limiter before it opens a
+connection. Writes queue for a slot like ingest does. Analytics may only use part of the slots and are shed as soon as
+ingest is waiting, so a camera reconnect storm degrades dashboards before it can
+drop events or exhaust Postgres max_connections. Rejections are 429 with Retry-After.
+
+Configuration (environment):
+    INGEST_RATE_PER_SEC     tokens per second per device (default 5)
+    INGEST_BURST            bucket size per device (default 20)
+    WRITE_RATE_PER_SEC      tokens per second per client for WRITE routes (default 0.5)
+    WRITE_BURST             bucket size per client for WRITE routes (default 5)
+    DB_MAX_CONCURRENCY      DB-bound requests in flight (default 8)
+    ANALYTICS_MAX_CONCURRENCY  share analytics may use (default half)
+    INGEST_QUEUE_SECONDS    how long ingest waits for a slot (default 1)
+"""
+import collections
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify, request
+
+INGEST = "ingest"
+WRITE = "write"
+ANALYTICS = "analytics"
+
+_MAX_TRACKED_KEYS = 10000
+
+
+class TokenBucketRegistry:
+    """One token bucket per client key. take() returns 0 if admitted, else seconds to wait."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > _MAX_TRACKED_KEYS:
+                self._prune(now)
+            return (1 - tokens) / self.rate
+
+    def _prune(self, now):
+        """Drop buckets that have refilled completely; they are equivalent to new ones."""
+        full_after = self.burst / self.rate
+        self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < full_after}
+
+
+class ConcurrencyLimiter:
+    """
+    Shared slots for DB-bound work. Ingest (and writes) may use every slot and wait
+    briefly for one, served in arrival order: a freed slot is handed to the oldest
+    waiter, so a request that just finished cannot jump the queue. Analytics may use at
+    most analytics_limit and never wait, and are refused while ingest is queued.
+    """
+
+    def __init__(self, limit, analytics_limit, ingest_wait=1.0):
+        self.limit = limit
+        self.analytics_limit = analytics_limit
+        self.ingest_wait = ingest_wait
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._analytics_in_flight = 0
+        self._waiters = collections.deque()  # [Condition, granted] per queued request
+
+    def acquire(self, priority):
+        with self._lock:
+            if priority == ANALYTICS:
+                if (self._waiters or self._in_flight >= self.limit
+                        or self._analytics_in_flight >= self.analytics_limit):
+                    return False
+                self._analytics_in_flight += 1
+                self._in_flight += 1
+                return True
+            if not self._waiters and self._in_flight < self.limit:
+                self._in_flight += 1
+                return True
+            waiter = [threading.Condition(self._lock), False]
+            self._waiters.append(waiter)
+            deadline = time.monotonic() + self.ingest_wait
+            while not waiter[1]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiters.remove(waiter)
+                    return False
+                waiter[0].wait(remaining)
+            return True
+
+    def release(self, priority):
+        with self._lock:
+            if priority == ANALYTICS:
+                self._analytics_in_flight -= 1
+            if self._waiters:
+                waiter = self._waiters.popleft()  # The slot passes on; in_flight is unchanged.
+                waiter[1] = True
+                waiter[0].notify()
+            else:
+                self._in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "analytics_in_flight": self._analytics_in_flight,
+                "ingest_waiting": len(self._waiters),
+                "limit": self.limit,
+                "analytics_limit": self.analytics_limit,
+            }
+
+
+_db_limit = int(os.environ.get("DB_MAX_CONCURRENCY", "8"))
+buckets = TokenBucketRegistry(
+    rate=float(os.environ.get("INGEST_RATE_PER_SEC", "5")),
+    burst=float(os.environ.get("INGEST_BURST", "20")),
+)
+write_buckets = TokenBucketRegistry(
+    rate=float(os.environ.get("WRITE_RATE_PER_SEC", "0.5")),
+    burst=float(os.environ.get("WRITE_BURST", "5")),
+)
+limiter = ConcurrencyLimiter(
+    limit=_db_limit,
+    analytics_limit=int(os.environ.get("ANALYTICS_MAX_CONCURRENCY", str(max(1, _db_limit // 2)))),
+    ingest_wait=float(os.environ.get("INGEST_QUEUE_SECONDS", "1")),
+)
+
+
+def client_key():
+    """Device ID, else API key, else client address."""
+    return (
+        request.headers.get("X-Device-Id")
+        or request.headers.get("X-API-Key")
+        or request.remote_addr
+        or "unknown"
+    )
+
+
+def _reject(retry_after, reason):
+    response = jsonify({"error": reason, "retry_after": retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def admit(priority, uses_db=None):
+    """
+    Route decorator: rate limit ingest and writes per client, then take a DB concurrency slot.
+    uses_db() returning False skips the slot (e.g. ingest acknowledged from a local log).
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if priority == INGEST:
+                wait = buckets.take(client_key())
+                if wait > 0:
+                    return _reject(max(1, math.ceil(wait)), "Rate limit exceeded for this device")
+            elif priority == WRITE:
+                wait = write_buckets.take(client_key())
+                if wait > 0:
+                    return _reject(max(1, math.ceil(wait)), "Rate limit exceeded for this client")
+            if uses_db is not None and not uses_db():
+                return fn(*args, **kwargs)
+            if not limiter.acquire(priority):
+                return _reject(1, "Server busy, retry shortly")
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                limiter.release(priority)
+        return wrapper
+    return decorator
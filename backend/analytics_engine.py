@@ -0,0 +1,297 @@
+"""
+Columnar in-memory analytics over closed car_entries.
+
+Keeps a NumPy snapshot of every completed entry and refreshes it incrementally
+using the entry_id watermark, so dashboard aggregates are answered from memory
+instead of running SQL on each request. Enable in app.py with
+ANALYTICS_ENGINE=columnar. tests/test_analytics_engine.py checks every aggregate
+against the SQL helpers in app.py.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import numpy as np
+
+_INITIAL_CAPACITY = 1024
+# entry_ids skipped by a refresh are re-checked for this long (an INSERT that had taken
+# its id but not yet committed), at most this many of them.
+_GAP_SECONDS = 60
+_MAX_GAPS = 10000
+_HOUR = 3600
+_DAY = 86400
+
+
+def _resolve_tz(tz):
+    try:
+        return ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {tz}")
+
+
+def _epoch(dt):
+    """Naive DB timestamps are UTC; convert to float epoch seconds."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def _group_sum(keys, *weights):
+    """Group by integer keys. Returns (unique_keys, counts, sums per weight)."""
+    uniq, inv = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inv, minlength=len(uniq))
+    sums = [np.bincount(inv, weights=w, minlength=len(uniq)) for w in weights]
+    return uniq, counts, sums
+
+
+class ColumnarAnalytics:
+    """
+    Append-only columnar snapshot of closed car_entries.
+
+    Rows are fetched with entry_id above the watermark; entries still open at that
+    point are remembered and re-checked on the next refresh until they close. SERIAL
+    ids can commit out of order, so ids below the watermark that were missing when it
+    moved past them (gaps) are re-checked for _GAP_SECONDS too.
+
+    One refresh runs at a time (_refresh_lock). The watermark, open set and gaps belong
+    to it; _lock only guards the swap of columns and counters, never DB I/O.
+    """
+
+    def __init__(self, refresh_seconds=5.0):
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._allocate(_INITIAL_CAPACITY)
+        self._watermark = 0
+        self._open_ids = set()
+        self._gaps = {}
+        self._last_refresh = 0.0
+        self._factor_version = None
+        self._tz_offsets = {}
+
+    def _allocate(self, capacity):
+        self._n = 0
+        self._entry_id = np.empty(capacity, dtype=np.int64)
+        self._enter = np.empty(capacity, dtype=np.float64)
+        self._minutes = np.empty(capacity, dtype=np.float64)
+        self._fuel = np.empty(capacity, dtype=np.float64)
+        self._carbon = np.empty(capacity, dtype=np.float64)
+
+    # --- Loading ---
+
+    def refresh(self, conn):
+        """
+        Pull newly closed entries since the last refresh. Returns rows appended.
+        A change of active emission-factor version invalidates the snapshot.
+        """
+        with self._refresh_lock:
+            return self._refresh(conn)
+
+    def _refresh(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT version FROM emission_factor_sets WHERE status = 'active'")
+            row = cur.fetchone()
+            version = row[0] if row else None
+            reset = version != self._factor_version
+            watermark = 0 if reset else self._watermark
+            open_ids = set() if reset else set(self._open_ids)
+            now = time.monotonic()
+            gaps = {} if reset else {i: t for i, t in self._gaps.items() if now - t < _GAP_SECONDS}
+            cur.execute("""
+                SELECT entry_id, enter_timestamp, exit_timestamp,
+                       minutes_elapsed, fuel_used, carbon_produced
+                FROM car_entries
+                WHERE entry_id > %s OR entry_id = ANY(%s)
+                ORDER BY entry_id
+            """, (watermark, list(open_ids | gaps.keys())))
+            rows = cur.fetchall()
+        gaps = self._update_gaps(gaps, watermark, [r[0] for r in rows], now)
+        closed = []
+        for entry_id, enter_ts, exit_ts, minutes, fuel, carbon in rows:
+            watermark = max(watermark, entry_id)
+            if exit_ts is None or enter_ts is None:
+                open_ids.add(entry_id)
+                continue
+            open_ids.discard(entry_id)
+            closed.append((entry_id, _epoch(enter_ts), float(minutes or 0), float(fuel or 0), float(carbon or 0)))
+        with self._lock:
+            if reset:
+                # Fresh arrays: readers may still hold views of the old snapshot.
+                self._allocate(_INITIAL_CAPACITY)
+                self._factor_version = version
+            self._append(closed)
+            self._watermark = watermark
+            self._open_ids = open_ids
+            self._gaps = gaps
+            self._last_refresh = time.monotonic()
+        return len(closed)
+
+    @staticmethod
+    def _update_gaps(gaps, watermark, ids, now):
+        """
+        Gaps after a refresh that returned `ids`: ids it skipped past are added and ids
+        it found are dropped. (Rolled-back inserts leave permanent gaps, which is why
+        they expire after _GAP_SECONDS.)
+        """
+        if not ids:
+            return gaps
+        found = np.asarray(ids, dtype=np.int64)
+        top = int(found.max())
+        start = watermark + 1 if watermark else int(found.min())
+        start = max(start, top - _MAX_GAPS)
+        for entry_id in np.setdiff1d(np.arange(start, top, dtype=np.int64), found).tolist():
+            gaps.setdefault(entry_id, now)
+        for entry_id in ids:
+            gaps.pop(entry_id, None)
+        if len(gaps) > _MAX_GAPS:
+            gaps = dict(sorted(gaps.items())[-_MAX_GAPS:])
+        return gaps
+
+    def refresh_if_stale(self, connect):
+        """
+        Refresh via connect() only when the snapshot is older than refresh_seconds.
+        Single-flight: while one caller refreshes, the others answer from the current
+        snapshot instead of queueing (only the very first load is waited for).
+        """
+        if time.monotonic() - self._last_refresh < self.refresh_seconds:
+            return 0
+        if not self._refresh_lock.acquire(blocking=self._last_refresh == 0):
+            return 0
+        try:
+            if time.monotonic() - self._last_refresh < self.refresh_seconds:
+                return 0  # Refreshed while we waited for the first load.
+            conn = connect()
+            try:
+                return self._refresh(conn)
+            finally:
+                conn.close()
+        finally:
+            self._refresh_lock.release()
+
+    def _append(self, rows):
+        if not rows:
+            return
+        needed = self._n + len(rows)
+        if needed > len(self._entry_id):
+            capacity = len(self._entry_id)
+            while capacity < needed:
+                capacity *= 2
+            for name in ("_entry_id", "_enter", "_minutes", "_fuel", "_carbon"):
+                old = getattr(self, name)
+                grown = np.empty(capacity, dtype=old.dtype)
+                grown[:self._n] = old[:self._n]
+                setattr(self, name, grown)
+        cols = list(zip(*rows))
+        end = self._n + len(rows)
+        self._entry_id[self._n:end] = cols[0]
+        self._enter[self._n:end] = cols[1]
+        self._minutes[self._n:end] = cols[2]
+        self._fuel[self._n:end] = cols[3]
+        self._carbon[self._n:end] = cols[4]
+        self._n = end
+
+    def _columns(self):
+        """Consistent views of the loaded columns (safe against concurrent appends)."""
+        with self._lock:
+            n = self._n
+            return self._enter[:n], self._minutes[:n], self._fuel[:n], self._carbon[:n]
+
+    @property
+    def cars_in_drive_through(self):
+        return len(self._open_ids)
+
+    # --- Timezone bucketing ---
+
+    def _local_seconds(self, enter, tz):
+        """Shift UTC epoch seconds to local wall-clock seconds for tz (DST-aware)."""
+        zone = _resolve_tz(tz)
+        cache = self._tz_offsets.setdefault(tz, {})
+        hours, inv = np.unique((enter // _HOUR).astype(np.int64), return_inverse=True)
+        offsets = np.empty(len(hours), dtype=np.float64)
+        for i, h in enumerate(hours.tolist()):
+            off = cache.get(h)
+            if off is None:
+                off = datetime.fromtimestamp(h * _HOUR, zone).utcoffset().total_seconds()
+                cache[h] = off
+            offsets[i] = off
+        return enter + offsets[inv]
+
+    # --- Aggregates (mirror the SQL helpers in app.py) ---
+
+    def metrics_last_hours(self, hours=2, now=None):
+        """Per-hour (hour, total_cars, avg_minutes, total_co2_kg, fuel_grams), newest first."""
+        enter, minutes, fuel, carbon = self._columns()
+        now = time.time() if now is None else now
+        mask = enter >= now - hours * _HOUR
+        keys = (enter[mask] // _HOUR).astype(np.int64)
+        uniq, counts, (m_sum, c_sum, f_sum) = _group_sum(keys, minutes[mask], carbon[mask], fuel[mask])
+        rows = []
+        for i in range(len(uniq) - 1, -1, -1):
+            hour = datetime.fromtimestamp(int(uniq[i]) * _HOUR, timezone.utc).replace(tzinfo=None)
+            rows.append((hour, int(counts[i]), float(m_sum[i] / counts[i]), float(c_sum[i]) / 1000.0, float(f_sum[i])))
+        return rows
+
+    def all_time_metrics(self, hours=24, now=None):
+        """(total_cars, avg_minutes, total_co2_kg, fuel_grams) for last N hours, or all time."""
+        enter, minutes, fuel, carbon = self._columns()
+        if hours:
+            now = time.time() if now is None else now
+            mask = enter >= now - hours * _HOUR
+            minutes, fuel, carbon = minutes[mask], fuel[mask], carbon[mask]
+        total = len(minutes)
+        avg = float(minutes.mean()) if total else 0.0
+        return total, avg, float(carbon.sum()) / 1000.0, float(fuel.sum())
+
+    def peak_hour(self, hours=168, tz="America/Los_Angeles", now=None):
+        """Local 1-hour window with the highest CO2, formatted 'HH:MM-HH:MM', or ''."""
+        enter, _, _, carbon = self._columns()
+        if hours:
+            now = time.time() if now is None else now
+            mask = enter >= now - hours * _HOUR
+            enter, carbon = enter[mask], carbon[mask]
+        if not len(enter):
+            return ""
+        keys = (self._local_seconds(enter, tz) // _HOUR).astype(np.int64)
+        uniq, _, (c_sum,) = _group_sum(keys, carbon)
+        best = int(np.argmax(c_sum))
+        if c_sum[best] <= 0:
+            return ""
+        start = int(uniq[best]) % 24
+        return f"{start:02d}:00-{(start + 1) % 24:02d}:00"
+
+    def idle_distribution(self):
+        """Counts of closed entries by idle bucket: <5, 5-10, 10+ minutes."""
+        _, minutes, _, _ = self._columns()
+        under_5 = int(np.count_nonzero(minutes < 5))
+        ten_plus = int(np.count_nonzero(minutes >= 10))
+        return [
+            {"range": "<5 mins", "count": under_5},
+            {"range": "5-10 mins", "count": len(minutes) - under_5 - ten_plus},
+            {"range": "10+ mins", "count": ten_plus},
+        ]
+
+    def hotspots_grid(self, tz="America/Los_Angeles"):
+        """7x24 CO2 grid (kg) by local day-of-week (0=Mon) and hour."""
+        enter, _, _, carbon = self._columns()
+        grid = np.zeros(7 * 24, dtype=np.float64)
+        if len(enter):
+            local = self._local_seconds(enter, tz)
+            day = ((local // _DAY).astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday
+            hour = ((local % _DAY) // _HOUR).astype(np.int64)
+            grid = np.bincount(day * 24 + hour, weights=carbon, minlength=7 * 24) / 1000.0
+        return [[round(float(v), 2) for v in row] for row in grid.reshape(7, 24)]
+
+    def hourly_trends(self, hours=24, now=None):
+        """Hourly car counts and idle seconds for charts (last N hours)."""
+        enter, minutes, _, _ = self._columns()
+        now = time.time() if now is None else now
+        mask = enter >= now - hours * _HOUR
+        keys = (enter[mask] // _HOUR).astype(np.int64)
+        uniq, counts, (m_sum,) = _group_sum(keys, minutes[mask])
+        rows = [
+            {"hour": f"{int(k) % 24:02d}:00", "total_cars": int(c), "total_idle_seconds": int(round(s * 60))}
+            for k, c, s in zip(uniq, counts, m_sum)
+        ]
+        rows.sort(key=lambda r: r["hour"])
+        return rows
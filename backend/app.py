@@ -2,22 +2,48 @@
 """
 Flask API serving dashboard metrics from PostgreSQL car_entries table.
 """
+import json
+import logging
+import math
 import os
+import queue
 import random
-from datetime import datetime, timezone
+import threading
+from datetime import datetime, timedelta, timezone
 
 import psycopg2
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 
+from analytics_engine import ColumnarAnalytics
+import admission
 from db import get_connection
+from efficiency import compute_efficiency_score
+import emission_factors
+import negotiation
+import offset_purchases
+from ingest_wal import DEFAULT_WAL_PATH, WriteBehindIngest
+import plates
+import rollups
+from forecast import DEFAULT_STATE_PATH, HourOfWeekForecaster
+import simulator
+from stall_detector import StallDetector
 
 app = Flask(__name__)
 
-# In-memory carbon credits account (Cloverly mimic). 1 CO2 kg = 1 carbon credit.
-# For production, persist to DB. Set CLOVERLY_API_KEY to use real Cloverly sandbox.
-_carbon_credits_balance = 0.0
-_carbon_credits_purchase_history = []
+# Optional columnar analytics engine: ANALYTICS_ENGINE=columnar serves dashboard
+# aggregates from an in-memory snapshot refreshed every ANALYTICS_REFRESH_SECONDS.
+_analytics = (
+    ColumnarAnalytics(refresh_seconds=float(os.environ.get("ANALYTICS_REFRESH_SECONDS", "5")))
+    if os.environ.get("ANALYTICS_ENGINE") == "columnar"
+    else None
+)
+
+# Carbon credits account (Cloverly). 1 CO2 kg = 1 carbon credit. Purchases are queued in
+# offset_purchases and bought in batches by a background worker; set CLOVERLY_API_KEY
+# (and optionally CLOVERLY_API_URL) to use Cloverly instead of the simulated provider.
+_purchase_worker = None
+_purchase_worker_lock = threading.Lock()
 
 
 def _ts_iso_utc(dt):
@@ -27,10 +53,24 @@ def _ts_iso_utc(dt):
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
     return dt.isoformat().replace("+00:00", "Z")
+
+
+def _ts_epoch(dt):
+    """Epoch seconds for a DB timestamp (naive values are UTC)."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
 CORS(app)
+negotiation.install(app)
+logger = logging.getLogger(__name__)
 
 TREES_KG_PER_YEAR = 22
 
+# Next-hour forecaster, loaded from FORECAST_STATE_PATH and caught up from the DB on first use.
+_forecaster = None
+_forecaster_lock = threading.Lock()
+_FORECAST_STATE_PATH = os.environ.get("FORECAST_STATE_PATH", DEFAULT_STATE_PATH)
+
 
 def _get_metrics_last_hours(conn, hours=2):
     """Get aggregated metrics for the last N hours, per hour."""
@@ -233,54 +273,176 @@ def _get_hourly_trends(conn, hours=24):
     return [{"hour": r[0], "total_cars": r[1], "total_idle_seconds": r[2]} for r in rows]
 
 
-def _compute_efficiency_score(total_co2_kg, avg_minutes, total_cars):
-    """
-    Efficiency 0-100: lower CO2 and idle = higher score.
-    Formula: score = 100 - co2_penalty - idle_penalty
-      co2_penalty = min(50, co2_per_vehicle_kg * 30)
-      idle_penalty = min(40, avg_minutes * 4)
-    Min score from formula is 10 (max penalties 50+40=90). Floor at 1 when we have data.
-    """
-    total_cars = float(total_cars or 0)
-    total_co2_kg = float(total_co2_kg or 0)
-    avg_minutes = float(avg_minutes or 0)
-    if total_cars == 0:
-        return 100.0
-    co2_per_vehicle = total_co2_kg / total_cars
-    co2_penalty = min(50, co2_per_vehicle * 30)
-    idle_penalty = min(40, avg_minutes * 4)
-    score = max(1, min(100, 100 - co2_penalty - idle_penalty))
-    return round(float(score), 1)
-
-
 def _pct_change(current, prev):
     if prev == 0:
         return 0
     return round(((current - prev) / prev) * 100)
 
 
+def _get_forecaster():
+    """Load persisted forecast state and replay events since it was saved (first call only)."""
+    global _forecaster
+    with _forecaster_lock:
+        if _forecaster is None:
+            model = HourOfWeekForecaster.load(
+                _FORECAST_STATE_PATH, tz=os.environ.get("FORECAST_TZ", "America/Los_Angeles")
+            )
+            conn = get_connection()
+            try:
+                model.catch_up(conn)
+            finally:
+                conn.close()
+            model.save(_FORECAST_STATE_PATH)
+            _forecaster = model
+        return _forecaster
+
+
+def _get_purchase_worker():
+    """Create the offset_purchases table and start the purchase worker (first call only)."""
+    global _purchase_worker
+    with _purchase_worker_lock:
+        if _purchase_worker is None:
+            conn = get_connection()
+            try:
+                offset_purchases.ensure_schema(conn)
+            finally:
+                conn.close()
+            _purchase_worker = offset_purchases.PurchaseWorker(get_connection).start()
+        return _purchase_worker
+
+
+def _forecast_observe(kind, row):
+    """Feed a committed enter/exit into the forecaster; persist when an hour closes."""
+    if _forecaster is None:
+        return  # Not loaded yet; catch_up will replay this event from the DB.
+    if kind == "enter":
+        rolled = _forecaster.observe_enter(_ts_epoch(row[2]))
+    else:
+        rolled = _forecaster.observe_exit(_ts_epoch(row[3]), row[4], row[5])
+    if rolled:
+        _forecaster.save(_FORECAST_STATE_PATH)
+
+
+# Stalled-vehicle alerts: STALL_THRESHOLD_MINUTES (default 10, 0 disables) after entry without
+# an exit, logged, streamed on /stalls/stream and POSTed to STALL_WEBHOOK_URL if set.
+_STALL_THRESHOLD_MINUTES = float(os.environ.get("STALL_THRESHOLD_MINUTES", "10"))
+_stall_detector = None
+
+
+def _entry_committed(kind, row):
+    """Fan a committed enter/exit row out to the response cache, forecaster and stall detector."""
+    negotiation.cache.clear()
+    try:
+        _forecast_observe(kind, row)
+    except Exception:
+        # The entry is committed; a failed state save is retried at the next hour.
+        logger.exception("Forecast update failed")
+    if _stall_detector is not None:
+        if kind == "enter":
+            _stall_detector.observe_enter(row[0], row[1], _ts_epoch(row[2]))
+        else:
+            _stall_detector.observe_exit(row[0], _ts_epoch(row[3]))
+
+
+# Optional write-behind ingest: INGEST_MODE=write_behind acknowledges enter/exit once they
+# are in the local log and flushes them to Postgres in the background.
+# Opened by _start_background_services() so only one process ever appends to the log.
+_INGEST_WRITE_BEHIND = os.environ.get("INGEST_MODE") == "write_behind"
+_ingest = None
+
+
+# Background threads start in the serving process only: on its first request, or up front
+# in the reloader child under `python app.py`. Never at import, so the reloader parent,
+# worker processes and scripts that import this module run none of them.
+_background_started = False
+_background_lock = threading.Lock()
+
+
+def _start_background_services():
+    global _background_started, _ingest, _stall_detector
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        if _STALL_THRESHOLD_MINUTES > 0:
+            _stall_detector = StallDetector(
+                _STALL_THRESHOLD_MINUTES * 60, webhook_url=os.environ.get("STALL_WEBHOOK_URL")
+            ).start(get_connection)
+        if _INGEST_WRITE_BEHIND:
+            _ingest = WriteBehindIngest(
+                get_connection,
+                path=os.environ.get("INGEST_WAL_PATH", DEFAULT_WAL_PATH),
+                fsync=os.environ.get("INGEST_WAL_FSYNC") == "1",
+                on_applied=_entry_committed,
+            ).start()
+        _background_started = True
+
+
+@app.before_request
+def _ensure_background_services():
+    _start_background_services()
+
+
+def _columnar():
+    """Columnar engine refreshed to the latest watermark, or None when serving from SQL."""
+    if _analytics is not None:
+        _analytics.refresh_if_stale(get_connection)
+    return _analytics
+
+
+# Column widths in car_entries; checked up front so write-behind never logs an event
+# Postgres would reject.
+_ENTRY_FIELD_MAX_LENGTHS = {"numberplate": 20, "vehicle_class": 20, "site": 50}
+
+
+def _ingest_uses_db():
+    """Write-behind enter/exit only append to the local log, so they need no DB slot."""
+    return _ingest is None
+
+
 @app.route("/car-entries/enter", methods=["POST"])
+@admission.admit(admission.INGEST, uses_db=_ingest_uses_db)
 def car_enter():
     """Simulate car entering drive-through. Creates record with enter_timestamp, exit_timestamp=null."""
+    data = request.get_json() or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Body must be a JSON object"}), 400
+    numberplate = data.get("numberplate") or f"SIM-{random.randint(10000, 99999)}"
+    vehicle_class = data.get("vehicle_class") or "default"
+    site = data.get("site") or "default"
+    for field, value in (("numberplate", numberplate), ("vehicle_class", vehicle_class), ("site", site)):
+        if not isinstance(value, str) or len(value) > _ENTRY_FIELD_MAX_LENGTHS[field]:
+            return jsonify({
+                "error": f"{field} must be a string of at most {_ENTRY_FIELD_MAX_LENGTHS[field]} characters"
+            }), 400
+    if _ingest is not None:
+        record = _ingest.append("enter", numberplate=numberplate, vehicle_class=vehicle_class, site=site)
+        return jsonify({
+            "entry_id": None,
+            "numberplate": numberplate,
+            "enter_timestamp": record["ts"].replace("+00:00", "Z"),
+            "queued": True,
+        })
+
     try:
         conn = get_connection()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
     try:
-        data = request.get_json() or {}
-        numberplate = data.get("numberplate") or f"SIM-{random.randint(10000, 99999)}"
         with conn.cursor() as cur:
             cur.execute(
                 """
-                INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp)
-                VALUES (%s, NOW(), NULL)
+                INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp, vehicle_class, site)
+                VALUES (%s, NOW(), NULL, %s, %s)
                 RETURNING entry_id, numberplate, enter_timestamp
                 """,
-                (numberplate,),
+                (numberplate, vehicle_class, site),
             )
             row = cur.fetchone()
             conn.commit()
+        _entry_committed("enter", row)
         return jsonify({"entry_id": row[0], "numberplate": row[1], "enter_timestamp": _ts_iso_utc(row[2])})
     except psycopg2.Error as e:
         conn.rollback()
@@ -290,8 +452,13 @@ def car_enter():
 
 
 @app.route("/car-entries/exit", methods=["POST"])
+@admission.admit(admission.INGEST, uses_db=_ingest_uses_db)
 def car_exit():
     """Simulate car leaving. Updates the car waiting longest (FIFO) with exit_timestamp."""
+    if _ingest is not None:
+        record = _ingest.append("exit")
+        return jsonify({"exit_timestamp": record["ts"].replace("+00:00", "Z"), "queued": True})
+
     try:
         conn = get_connection()
     except Exception as e:
@@ -309,13 +476,14 @@ def car_exit():
                     ORDER BY enter_timestamp ASC
                     LIMIT 1
                 )
-                RETURNING entry_id, numberplate, enter_timestamp, exit_timestamp
+                RETURNING entry_id, numberplate, enter_timestamp, exit_timestamp, minutes_elapsed, carbon_produced
                 """
             )
             row = cur.fetchone()
             conn.commit()
         if not row:
             return jsonify({"error": "No car in drive-through to exit"}), 400
+        _entry_committed("exit", row)
         return jsonify({
             "entry_id": row[0],
             "numberplate": row[1],
@@ -330,6 +498,8 @@ def car_exit():
 
 
 @app.route("/car-entries")
+@negotiation.cached
+@admission.admit(admission.ANALYTICS)
 def car_entries_list():
     """Recent car entries, order by enter_timestamp desc. Includes entries without exit."""
     try:
@@ -376,6 +546,8 @@ def car_entries_list():
 
 
 @app.route("/car-entries/pending")
+@negotiation.cached
+@admission.admit(admission.ANALYTICS)
 def car_pending():
     """Cars currently in drive-through (exit_timestamp is null)."""
     try:
@@ -401,8 +573,188 @@ def car_pending():
         conn.close()
 
 
+# Served from the detector's memory: no DB connection, so no admission slot.
+@app.route("/stalls")
+def stalls():
+    """Cars currently past the stall threshold, oldest first."""
+    if _stall_detector is None:
+        return jsonify({"error": "Stall detection disabled (STALL_THRESHOLD_MINUTES=0)"}), 404
+    return jsonify({
+        "threshold_minutes": _STALL_THRESHOLD_MINUTES,
+        "stalled": _stall_detector.stalled(),
+        "stats": _stall_detector.stats(),
+    })
+
+
+@app.route("/stalls/stream")
+def stalls_stream():
+    """Server-Sent Events: one `stalled` / `cleared` event per alert, as it fires."""
+    if _stall_detector is None:
+        return jsonify({"error": "Stall detection disabled (STALL_THRESHOLD_MINUTES=0)"}), 404
+    subscription = _stall_detector.subscribe()
+
+    def events():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    alert = subscription.get(timeout=15)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {alert['event']}\ndata: {json.dumps(alert)}\n\n"
+        finally:
+            _stall_detector.unsubscribe(subscription)
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def _plate_stats_json(stats):
+    return {
+        **stats,
+        "first_seen": _ts_iso_utc(stats["first_seen"]) if stats["first_seen"] else None,
+        "last_seen": _ts_iso_utc(stats["last_seen"]) if stats["last_seen"] else None,
+    }
+
+
+@app.route("/car-entries/search")
+@admission.admit(admission.ANALYTICS)
+def car_entries_search():
+    """
+    Plate lookup: ?plate=...&mode=exact|prefix|fuzzy&limit=N. Returns matching plates
+    with their aggregates; exact matches also include recent visits.
+    """
+    plate = request.args.get("plate", "")
+    mode = request.args.get("mode", "exact")
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    if not plates.normalize_plate(plate):
+        return jsonify({"error": "plate is required"}), 400
+    if mode not in plates.MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(plates.MODES)}"}), 400
+
+    try:
+        conn = get_connection()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    try:
+        matches = plates.search(conn, plate, mode=mode, limit=limit)
+        payload = {"plate": plates.normalize_plate(plate), "mode": mode,
+                   "matches": [_plate_stats_json(m) for m in matches]}
+        if mode == "exact":
+            payload["visits"] = [
+                {
+                    "entry_id": r[0],
+                    "enter_timestamp": _ts_iso_utc(r[1]) if r[1] else None,
+                    "exit_timestamp": _ts_iso_utc(r[2]) if r[2] else None,
+                    "minutes_elapsed": round(float(r[3]), 2) if r[3] is not None else None,
+                    "carbon_produced": round(float(r[4]), 2) if r[4] is not None else None,
+                }
+                for r in plates.visit_history(conn, plate)
+            ]
+        return jsonify(payload)
+    except psycopg2.Error as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
+@app.route("/plates/repeat-visitors")
+@admission.admit(admission.ANALYTICS)
+def repeat_visitors():
+    """Unique vs repeat plates and the most frequent visitors (?limit=N)."""
+    try:
+        conn = get_connection()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    try:
+        limit = min(max(request.args.get("limit", 10, type=int), 1), 100)
+        stats = plates.repeat_visitors(conn, limit=limit)
+        stats["top_repeat_visitors"] = [_plate_stats_json(p) for p in stats["top_repeat_visitors"]]
+        return jsonify(stats)
+    except psycopg2.Error as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
+def _metrics_payload(hourly, all_time, cars_in_drive_through, peak_hour):
+    """Assemble the /metrics response from hourly rows and overall aggregates."""
+    total_cars, avg_minutes, total_co2_kg, fuel_grams = all_time or (0, 0, 0, 0)
+
+    trees_required = round(total_co2_kg / TREES_KG_PER_YEAR, 1) if total_co2_kg else 0
+    co2_per_vehicle = (total_co2_kg / total_cars) if total_cars else 0
+
+    # Efficiency score: last 2 hours if available, else all-time (so seed data always counts)
+    last_hr = hourly[0] if hourly else None
+    if last_hr:
+        _, lh_cars, lh_avg_min, lh_co2_kg, lh_fuel = last_hr
+        sustainability_score = compute_efficiency_score(lh_co2_kg, lh_avg_min, lh_cars)
+    else:
+        sustainability_score = compute_efficiency_score(total_co2_kg, avg_minutes, total_cars) if total_cars else 100
+
+    # vs last hr trends
+    vehicles_trend = {"value": 0, "isPositive": False}
+    co2_trend = {"value": 0, "isPositive": False}
+    idle_trend = {"value": 0, "isPositive": False}
+
+    if len(hourly) >= 2:
+        curr = hourly[0]
+        prev = hourly[1]
+        curr_cars, curr_avg_min, curr_co2, _ = curr[1], curr[2], curr[3], curr[4]
+        prev_cars, prev_avg_min, prev_co2, _ = prev[1], prev[2], prev[3], prev[4]
+
+        v = _pct_change(curr_cars, prev_cars)
+        vehicles_trend = {"value": abs(v), "isPositive": v > 0}
+
+        c = _pct_change(curr_co2, prev_co2)
+        co2_trend = {"value": abs(c), "isPositive": c < 0}
+
+        curr_idle_sec = curr_avg_min * 60 * curr_cars if curr_cars else 0
+        prev_idle_sec = prev_avg_min * 60 * prev_cars if prev_cars else 0
+        i = _pct_change(curr_idle_sec, prev_idle_sec)
+        idle_trend = {"value": abs(i), "isPositive": i < 0}
+
+    return {
+        "total_cars": total_cars,
+        "avg_idle_minutes": round(avg_minutes, 1),
+        "total_co2_kg": round(total_co2_kg, 1),
+        "trees_required": trees_required,
+        "sustainability_score": sustainability_score,
+        "fuel_wasted_grams": round(fuel_grams, 1),
+        "co2_per_vehicle_kg": round(co2_per_vehicle, 3),
+        "peak_hour": peak_hour,
+        "cars_in_drive_through": cars_in_drive_through,
+        "trends": {
+            "vehicles": vehicles_trend,
+            "co2": co2_trend,
+            "idle": idle_trend,
+        },
+    }
+
+
 @app.route("/metrics")
+@negotiation.cached
+@admission.admit(admission.ANALYTICS)
 def metrics():
+    tz = request.args.get("tz", "America/Los_Angeles")
+    try:
+        engine = _columnar()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if engine is not None:
+        try:
+            all_time = engine.all_time_metrics(hours=24)
+            if all_time[0] == 0:
+                all_time = engine.all_time_metrics(hours=None)
+            peak_hour = engine.peak_hour(hours=168, tz=tz) or engine.peak_hour(hours=None, tz=tz)
+            return jsonify(_metrics_payload(
+                engine.metrics_last_hours(hours=24), all_time, engine.cars_in_drive_through, peak_hour
+            ))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 500
+
     try:
         conn = get_connection()
     except Exception as e:
@@ -414,68 +766,17 @@ def metrics():
         if all_time and all_time[0] == 0:
             all_time = _get_all_time_metrics(conn, hours=None)
 
-        total_cars, avg_minutes, total_co2_kg, fuel_grams = all_time or (0, 0, 0, 0)
-
         with conn.cursor() as cur:
             cur.execute(
                 "SELECT COUNT(*) FROM car_entries WHERE enter_timestamp IS NOT NULL AND exit_timestamp IS NULL"
             )
             cars_in_drive_through = cur.fetchone()[0] or 0
 
-        trees_required = round(total_co2_kg / TREES_KG_PER_YEAR, 1) if total_co2_kg else 0
-        co2_per_vehicle = (total_co2_kg / total_cars) if total_cars else 0
-
-        # Efficiency score: last 2 hours if available, else all-time (so seed data always counts)
-        last_hr = hourly[0] if hourly else None
-        if last_hr:
-            _, lh_cars, lh_avg_min, lh_co2_kg, lh_fuel = last_hr
-            sustainability_score = _compute_efficiency_score(lh_co2_kg, lh_avg_min, lh_cars)
-        else:
-            sustainability_score = _compute_efficiency_score(total_co2_kg, avg_minutes, total_cars) if total_cars else 100
-
-        # vs last hr trends
-        vehicles_trend = {"value": 0, "isPositive": False}
-        co2_trend = {"value": 0, "isPositive": False}
-        idle_trend = {"value": 0, "isPositive": False}
-
-        if len(hourly) >= 2:
-            curr = hourly[0]
-            prev = hourly[1]
-            curr_cars, curr_avg_min, curr_co2, _ = curr[1], curr[2], curr[3], curr[4]
-            prev_cars, prev_avg_min, prev_co2, _ = prev[1], prev[2], prev[3], prev[4]
-
-            v = _pct_change(curr_cars, prev_cars)
-            vehicles_trend = {"value": abs(v), "isPositive": v > 0}
-
-            c = _pct_change(curr_co2, prev_co2)
-            co2_trend = {"value": abs(c), "isPositive": c < 0}
-
-            curr_idle_sec = curr_avg_min * 60 * curr_cars if curr_cars else 0
-            prev_idle_sec = prev_avg_min * 60 * prev_cars if prev_cars else 0
-            i = _pct_change(curr_idle_sec, prev_idle_sec)
-            idle_trend = {"value": abs(i), "isPositive": i < 0}
-
-        tz = request.args.get("tz", "America/Los_Angeles")
         peak_hour = _get_peak_hour(conn, hours=168, tz=tz)
         if not peak_hour:
             peak_hour = _get_peak_hour(conn, hours=None, tz=tz)
 
-        return jsonify({
-            "total_cars": total_cars,
-            "avg_idle_minutes": round(avg_minutes, 1),
-            "total_co2_kg": round(total_co2_kg, 1),
-            "trees_required": trees_required,
-            "sustainability_score": sustainability_score,
-            "fuel_wasted_grams": round(fuel_grams, 1),
-            "co2_per_vehicle_kg": round(co2_per_vehicle, 3),
-            "peak_hour": peak_hour,
-            "cars_in_drive_through": cars_in_drive_through,
-            "trends": {
-                "vehicles": vehicles_trend,
-                "co2": co2_trend,
-                "idle": idle_trend,
-            },
-        })
+        return jsonify(_metrics_payload(hourly, all_time, cars_in_drive_through, peak_hour))
     except psycopg2.Error as e:
         return jsonify({"error": str(e)}), 500
     finally:
@@ -483,6 +784,8 @@ def metrics():
 
 
 @app.route("/emissions-timeseries")
+@negotiation.cached
+@admission.admit(admission.ANALYTICS)
 def emissions_timeseries():
     """Last 1 hour from latest exit_timestamp, 5-min buckets, CO2 per bucket."""
     try:
@@ -499,16 +802,65 @@ def emissions_timeseries():
         conn.close()
 
 
+@app.route("/series")
+@negotiation.cached
+@admission.admit(admission.ANALYTICS)
+def series():
+    """
+    Long-range emissions series from precomputed rollups. ?hours=24 or ?start=&end= (ISO 8601),
+    ?max_points=500, ?lttb=1 to downsample, ?metric=co2_kg for the LTTB shape.
+    """
+    try:
+        end = request.args.get("end")
+        end = datetime.fromisoformat(end) if end else datetime.now(timezone.utc)
+        start = request.args.get("start")
+        if start:
+            start = datetime.fromisoformat(start)
+        else:
+            start = end - timedelta(hours=request.args.get("hours", 24, type=float))
+        start, end = (
+            (dt.astimezone(timezone.utc) if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).replace(tzinfo=None)
+            for dt in (start, end)
+        )
+        max_points = min(max(request.args.get("max_points", 500, type=int), 3), 5000)
+        downsample = request.args.get("lttb", "0") in ("1", "true")
+        metric = request.args.get("metric", "co2_kg")
+    except (ValueError, TypeError, OverflowError) as e:
+        return jsonify({"error": str(e)}), 400
+    if end <= start:
+        return jsonify({"error": "end must be after start"}), 400
+
+    try:
+        conn = get_connection()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    try:
+        resolution, points = rollups.get_series(conn, start, end, max_points, downsample, metric)
+        return jsonify({"resolution_minutes": resolution, "points": points})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except psycopg2.Error as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
 @app.route("/hotspots")
+@negotiation.cached
+@admission.admit(admission.ANALYTICS)
 def hotspots():
     """CO2 heatmap grid: 7 days x 24 hours, values in kg. ?tz=America/Los_Angeles for local time."""
+    tz = request.args.get("tz", "America/Los_Angeles")
     try:
+        engine = _columnar()
+        if engine is not None:
+            return jsonify({"grid": engine.hotspots_grid(tz=tz)})
         conn = get_connection()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
     try:
-        tz = request.args.get("tz", "America/Los_Angeles")
         grid = _get_hotspots_grid(conn, tz=tz)
         return jsonify({"grid": grid})
     except psycopg2.Error as e:
@@ -518,9 +870,14 @@ def hotspots():
 
 
 @app.route("/idle-distribution")
+@negotiation.cached
+@admission.admit(admission.ANALYTICS)
 def idle_distribution():
     """Count of complete records by idle time bucket (<5 mins, 5-10 mins, 10+ mins)."""
     try:
+        engine = _columnar()
+        if engine is not None:
+            return jsonify(engine.idle_distribution())
         conn = get_connection()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -535,8 +892,13 @@ def idle_distribution():
 
 
 @app.route("/trends")
+@negotiation.cached
+@admission.admit(admission.ANALYTICS)
 def trends():
     try:
+        engine = _columnar()
+        if engine is not None:
+            return jsonify(engine.hourly_trends())
         conn = get_connection()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -550,56 +912,203 @@ def trends():
         conn.close()
 
 
+@app.route("/forecast")
+@admission.admit(admission.ANALYTICS)
+def forecast():
+    """Next-hour forecast of cars, idle minutes and CO2 (kg) with 95% intervals."""
+    try:
+        return jsonify(_get_forecaster().forecast_next_hour())
+    except (psycopg2.Error, ValueError) as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/emission-factors")
+@admission.admit(admission.ANALYTICS)
+def emission_factor_profile():
+    """Emission factors for a version (?version=N, default: the active one)."""
+    try:
+        conn = get_connection()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    try:
+        return jsonify(emission_factors.list_factors(conn, request.args.get("version", type=int)))
+    except psycopg2.Error as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
+@app.route("/emission-factors/recompute")
+@app.route("/emission-factors/recompute/<int:job_id>")
+@admission.admit(admission.ANALYTICS)
+def emission_factor_recompute_status(job_id=None):
+    """Progress of a historical recompute job (default: the latest)."""
+    try:
+        conn = get_connection()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    try:
+        status = emission_factors.job_status(conn, job_id)
+        if status is None:
+            return jsonify({"error": "No recompute job found"}), 404
+        return jsonify(status)
+    except psycopg2.Error as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
+@app.route("/simulate", methods=["POST"])
+@admission.admit(admission.ANALYTICS)
+def simulate():
+    """
+    What-if queue simulation. Body: {"scenarios": [{"lanes", "distribution", "service_mean_minutes",
+    "service_cv"}], "runs", and either "arrivals_per_hour" or "hour_of_week" (default: now)}.
+    """
+    data = request.get_json() or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Body must be a JSON object"}), 400
+    tz = request.args.get("tz", "America/Los_Angeles")
+    try:
+        arrivals = data.get("arrivals_per_hour")
+        if arrivals is None:
+            try:
+                conn = get_connection()
+            except Exception as e:
+                return jsonify({"error": str(e)}), 500
+            try:
+                rates = simulator.get_arrival_rates(conn, tz=tz)
+            except psycopg2.Error as e:
+                return jsonify({"error": str(e)}), 500
+            finally:
+                conn.close()
+            how = data.get("hour_of_week")
+            how = simulator.current_hour_of_week(tz) if how is None else int(how)
+            arrivals = rates[how % 168]
+        results = simulator.simulate(
+            data.get("scenarios") or [{}],
+            float(arrivals),
+            runs=data.get("runs", 10000),
+            seed=data.get("seed"),
+        )
+        return jsonify({"arrivals_per_hour": round(float(arrivals), 2), "scenarios": results})
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+
 # --- Go Carbon Neutral: Cloverly-mimic carbon credits (1 CO2 kg = 1 credit) ---
 
 @app.route("/carbon-neutral/account")
+@admission.admit(admission.ANALYTICS)
 def carbon_neutral_account():
-    """Get carbon credits balance and purchase history."""
-    global _carbon_credits_balance, _carbon_credits_purchase_history
-    return jsonify({
-        "credits_balance": round(_carbon_credits_balance, 2),
-        "purchase_history": list(_carbon_credits_purchase_history[-20:]),  # last 20
-    })
+    """Get confirmed carbon credits balance and purchase history."""
+    try:
+        _get_purchase_worker()
+        conn = get_connection()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    try:
+        balance = offset_purchases.get_balance(conn)
+        history = offset_purchases.get_history(conn, limit=20)
+        return jsonify({
+            "credits_balance": round(balance, 2),
+            "purchase_history": [
+                {
+                    "purchase_id": r[0],
+                    "credits": float(r[1]),
+                    "timestamp": _ts_iso_utc(r[2]),
+                    "status": r[3],
+                    "balance_after": round(float(r[4]), 2),
+                }
+                for r in history
+            ],
+        })
+    except psycopg2.Error as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
 
 
 @app.route("/carbon-neutral/purchase", methods=["POST"])
+@admission.admit(admission.WRITE)
 def carbon_neutral_purchase():
     """
-    Purchase carbon credits. 1 CO2 kg = 1 carbon credit.
-    Mimics Cloverly API - in sandbox mode we simulate; with CLOVERLY_API_KEY we could call real API.
+    Queue a carbon credit purchase. 1 CO2 kg = 1 carbon credit.
+    Returns 202 immediately; the background worker buys queued credits in batches.
+    Poll /carbon-neutral/purchases/<purchase_id> for status.
     """
-    global _carbon_credits_balance, _carbon_credits_purchase_history
     try:
         data = request.get_json() or {}
         credits = float(data.get("credits", 0))
-        if credits <= 0:
-            return jsonify({"error": "Credits must be a positive number"}), 400
-        if credits > 10000:
-            return jsonify({"error": "Maximum 10,000 credits per purchase"}), 400
-
-        # Simulate Cloverly purchase (sandbox mode)
-        cloverly_key = os.environ.get("CLOVERLY_API_KEY")
-        if cloverly_key:
-            # TODO: Call Cloverly API when key is set
-            pass
-
-        _carbon_credits_balance += credits
-        record = {
-            "credits": credits,
-            "timestamp": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
-            "balance_after": round(_carbon_credits_balance, 2),
-        }
-        _carbon_credits_purchase_history.append(record)
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid credits value"}), 400
+    if not math.isfinite(credits):
+        return jsonify({"error": "Invalid credits value"}), 400
+    if credits <= 0:
+        return jsonify({"error": "Credits must be a positive number"}), 400
+    if credits > 10000:
+        return jsonify({"error": "Maximum 10,000 credits per purchase"}), 400
+
+    try:
+        worker = _get_purchase_worker()
+        conn = get_connection()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
+    try:
+        purchase_id, _ = offset_purchases.enqueue(conn, credits)
+        balance = offset_purchases.get_balance(conn)
+        worker.notify()
         return jsonify({
             "success": True,
+            "purchase_id": purchase_id,
+            "status": "pending",
             "credits_purchased": credits,
-            "new_balance": round(_carbon_credits_balance, 2),
-            "message": "Carbon credits purchased successfully (simulated)",
+            "new_balance": round(balance, 2),
+            "message": f"Purchase queued ({worker.provider.name} provider)",
+        }), 202
+    except psycopg2.Error as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
+@app.route("/carbon-neutral/purchases/<int:purchase_id>")
+@admission.admit(admission.ANALYTICS)
+def carbon_neutral_purchase_status(purchase_id):
+    """Status of a queued purchase: pending, submitted, completed or failed."""
+    try:
+        conn = get_connection()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    try:
+        row = offset_purchases.get_purchase(conn, purchase_id)
+        if not row:
+            return jsonify({"error": "Purchase not found"}), 404
+        return jsonify({
+            "purchase_id": row[0],
+            "credits": float(row[1]),
+            "status": row[2],
+            "attempts": row[3],
+            "provider_reference": row[4],
+            "error": row[5],
+            "created_at": _ts_iso_utc(row[6]),
+            "completed_at": _ts_iso_utc(row[7]),
+            "next_attempt_at": _ts_iso_utc(row[8]) if row[2] == "pending" else None,
         })
-    except (ValueError, TypeError) as e:
-        return jsonify({"error": "Invalid credits value"}), 400
+    except psycopg2.Error as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
 
 
 if __name__ == "__main__":
+    # debug=True runs the app in a reloader child (WERKZEUG_RUN_MAIN); the parent only watches files.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        _start_background_services()
     app.run(host="0.0.0.0", port=8000, debug=True)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Bytes on the wire and server CPU per response encoding.
+
+Encodes the /hotspots, /car-entries (500 rows) and /metrics payloads as JSON and
+MessagePack, each uncompressed, gzip and brotli, with the same settings as
+negotiation.encode() (bodies under COMPRESS_MIN_BYTES stay uncompressed).
+Payloads are synthetic by default, or fetched from a running server with --url.
+CPU is process time per encode (what a cache miss costs); a cache hit only looks
+up the stored variant.
+
+    python bench_encodings.py
+    python bench_encodings.py --url http://localhost:8000 --iterations 500
+"""
+import argparse
+import json
+import random
+import time
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+import negotiation
+
+PATHS = {"hotspots": "/hotspots", "car-entries": "/car-entries?limit=500", "metrics": "/metrics"}
+
+
+def synthetic_payloads(seed=0):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    entries = []
+    for i in range(500):
+        enter = now - timedelta(minutes=3 * i + rng.random())
+        minutes = rng.uniform(1, 15)
+        entries.append({
+            "numberplate": f"{rng.choice('ABCDEFGH')}{rng.choice('KLMNPRST')}{rng.randint(10, 99)} "
+                           f"{rng.choice('XYZ')}{rng.choice('UVW')}{rng.choice('ABC')}",
+            "enter_timestamp": enter.isoformat().replace("+00:00", "Z"),
+            "exit_timestamp": (enter + timedelta(minutes=minutes)).isoformat().replace("+00:00", "Z"),
+            "minutes_elapsed": round(minutes, 2),
+            "fuel_used": round(minutes * 12, 2),
+            "carbon_produced": round(minutes * 27, 2),
+        })
+    trend = {"value": 4.2, "isPositive": False}
+    return {
+        "hotspots": {"grid": [[round(rng.uniform(0, 12), 2) for _ in range(24)] for _ in range(7)]},
+        "car-entries": entries,
+        "metrics": {
+            "total_cars": 412, "avg_idle_minutes": 6.3, "total_co2_kg": 70.1, "trees_required": 3.2,
+            "sustainability_score": 71, "fuel_wasted_grams": 31140.5, "co2_per_vehicle_kg": 0.17,
+            "peak_hour": "12:00 – 13:00", "cars_in_drive_through": 3,
+            "trends": {"vehicles": trend, "co2": trend, "idle": trend},
+        },
+    }
+
+
+def fetch_payloads(url):
+    payloads = {}
+    for name, path in PATHS.items():
+        with urllib.request.urlopen(url.rstrip("/") + path, timeout=30) as resp:
+            payloads[name] = json.loads(resp.read())
+    return payloads
+
+
+def bench(payloads, iterations):
+    formats = [negotiation.JSON] + ([negotiation.MSGPACK] if negotiation.msgpack else [])
+    codings = ["identity", "gzip"] + (["br"] if negotiation.brotli else [])
+    rows = []
+    for name, payload in payloads.items():
+        # Same serialization Flask's jsonify uses outside debug mode.
+        json_body = (json.dumps(payload, separators=(",", ":")) + "\n").encode()
+        for fmt in formats:
+            for coding in codings:
+                body, content_type, content_encoding = negotiation.encode(json_body, fmt, coding)
+                start = time.process_time()
+                for _ in range(iterations):
+                    negotiation.encode(json_body, fmt, coding)
+                cpu_us = (time.process_time() - start) / iterations * 1e6
+                rows.append({
+                    "payload": name,
+                    "format": "msgpack" if fmt == negotiation.MSGPACK else "json",
+                    "served": "msgpack" if content_type == negotiation.MSGPACK else "json",
+                    "requested": coding,
+                    "encoding": content_encoding or "identity",
+                    "bytes": len(body),
+                    "ratio": round(len(body) / len(json_body), 3),
+                    "cpu_us": round(cpu_us, 1),
+                })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark response encodings.")
+    parser.add_argument("--url", help="Fetch payloads from a running API server instead of synthesizing them")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="Print raw results as JSON")
+    args = parser.parse_args()
+
+    payloads = fetch_payloads(args.url) if args.url else synthetic_payloads()
+    rows = bench(payloads, args.iterations)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    missing = [name for name, mod in (("msgpack", negotiation.msgpack), ("brotli", negotiation.brotli)) if mod is None]
+    if missing:
+        print(f"(not installed, skipped: {', '.join(missing)})")
+    print(f"{'payload':<12} {'format':<8} {'served':<8} {'requested':<10} {'encoding':<9} {'bytes':>8} "
+          f"{'ratio':>6} {'cpu_us':>9}")
+    for r in rows:
+        print(f"{r['payload']:<12} {r['format']:<8} {r['served']:<8} {r['requested']:<10} {r['encoding']:<9} "
+              f"{r['bytes']:>8} {r['ratio']:>6} {r['cpu_us']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,35 @@ except ImportError:
     print("Error: psycopg2 is required. Install with: pip install psycopg2-binary")
     sys.exit(1)
 
+from emission_factors import ensure_schema
+import plates
+import rollups
+
+
+CAR_ENTRIES_SQL = """
+CREATE TABLE car_entries (
+    entry_id SERIAL PRIMARY KEY,
+    numberplate VARCHAR(20) NOT NULL,
+    enter_timestamp TIMESTAMP,
+    exit_timestamp TIMESTAMP,
+    minutes_elapsed DECIMAL(10, 2) GENERATED ALWAYS AS (
+        CASE
+            WHEN exit_timestamp IS NOT NULL AND enter_timestamp IS NOT NULL
+            THEN ROUND((EXTRACT(EPOCH FROM (exit_timestamp - enter_timestamp)) / 60)::numeric, 2)
+            ELSE NULL
+        END
+    ) STORED,
+    fuel_used DECIMAL(10, 2),
+    carbon_produced DECIMAL(10, 2),
+    factor_version INTEGER,
+    vehicle_class VARCHAR(20) NOT NULL DEFAULT 'default',
+    site VARCHAR(50) NOT NULL DEFAULT 'default',
+    fuel_used_next DECIMAL(10, 2),
+    carbon_produced_next DECIMAL(10, 2),
+    factor_version_next INTEGER
+);
+"""
+
 
 def get_connection():
     """Create database connection using environment variables."""
@@ -71,7 +100,8 @@ def get_connection():
 
 def create_car_entries_table(conn):
     """Drop and recreate the car_entries table.
-    fuel_used and carbon_produced are auto-calculated: 12 g/min fuel, 27 g/min carbon.
+    fuel_used and carbon_produced are filled by a trigger from the active emission-factor
+    version (default 12 g/min fuel, 27 g/min carbon); see emission_factors.py.
     Both are NULL when exit_timestamp is NULL.
     """
     try:
@@ -83,40 +113,15 @@ def create_car_entries_table(conn):
         conn.rollback()
         raise
 
-    create_table_sql = """
-    CREATE TABLE car_entries (
-        entry_id SERIAL PRIMARY KEY,
-        numberplate VARCHAR(20) NOT NULL,
-        enter_timestamp TIMESTAMP,
-        exit_timestamp TIMESTAMP,
-        minutes_elapsed DECIMAL(10, 2) GENERATED ALWAYS AS (
-            CASE
-                WHEN exit_timestamp IS NOT NULL AND enter_timestamp IS NOT NULL
-                THEN ROUND((EXTRACT(EPOCH FROM (exit_timestamp - enter_timestamp)) / 60)::numeric, 2)
-                ELSE NULL
-            END
-        ) STORED,
-        fuel_used DECIMAL(10, 2) GENERATED ALWAYS AS (
-            CASE
-                WHEN exit_timestamp IS NOT NULL AND enter_timestamp IS NOT NULL
-                THEN ROUND((EXTRACT(EPOCH FROM (exit_timestamp - enter_timestamp)) / 60 * 12)::numeric, 2)
-                ELSE NULL
-            END
-        ) STORED,
-        carbon_produced DECIMAL(10, 2) GENERATED ALWAYS AS (
-            CASE
-                WHEN exit_timestamp IS NOT NULL AND enter_timestamp IS NOT NULL
-                THEN ROUND((EXTRACT(EPOCH FROM (exit_timestamp - enter_timestamp)) / 60 * 27)::numeric, 2)
-                ELSE NULL
-            END
-        ) STORED
-    );
-    """
     try:
         with conn.cursor() as cur:
-            cur.execute(create_table_sql)
+            cur.execute(CAR_ENTRIES_SQL)
             conn.commit()
-            print("Table 'car_entries' dropped and recreated successfully.")
+        ensure_schema(conn)
+        rollups.ensure_schema(conn)
+        plates.ensure_schema(conn)
+        plates.rebuild(conn)
+        print("Table 'car_entries' dropped and recreated successfully.")
     except psycopg2.Error as e:
         print(f"Error creating table: {e}")
         conn.rollback()
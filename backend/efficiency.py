@@ -0,0 +1,21 @@
+"""Efficiency score shared by the API and the simulator (no imports, no side effects)."""
+
+
+def compute_efficiency_score(total_co2_kg, avg_minutes, total_cars):
+    """
+    Efficiency 0-100: lower CO2 and idle = higher score.
+    Formula: score = 100 - co2_penalty - idle_penalty
+      co2_penalty = min(50, co2_per_vehicle_kg * 30)
+      idle_penalty = min(40, avg_minutes * 4)
+    Min score from formula is 10 (max penalties 50+40=90). Floor at 1 when we have data.
+    """
+    total_cars = float(total_cars or 0)
+    total_co2_kg = float(total_co2_kg or 0)
+    avg_minutes = float(avg_minutes or 0)
+    if total_cars == 0:
+        return 100.0
+    co2_per_vehicle = total_co2_kg / total_cars
+    co2_penalty = min(50, co2_per_vehicle * 30)
+    idle_penalty = min(40, avg_minutes * 4)
+    score = max(1, min(100, 100 - co2_penalty - idle_penalty))
+    return round(float(score), 1)
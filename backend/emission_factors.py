@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+Versioned emission-factor profiles and chunked historical recompute.
+
+fuel_used / carbon_produced are filled by a trigger from the active factor version,
+matched by vehicle class, site and effective date (falling back to 'default', then to
+the built-in 12/27 g/min when no row matches, in both live and recomputed columns).
+Changing factors means creating a new version and running a recompute job:
+
+  * the job splits car_entries into entry_id chunks; worker processes lock a chunk's
+    entries, then claim the chunk and write the new values into *_next shadow columns,
+    one short transaction per chunk (resumable: finished chunks stay done);
+  * while the job runs, the trigger also fills *_next for new exits;
+  * emission rollups for the new factors are built alongside in emission_rollups_next
+    (see rollups.py);
+  * when every chunk is done the shadow and live columns, and the two rollup tables,
+    are swapped by RENAME in one brief transaction, so dashboards never see a mix of
+    old and new factors.
+
+Usage:
+    python emission_factors.py migrate                      # upgrade an existing table
+    python emission_factors.py create-version factors.json  # [{"vehicle_class", "site",
+                                                            #   "effective_from", "fuel_g_per_min", "co2_g_per_min"}]
+    python emission_factors.py recompute VERSION [--workers 4] [--chunk-size 5000]
+    python emission_factors.py resume JOB_ID [--workers 4]
+    python emission_factors.py status [JOB_ID]
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+
+import psycopg2
+
+import rollups
+
+DEFAULT_FUEL_G_PER_MIN = 12
+DEFAULT_CO2_G_PER_MIN = 27
+DEFAULT_CHUNK_SIZE = 5000
+
+# Pairs swapped when a recompute job is published.
+_SWAPPED_COLUMNS = ("fuel_used", "carbon_produced", "factor_version")
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS emission_factor_sets (
+    version SERIAL PRIMARY KEY,
+    description TEXT,
+    status VARCHAR(16) NOT NULL DEFAULT 'draft',
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    activated_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS emission_factors (
+    version INTEGER NOT NULL REFERENCES emission_factor_sets(version),
+    vehicle_class VARCHAR(20) NOT NULL DEFAULT 'default',
+    site VARCHAR(50) NOT NULL DEFAULT 'default',
+    effective_from TIMESTAMP NOT NULL DEFAULT '1970-01-01',
+    fuel_g_per_min DECIMAL(10, 4) NOT NULL,
+    co2_g_per_min DECIMAL(10, 4) NOT NULL,
+    PRIMARY KEY (version, vehicle_class, site, effective_from)
+);
+
+CREATE TABLE IF NOT EXISTS emission_recompute_jobs (
+    job_id SERIAL PRIMARY KEY,
+    target_version INTEGER NOT NULL REFERENCES emission_factor_sets(version),
+    status VARCHAR(16) NOT NULL DEFAULT 'running',
+    chunk_size INTEGER NOT NULL,
+    total_chunks INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    published_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS emission_recompute_chunks (
+    job_id INTEGER NOT NULL REFERENCES emission_recompute_jobs(job_id),
+    chunk_no INTEGER NOT NULL,
+    start_id INTEGER NOT NULL,
+    end_id INTEGER NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    rows_updated INTEGER,
+    finished_at TIMESTAMP,
+    PRIMARY KEY (job_id, chunk_no)
+);
+
+-- True while a recompute job is running and the entry's *_next values are final for
+-- it (its chunk is done, or it is newer than every chunk), i.e. when shadow aggregates
+-- should follow the row. Share-locks the chunk so no worker finishes it meanwhile
+-- (workers lock the chunk's entries first, then the chunk row: see process_chunks).
+CREATE OR REPLACE FUNCTION emission_recompute_covers(id INTEGER) RETURNS BOOLEAN
+LANGUAGE plpgsql AS $$
+DECLARE
+    job RECORD;
+    chunk_status TEXT;
+BEGIN
+    SELECT j.job_id, j.chunk_size INTO job FROM emission_recompute_jobs j
+    WHERE j.status = 'running' ORDER BY j.job_id DESC LIMIT 1;
+    IF NOT FOUND THEN
+        RETURN FALSE;
+    END IF;
+    SELECT c.status INTO chunk_status FROM emission_recompute_chunks c
+    WHERE c.job_id = job.job_id
+      AND c.chunk_no = (id - (SELECT c0.start_id FROM emission_recompute_chunks c0
+                              WHERE c0.job_id = job.job_id AND c0.chunk_no = 0)) / job.chunk_size
+    FOR SHARE;
+    RETURN chunk_status IS NULL OR chunk_status = 'done';
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION emission_factor_for(v INTEGER, cls TEXT, st TEXT, ts TIMESTAMP)
+RETURNS TABLE (version INTEGER, fuel_g_per_min DECIMAL, co2_g_per_min DECIMAL)
+LANGUAGE sql STABLE AS $$
+    SELECT f.version, f.fuel_g_per_min, f.co2_g_per_min
+    FROM emission_factors f
+    WHERE f.version = v
+      AND f.vehicle_class IN (cls, 'default')
+      AND f.site IN (st, 'default')
+      AND f.effective_from <= ts
+    ORDER BY (f.vehicle_class = cls) DESC, (f.site = st) DESC, f.effective_from DESC
+    LIMIT 1
+$$;
+
+CREATE OR REPLACE FUNCTION car_entries_apply_emission_factors() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    minutes NUMERIC;
+    f RECORD;
+    target INTEGER;
+BEGIN
+    NEW.fuel_used := NULL;
+    NEW.carbon_produced := NULL;
+    NEW.factor_version := NULL;
+    NEW.fuel_used_next := NULL;
+    NEW.carbon_produced_next := NULL;
+    NEW.factor_version_next := NULL;
+    IF NEW.exit_timestamp IS NULL OR NEW.enter_timestamp IS NULL THEN
+        RETURN NEW;
+    END IF;
+    minutes := (EXTRACT(EPOCH FROM (NEW.exit_timestamp - NEW.enter_timestamp)) / 60)::numeric;
+
+    SELECT * INTO f FROM emission_factor_for(
+        (SELECT s.version FROM emission_factor_sets s WHERE s.status = 'active'),
+        NEW.vehicle_class, NEW.site, NEW.enter_timestamp);
+    NEW.fuel_used := ROUND(minutes * COALESCE(f.fuel_g_per_min, %(fuel)s), 2);
+    NEW.carbon_produced := ROUND(minutes * COALESCE(f.co2_g_per_min, %(co2)s), 2);
+    NEW.factor_version := f.version;
+
+    SELECT j.target_version INTO target FROM emission_recompute_jobs j
+    WHERE j.status = 'running' ORDER BY j.job_id DESC LIMIT 1;
+    IF target IS NOT NULL THEN
+        SELECT * INTO f FROM emission_factor_for(target, NEW.vehicle_class, NEW.site, NEW.enter_timestamp);
+        NEW.fuel_used_next := ROUND(minutes * COALESCE(f.fuel_g_per_min, %(fuel)s), 2);
+        NEW.carbon_produced_next := ROUND(minutes * COALESCE(f.co2_g_per_min, %(co2)s), 2);
+        NEW.factor_version_next := f.version;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS car_entries_emission_factors ON car_entries;
+CREATE TRIGGER car_entries_emission_factors
+    BEFORE INSERT OR UPDATE OF enter_timestamp, exit_timestamp, vehicle_class, site ON car_entries
+    FOR EACH ROW EXECUTE FUNCTION car_entries_apply_emission_factors();
+"""
+
+# Same fallback as the trigger: no matching factor row means the default rates.
+_CHUNK_UPDATE_SQL = f"""
+    UPDATE car_entries c
+    SET (fuel_used_next, carbon_produced_next, factor_version_next) = (
+        SELECT
+            ROUND((EXTRACT(EPOCH FROM (c.exit_timestamp - c.enter_timestamp)) / 60)::numeric
+                  * COALESCE(f.fuel_g_per_min, {DEFAULT_FUEL_G_PER_MIN}), 2),
+            ROUND((EXTRACT(EPOCH FROM (c.exit_timestamp - c.enter_timestamp)) / 60)::numeric
+                  * COALESCE(f.co2_g_per_min, {DEFAULT_CO2_G_PER_MIN}), 2),
+            f.version
+        FROM (SELECT 1) one
+        LEFT JOIN LATERAL emission_factor_for(%s, c.vehicle_class, c.site, c.enter_timestamp) f ON TRUE
+    )
+    WHERE c.entry_id BETWEEN %s AND %s
+      AND c.exit_timestamp IS NOT NULL
+      AND c.enter_timestamp IS NOT NULL
+"""
+
+
+def ensure_schema(conn):
+    """Create factor/job tables, the lookup function and the car_entries trigger; seed version 1."""
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL % {"fuel": DEFAULT_FUEL_G_PER_MIN, "co2": DEFAULT_CO2_G_PER_MIN})
+        cur.execute("SELECT COUNT(*) FROM emission_factor_sets")
+        if cur.fetchone()[0] == 0:
+            cur.execute("""
+                INSERT INTO emission_factor_sets (description, status, activated_at)
+                VALUES ('Default idling factors', 'active', NOW())
+                RETURNING version
+            """)
+            version = cur.fetchone()[0]
+            cur.execute(
+                "INSERT INTO emission_factors (version, fuel_g_per_min, co2_g_per_min) VALUES (%s, %s, %s)",
+                (version, DEFAULT_FUEL_G_PER_MIN, DEFAULT_CO2_G_PER_MIN),
+            )
+    conn.commit()
+
+
+def migrate(conn):
+    """
+    Upgrade a car_entries table with GENERATED fuel/carbon columns. DROP EXPRESSION and
+    ADD COLUMN with a constant default are catalog-only changes, so no table rewrite.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SET lock_timeout = '5s'")
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = 'car_entries' AND is_generated = 'ALWAYS'
+              AND column_name IN ('fuel_used', 'carbon_produced')
+        """)
+        for (column,) in cur.fetchall():
+            cur.execute(f"ALTER TABLE car_entries ALTER COLUMN {column} DROP EXPRESSION")
+        cur.execute("""
+            ALTER TABLE car_entries
+                ADD COLUMN IF NOT EXISTS vehicle_class VARCHAR(20) NOT NULL DEFAULT 'default',
+                ADD COLUMN IF NOT EXISTS site VARCHAR(50) NOT NULL DEFAULT 'default',
+                ADD COLUMN IF NOT EXISTS factor_version INTEGER,
+                ADD COLUMN IF NOT EXISTS fuel_used_next DECIMAL(10, 2),
+                ADD COLUMN IF NOT EXISTS carbon_produced_next DECIMAL(10, 2),
+                ADD COLUMN IF NOT EXISTS factor_version_next INTEGER
+        """)
+    conn.commit()
+    ensure_schema(conn)
+
+
+def get_active_version(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT version FROM emission_factor_sets WHERE status = 'active'")
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def list_factors(conn, version=None):
+    """Factor rows for a version (default: active)."""
+    version = version or get_active_version(conn)
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT vehicle_class, site, effective_from, fuel_g_per_min, co2_g_per_min
+            FROM emission_factors WHERE version = %s
+            ORDER BY vehicle_class, site, effective_from
+        """, (version,))
+        rows = cur.fetchall()
+    return {
+        "version": version,
+        "factors": [
+            {
+                "vehicle_class": r[0],
+                "site": r[1],
+                "effective_from": r[2].isoformat(),
+                "fuel_g_per_min": float(r[3]),
+                "co2_g_per_min": float(r[4]),
+            }
+            for r in rows
+        ],
+    }
+
+
+def create_version(conn, factors, description=None):
+    """Create a draft factor version. Must include a default/default row. Returns version."""
+    if not any(f.get("vehicle_class", "default") == "default" and f.get("site", "default") == "default"
+               for f in factors):
+        raise ValueError("A factor version needs a vehicle_class='default', site='default' row")
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO emission_factor_sets (description) VALUES (%s) RETURNING version", (description,)
+        )
+        version = cur.fetchone()[0]
+        cur.executemany("""
+            INSERT INTO emission_factors
+                (version, vehicle_class, site, effective_from, fuel_g_per_min, co2_g_per_min)
+            VALUES (%s, %s, %s, COALESCE(%s::timestamp, '1970-01-01'), %s, %s)
+        """, [
+            (version, f.get("vehicle_class", "default"), f.get("site", "default"), f.get("effective_from"),
+             float(f["fuel_g_per_min"]), float(f["co2_g_per_min"]))
+            for f in factors
+        ])
+    conn.commit()
+    return version
+
+
+def start_job(conn, target_version, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Create a recompute job and its entry_id chunks. Returns job_id."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM emission_recompute_jobs WHERE status = 'running'")
+        if cur.fetchone():
+            raise ValueError("Another recompute job is already running")
+        rollups.reset_shadow(conn)
+        cur.execute("SELECT COALESCE(MIN(entry_id), 1), COALESCE(MAX(entry_id), 0) FROM car_entries")
+        min_id, max_id = cur.fetchone()
+        cur.execute(
+            "INSERT INTO emission_recompute_jobs (target_version, chunk_size) VALUES (%s, %s) RETURNING job_id",
+            (target_version, chunk_size),
+        )
+        job_id = cur.fetchone()[0]
+        cur.execute("""
+            INSERT INTO emission_recompute_chunks (job_id, chunk_no, start_id, end_id)
+            SELECT %s, n, %s + n * %s, %s + (n + 1) * %s - 1
+            FROM generate_series(0, GREATEST(0, (%s - %s) / %s)) AS n
+        """, (job_id, min_id, chunk_size, min_id, chunk_size, max_id, min_id, chunk_size))
+        cur.execute(
+            "UPDATE emission_recompute_jobs SET total_chunks = %s WHERE job_id = %s",
+            (cur.rowcount, job_id),
+        )
+    conn.commit()
+    return job_id
+
+
+def process_chunks(conn, job_id):
+    """
+    Claim and recompute pending chunks until none are left. Returns chunks processed.
+
+    A chunk's car_entries rows are locked before its chunk row, the same order as an
+    exit, whose rollup trigger share-locks the chunk row while holding its entry.
+    Workers pick different chunks with a transaction-scoped advisory lock.
+    """
+    processed = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL lock_timeout = '2s'")
+            cur.execute("""
+                SELECT c.chunk_no, c.start_id, c.end_id, j.target_version
+                FROM emission_recompute_chunks c
+                JOIN emission_recompute_jobs j USING (job_id)
+                WHERE c.job_id = %s AND c.status = 'pending' AND j.status = 'running'
+                ORDER BY c.chunk_no
+            """, (job_id,))
+            pending = cur.fetchall()
+            if not pending:
+                conn.rollback()
+                return processed
+            for chunk_no, start_id, end_id, version in pending:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (job_id, chunk_no))
+                if cur.fetchone()[0]:
+                    break
+            else:
+                conn.rollback()  # Every pending chunk is being processed by another worker.
+                time.sleep(0.5)
+                continue
+            try:
+                cur.execute("SELECT 1 FROM car_entries WHERE entry_id BETWEEN %s AND %s FOR UPDATE",
+                            (start_id, end_id))
+                cur.execute(
+                    "SELECT status FROM emission_recompute_chunks WHERE job_id = %s AND chunk_no = %s FOR UPDATE",
+                    (job_id, chunk_no),
+                )
+                if cur.fetchone()[0] != "pending":
+                    conn.rollback()  # Finished by another worker since the list above was read.
+                    continue
+                cur.execute(_CHUNK_UPDATE_SQL, (version, start_id, end_id))
+                rows = cur.rowcount
+                rollups.add_to_shadow(conn, start_id, end_id)
+                cur.execute("""
+                    UPDATE emission_recompute_chunks
+                    SET status = 'done', rows_updated = %s, finished_at = NOW()
+                    WHERE job_id = %s AND chunk_no = %s
+                """, (rows, job_id, chunk_no))
+                conn.commit()
+                processed += 1
+            except psycopg2.errors.LockNotAvailable:
+                conn.rollback()
+                time.sleep(0.5)
+
+
+def publish(conn, job_id):
+    """
+    Swap *_next into the live columns and the shadow rollups into place, and activate
+    the target version, if every chunk is done. Returns True when published; False if unfinished or the table was busy.
+    """
+    try:
+        return _publish(conn, job_id)
+    except psycopg2.errors.LockNotAvailable:
+        conn.rollback()
+        return False
+
+
+def _publish(conn, job_id):
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = '5s'")
+        cur.execute(
+            "SELECT status, target_version FROM emission_recompute_jobs WHERE job_id = %s FOR UPDATE", (job_id,)
+        )
+        row = cur.fetchone()
+        if not row or row[0] != "running":
+            conn.rollback()
+            return False
+        cur.execute(
+            "SELECT COUNT(*) FROM emission_recompute_chunks WHERE job_id = %s AND status <> 'done'", (job_id,)
+        )
+        if cur.fetchone()[0]:
+            conn.rollback()
+            return False
+        for column in _SWAPPED_COLUMNS:
+            cur.execute(f"ALTER TABLE car_entries RENAME COLUMN {column} TO {column}_swap")
+            cur.execute(f"ALTER TABLE car_entries RENAME COLUMN {column}_next TO {column}")
+            cur.execute(f"ALTER TABLE car_entries RENAME COLUMN {column}_swap TO {column}_next")
+        rollups.swap_shadow(conn)
+        cur.execute("UPDATE emission_factor_sets SET status = 'superseded' WHERE status = 'active'")
+        cur.execute(
+            "UPDATE emission_factor_sets SET status = 'active', activated_at = NOW() WHERE version = %s", (row[1],)
+        )
+        cur.execute(
+            "UPDATE emission_recompute_jobs SET status = 'done', published_at = NOW() WHERE job_id = %s", (job_id,)
+        )
+    conn.commit()
+    return True
+
+
+def job_status(conn, job_id=None):
+    """Progress of a job (default: most recent)."""
+    with conn.cursor() as cur:
+        if job_id is None:
+            cur.execute("SELECT MAX(job_id) FROM emission_recompute_jobs")
+            job_id = cur.fetchone()[0]
+            if job_id is None:
+                return None
+        cur.execute("""
+            SELECT j.job_id, j.target_version, j.status, j.total_chunks,
+                   COUNT(*) FILTER (WHERE c.status = 'done'),
+                   COALESCE(SUM(c.rows_updated), 0), j.created_at, j.published_at
+            FROM emission_recompute_jobs j
+            LEFT JOIN emission_recompute_chunks c USING (job_id)
+            WHERE j.job_id = %s
+            GROUP BY j.job_id
+        """, (job_id,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        "job_id": row[0],
+        "target_version": row[1],
+        "status": row[2],
+        "total_chunks": row[3],
+        "done_chunks": row[4],
+        "progress": round(row[4] / row[3], 4) if row[3] else 1.0,
+        "rows_updated": row[5],
+        "created_at": row[6].isoformat() if row[6] else None,
+        "published_at": row[7].isoformat() if row[7] else None,
+    }
+
+
+def _worker(job_id):
+    from db import get_connection
+
+    conn = get_connection()
+    try:
+        return process_chunks(conn, job_id)
+    finally:
+        conn.close()
+
+
+def run_job(job_id, workers=4):
+    """Process a job across worker processes, printing progress, then publish it."""
+    from db import get_connection
+
+    with multiprocessing.Pool(workers) as pool:
+        pending = pool.map_async(_worker, [job_id] * workers)
+        conn = get_connection()
+        try:
+            while not pending.ready():
+                status = job_status(conn, job_id)
+                conn.rollback()
+                print(f"job {job_id}: {status['done_chunks']}/{status['total_chunks']} chunks, "
+                      f"{status['rows_updated']} rows")
+                pending.wait(2)
+            pending.get()
+            published = publish(conn, job_id)
+            print(f"job {job_id}: {'published' if published else 'not published'}")
+            if published:
+                import plates
+
+                print(f"Recomputed CO2 for {plates.recompute_co2(conn)} plates.")
+        finally:
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emission-factor versions and historical recompute.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate")
+    create = sub.add_parser("create-version")
+    create.add_argument("path")
+    create.add_argument("--description")
+    recompute = sub.add_parser("recompute")
+    recompute.add_argument("version", type=int)
+    recompute.add_argument("--workers", type=int, default=4)
+    recompute.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    resume = sub.add_parser("resume")
+    resume.add_argument("job_id", type=int)
+    resume.add_argument("--workers", type=int, default=4)
+    status = sub.add_parser("status")
+    status.add_argument("job_id", type=int, nargs="?")
+    args = parser.parse_args()
+
+    from db import get_connection
+
+    conn = get_connection()
+    try:
+        if args.command == "migrate":
+            migrate(conn)
+            print("car_entries migrated to versioned emission factors.")
+        elif args.command == "create-version":
+            with open(args.path) as fh:
+                factors = json.load(fh)
+            print(f"Created draft version {create_version(conn, factors, args.description)}")
+        elif args.command == "recompute":
+            job_id = start_job(conn, args.version, args.chunk_size)
+            print(f"Started job {job_id}")
+            run_job(job_id, args.workers)
+        elif args.command == "resume":
+            run_job(args.job_id, args.workers)
+        else:
+            print(json.dumps(job_status(conn, args.job_id), indent=2))
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
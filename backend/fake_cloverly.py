@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Cloverly purchase API, for exercising the offset queue.
+
+    python fake_cloverly.py --port 8787 --latency 2 --failure-rate 0.3
+    CLOVERLY_API_KEY=test CLOVERLY_API_URL=http://localhost:8787 python app.py
+
+Every accepted purchase is kept in memory and listed at GET /2021-10/purchases.
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeCloverlyHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    failure_rate = 0.0
+    purchases = []
+    by_idempotency_key = {}
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/2021-10/purchases":
+            return self._send(200, self.purchases)
+        self._send(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/2021-10/purchases/carbon":
+            return self._send(404, {"error": "Not found"})
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            return self._send(401, {"error": "Missing API key"})
+        length = int(self.headers.get("Content-Length") or 0)
+        data = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            return self._send(503, {"error": "Simulated provider failure"})
+
+        key = self.headers.get("Idempotency-Key")
+        if key and key in self.by_idempotency_key:
+            return self._send(200, self.by_idempotency_key[key])
+        purchase = {
+            "slug": uuid.uuid4().hex[:12],
+            "state": "completed",
+            "weight": data.get("weight"),
+            "metadata": data.get("metadata"),
+            "total_cost_in_usd_cents": round(float(data.get("weight", {}).get("value", 0)) * 2),
+        }
+        self.purchases.append(purchase)
+        if key:
+            self.by_idempotency_key[key] = purchase
+        self._send(200, purchase)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Cloverly API server.")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait per purchase")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of purchases that return 503")
+    args = parser.parse_args()
+    FakeCloverlyHandler.latency = args.latency
+    FakeCloverlyHandler.failure_rate = args.failure_rate
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeCloverlyHandler)
+    print(f"Fake Cloverly listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Local webhook receiver for stall alerts.
+
+    python fake_webhook.py --port 8788
+    STALL_THRESHOLD_MINUTES=0.5 STALL_WEBHOOK_URL=http://localhost:8788/stalls python app.py
+
+Each POSTed alert is printed with its delivery lag (receive time minus the alert's
+deadline) and kept in memory; GET /stalls lists them.
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeWebhookHandler(BaseHTTPRequestHandler):
+    received = []
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stalls":
+            return self._send(200, self.received)
+        self._send(404, {"error": "Not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        alert = json.loads(self.rfile.read(length) or b"{}")
+        self.received.append(alert)
+        lag = f"{(time.time() - alert['deadline']) * 1000:.0f} ms after deadline" if alert.get("event") == "stalled" else ""
+        print(f"{alert.get('event')}: {alert.get('numberplate')} (entry {alert.get('entry_id')}) {lag}", flush=True)
+        self._send(200, {"ok": True})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake stall-alert webhook receiver.")
+    parser.add_argument("--port", type=int, default=8788)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeWebhookHandler)
+    print(f"Fake webhook listening on http://127.0.0.1:{args.port}/stalls")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Online next-hour forecast of cars, idle minutes and CO2.
+
+Keeps additive Holt-Winters state (a level plus one seasonal term per hour of the
+week) for each series. Enter/exit events add to the current hour's totals in O(1);
+when an hour closes its totals are folded into the model, so there are no
+periodic refits. State is persisted to JSON so restarts only replay events since
+the last one seen.
+
+Cars are counted at entry; idle minutes and CO2 at exit.
+
+Usage:
+    python forecast.py --backtest     # replay history, report error and interval coverage
+    python forecast.py --rebuild      # rebuild persisted state from the full history
+"""
+import argparse
+import json
+import math
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+SERIES = ("cars", "idle_minutes", "co2_kg")
+DEFAULT_STATE_PATH = Path(__file__).resolve().parent / "forecast_state.json"
+
+_HOUR = 3600
+_Z95 = 1.96
+
+
+def _epoch(dt):
+    """Naive DB timestamps are UTC; convert to float epoch seconds."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+class HourOfWeekForecaster:
+    """
+    Additive Holt-Winters with a 168-hour season, updated once per closed hour.
+    alpha smooths the level, gamma the seasonal terms, beta the residual variance
+    used for prediction intervals.
+    """
+
+    def __init__(self, tz="America/Los_Angeles", alpha=0.1, gamma=0.3, beta=0.1):
+        self.tz = tz
+        self.alpha = alpha
+        self.gamma = gamma
+        self.beta = beta
+        self._zone = ZoneInfo(tz)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.level = {name: 0.0 for name in SERIES}
+        self.season = {name: [0.0] * 168 for name in SERIES}
+        self.variance = {name: 0.0 for name in SERIES}
+        self.hours_seen = 0
+        self.current_hour = None  # UTC epoch hour being accumulated
+        self.current = {name: 0.0 for name in SERIES}
+        self.last_enter = 0.0
+        self.last_exit = 0.0
+
+    def hour_of_week(self, epoch_hour):
+        local = datetime.fromtimestamp(epoch_hour * _HOUR, self._zone)
+        return local.weekday() * 24 + local.hour
+
+    # --- Updates ---
+
+    def _fold(self, totals, epoch_hour):
+        """Fold one closed hour into level, season and residual variance."""
+        slot = self.hour_of_week(epoch_hour)
+        for name in SERIES:
+            y = totals[name]
+            level, season = self.level[name], self.season[name][slot]
+            if self.hours_seen:
+                residual = y - max(0.0, level + season)
+                self.variance[name] = self.beta * residual ** 2 + (1 - self.beta) * self.variance[name]
+            self.level[name] = self.alpha * (y - season) + (1 - self.alpha) * level
+            self.season[name][slot] = self.gamma * (y - self.level[name]) + (1 - self.gamma) * season
+        self.hours_seen += 1
+
+    def _advance(self, epoch_hour):
+        """Close every hour before epoch_hour (empty hours fold in as zeros)."""
+        if self.current_hour is None:
+            self.current_hour = epoch_hour
+            return False
+        rolled = False
+        while self.current_hour < epoch_hour:
+            self._fold(self.current, self.current_hour)
+            self.current = {name: 0.0 for name in SERIES}
+            self.current_hour += 1
+            rolled = True
+        return rolled
+
+    def observe_enter(self, ts):
+        """Record a car entering at epoch seconds ts. Returns True if an hour closed."""
+        with self._lock:
+            rolled = self._advance(int(ts // _HOUR))
+            self.current["cars"] += 1
+            self.last_enter = max(self.last_enter, ts)
+            return rolled
+
+    def observe_exit(self, ts, minutes_elapsed, carbon_grams):
+        """Record a car leaving at epoch seconds ts. Returns True if an hour closed."""
+        with self._lock:
+            rolled = self._advance(int(ts // _HOUR))
+            self.current["idle_minutes"] += float(minutes_elapsed or 0)
+            self.current["co2_kg"] += float(carbon_grams or 0) / 1000.0
+            self.last_exit = max(self.last_exit, ts)
+            return rolled
+
+    def advance_to(self, ts):
+        with self._lock:
+            return self._advance(int(ts // _HOUR))
+
+    # --- Forecast ---
+
+    def predict(self, epoch_hour):
+        """Point forecast and 95% interval for each series at the given UTC epoch hour."""
+        slot = self.hour_of_week(epoch_hour)
+        out = {}
+        for name in SERIES:
+            point = max(0.0, self.level[name] + self.season[name][slot])
+            spread = _Z95 * math.sqrt(self.variance[name])
+            out[name] = {
+                "predicted": round(point, 2),
+                "lower": round(max(0.0, point - spread), 2),
+                "upper": round(point + spread, 2),
+            }
+        return out
+
+    def forecast_next_hour(self, now=None):
+        """Forecast for the hour after the current one, as served by /forecast."""
+        now = datetime.now(timezone.utc).timestamp() if now is None else now
+        with self._lock:
+            self._advance(int(now // _HOUR))
+            next_hour = self.current_hour + 1
+            result = self.predict(next_hour)
+        start = datetime.fromtimestamp(next_hour * _HOUR, timezone.utc)
+        return {
+            "hour_start": start.isoformat().replace("+00:00", "Z"),
+            "hours_observed": self.hours_seen,
+            **result,
+        }
+
+    # --- Persistence ---
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "tz": self.tz, "alpha": self.alpha, "gamma": self.gamma, "beta": self.beta,
+                "level": self.level, "season": self.season, "variance": self.variance,
+                "hours_seen": self.hours_seen, "current_hour": self.current_hour, "current": self.current,
+                "last_enter": self.last_enter, "last_exit": self.last_exit,
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        model = cls(tz=data["tz"], alpha=data["alpha"], gamma=data["gamma"], beta=data["beta"])
+        for key in ("level", "season", "variance", "hours_seen", "current_hour", "current", "last_enter", "last_exit"):
+            setattr(model, key, data[key])
+        return model
+
+    def save(self, path=DEFAULT_STATE_PATH):
+        """Atomically replace the state file (concurrent saves land in snapshot order)."""
+        path = Path(path)
+        with self._save_lock:
+            data = json.dumps(self.to_dict())
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as fh:
+                    fh.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+
+    @classmethod
+    def load(cls, path=DEFAULT_STATE_PATH, tz="America/Los_Angeles"):
+        path = Path(path)
+        if path.exists():
+            return cls.from_dict(json.loads(path.read_text()))
+        return cls(tz=tz)
+
+    # --- Replay from the database ---
+
+    def catch_up(self, conn):
+        """Replay enter/exit events newer than the last ones seen. Returns events applied."""
+        events = _fetch_events(conn, self.last_enter, self.last_exit)
+        for ts, kind, minutes, carbon in events:
+            if kind == "enter":
+                self.observe_enter(ts)
+            else:
+                self.observe_exit(ts, minutes, carbon)
+        return len(events)
+
+
+def _fetch_events(conn, after_enter=0.0, after_exit=0.0):
+    """Enter and exit events strictly after the given epoch times, in time order."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT enter_timestamp FROM car_entries
+            WHERE enter_timestamp > TO_TIMESTAMP(%s) AT TIME ZONE 'UTC'
+        """, (after_enter,))
+        events = [(_epoch(r[0]), "enter", None, None) for r in cur.fetchall()]
+        cur.execute("""
+            SELECT exit_timestamp, minutes_elapsed, carbon_produced FROM car_entries
+            WHERE exit_timestamp > TO_TIMESTAMP(%s) AT TIME ZONE 'UTC'
+        """, (after_exit,))
+        events += [(_epoch(r[0]), "exit", r[1], r[2]) for r in cur.fetchall()]
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def backtest(conn, tz="America/Los_Angeles", warmup_hours=168, **params):
+    """
+    Replay history hour by hour, forecasting each hour before observing it.
+    Returns MAE, RMSE and 95% interval coverage per series after warmup_hours.
+    """
+    model = HourOfWeekForecaster(tz=tz, **params)
+    errors = {name: [] for name in SERIES}
+    covered = {name: 0 for name in SERIES}
+    events = _fetch_events(conn)
+    if not events:
+        return {"hours_evaluated": 0}
+
+    def score_current():
+        if model.hours_seen < warmup_hours:
+            return
+        predicted = model.predict(model.current_hour)
+        for name in SERIES:
+            actual = model.current[name]
+            errors[name].append(actual - predicted[name]["predicted"])
+            covered[name] += predicted[name]["lower"] <= actual <= predicted[name]["upper"]
+
+    for ts, kind, minutes, carbon in events:
+        hour = int(ts // _HOUR)
+        while model.current_hour is not None and model.current_hour < hour:
+            score_current()
+            model.advance_to((model.current_hour + 1) * _HOUR)
+        if kind == "enter":
+            model.observe_enter(ts)
+        else:
+            model.observe_exit(ts, minutes, carbon)
+
+    evaluated = len(errors["cars"])
+    report = {"hours_evaluated": evaluated}
+    for name in SERIES:
+        e = errors[name]
+        report[name] = {
+            "mae": round(sum(abs(x) for x in e) / evaluated, 3) if evaluated else None,
+            "rmse": round(math.sqrt(sum(x * x for x in e) / evaluated), 3) if evaluated else None,
+            "coverage_95": round(covered[name] / evaluated, 3) if evaluated else None,
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hour-of-week forecaster: backtest or rebuild persisted state.")
+    parser.add_argument("--backtest", action="store_true")
+    parser.add_argument("--rebuild", action="store_true")
+    parser.add_argument("--tz", default=os.environ.get("FORECAST_TZ", "America/Los_Angeles"))
+    parser.add_argument("--warmup-hours", type=int, default=168)
+    parser.add_argument("--state", default=os.environ.get("FORECAST_STATE_PATH", DEFAULT_STATE_PATH))
+    args = parser.parse_args()
+    if not (args.backtest or args.rebuild):
+        parser.print_help()
+        return
+
+    from db import get_connection
+
+    conn = get_connection()
+    try:
+        if args.backtest:
+            print(json.dumps(backtest(conn, tz=args.tz, warmup_hours=args.warmup_hours), indent=2))
+        if args.rebuild:
+            model = HourOfWeekForecaster(tz=args.tz)
+            applied = model.catch_up(conn)
+            model.save(args.state)
+            print(f"Rebuilt forecast state from {applied} events ({model.hours_seen} hours) -> {args.state}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+Write-behind ingest: local append-only log plus background batch flush to Postgres.
+
+Enter/exit events are appended to a JSON-lines log and acknowledged immediately. A
+flusher thread applies pending events to car_entries in log order (so exits keep
+FIFO semantics) in one transaction per batch, together with the last applied
+sequence number in ingest_wal_checkpoints. Because that checkpoint commits
+atomically with the rows, replay after a crash or DB outage never applies an event
+twice. On startup every event after the local checkpoint is replayed.
+
+An event Postgres rejects as bad data (e.g. a value too long for its column) would
+otherwise fail its batch forever. It is moved to a .quarantine file next to the
+log and skipped, so later events keep flowing.
+
+Enable in app.py with INGEST_MODE=write_behind. INGEST_WAL_PATH sets the log file;
+INGEST_WAL_FSYNC=1 fsyncs every append (default: flush to the OS only).
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import psycopg2
+
+DEFAULT_WAL_PATH = Path(__file__).resolve().parent / "ingest.wal"
+FLUSH_INTERVAL_SECONDS = 0.2
+MAX_BATCH = 500
+MAX_RETRY_SECONDS = 30
+COMPACT_BYTES = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS ingest_wal_checkpoints (
+    wal_id VARCHAR(32) PRIMARY KEY,
+    last_seq BIGINT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+"""
+
+
+def is_bad_event_error(error):
+    """
+    True when an error is caused by the event's values, not by the database: invalid or
+    oversized data (DataError), or a value psycopg2 cannot adapt (ProgrammingError raised
+    client-side, without a SQLSTATE). Server-side ProgrammingErrors such as a missing
+    column are schema problems and are retried like any outage.
+    """
+    if isinstance(error, psycopg2.DataError):
+        return True
+    return isinstance(error, psycopg2.ProgrammingError) and error.pgcode is None
+
+
+class WriteBehindIngest:
+    """
+    Append-only event log with a background flusher. on_applied(kind, row) is called
+    after each batch commits, with the same row shape the synchronous routes return.
+    """
+
+    def __init__(self, connect, path=DEFAULT_WAL_PATH, fsync=False, on_applied=None):
+        self._connect = connect
+        self.path = Path(path)
+        self.checkpoint_path = self.path.with_suffix(self.path.suffix + ".checkpoint")
+        self.quarantine_path = self.path.with_suffix(self.path.suffix + ".quarantine")
+        self.fsync = fsync
+        self.on_applied = on_applied
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = []
+        self._seq = 0
+        self.flushed_seq = 0
+        self.wal_id = None
+        self._open()
+        self._thread = threading.Thread(target=self._run, name="ingest-flusher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    # --- Log ---
+
+    def _open(self):
+        """
+        Load the log, queue events after the local checkpoint, and open for append. A torn
+        final write (no trailing newline) was never acknowledged; it is truncated away so
+        the next append starts on a fresh line.
+        """
+        if self.checkpoint_path.exists():
+            self.flushed_seq = int(self.checkpoint_path.read_text().strip() or 0)
+        if self.path.exists():
+            valid_end = 0
+            with open(self.path, "rb") as fh:
+                for line in fh:
+                    if not line.endswith(b"\n"):
+                        break
+                    valid_end += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.error("Skipping corrupt ingest log line at byte %d", valid_end - len(line))
+                        continue
+                    if "wal_id" in record:
+                        self.wal_id = record["wal_id"]
+                        self._seq = max(self._seq, record.get("seq", 0))
+                        continue
+                    self._seq = max(self._seq, record["seq"])
+                    if record["seq"] > self.flushed_seq:
+                        self._pending.append(record)
+            torn = self.path.stat().st_size - valid_end
+            if torn:
+                logger.warning("Truncating %d bytes of torn write from the ingest log", torn)
+                with open(self.path, "r+b") as fh:
+                    fh.truncate(valid_end)
+                    os.fsync(fh.fileno())
+        if self.wal_id is None:
+            self.wal_id = uuid.uuid4().hex
+            self._write_header()
+        self._fh = open(self.path, "a")
+        if self._pending:
+            logger.info("Replaying %d unflushed ingest events", len(self._pending))
+
+    def _write_header(self):
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp.write_text(json.dumps({"wal_id": self.wal_id, "seq": self._seq}) + "\n")
+        os.replace(tmp, self.path)
+
+    def append(self, kind, **fields):
+        """Durably log an event and queue it for flushing. Returns the logged record."""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            self._seq += 1
+            record = {"seq": self._seq, "kind": kind, "ts": now.isoformat(), **fields}
+            self._fh.write(json.dumps(record) + "\n")
+            self._fh.flush()
+            if self.fsync:
+                os.fsync(self._fh.fileno())
+            self._pending.append(record)
+        self._wake.set()
+        return record
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+    def backlog(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _checkpoint(self, seq):
+        """Record seq as flushed locally; compact the log once it is fully drained."""
+        with self._lock:
+            self.flushed_seq = seq
+            tmp = self.checkpoint_path.with_suffix(".tmp")
+            tmp.write_text(str(seq))
+            os.replace(tmp, self.checkpoint_path)
+            if not self._pending and self._fh.tell() > COMPACT_BYTES:
+                self._fh.close()
+                self._write_header()
+                self._fh = open(self.path, "a")
+
+    # --- Flush ---
+
+    def _apply(self, conn, batch, isolate=False):
+        """
+        Apply a batch in one transaction. Returns (last_seq, applied rows). With isolate,
+        each event runs under a savepoint and bad-data events are quarantined.
+        """
+        applied = []
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO ingest_wal_checkpoints (wal_id, last_seq) VALUES (%s, 0)
+                ON CONFLICT (wal_id) DO NOTHING
+                """,
+                (self.wal_id,),
+            )
+            cur.execute(
+                "SELECT last_seq FROM ingest_wal_checkpoints WHERE wal_id = %s FOR UPDATE", (self.wal_id,)
+            )
+            db_seq = cur.fetchone()[0]
+            for event in batch:
+                if event["seq"] <= db_seq:
+                    continue  # Committed before a crash, local checkpoint lagged.
+                if isolate:
+                    cur.execute("SAVEPOINT ingest_event")
+                try:
+                    row = self._apply_event(cur, event)
+                except (psycopg2.DataError, psycopg2.ProgrammingError) as e:
+                    if not (isolate and is_bad_event_error(e)):
+                        raise
+                    cur.execute("ROLLBACK TO SAVEPOINT ingest_event")
+                    self._quarantine(event, e)
+                    continue
+                if isolate:
+                    cur.execute("RELEASE SAVEPOINT ingest_event")
+                if row:
+                    applied.append((event["kind"], row))
+                else:
+                    logger.warning("Dropped ingest exit seq=%s: no car in drive-through", event["seq"])
+            last_seq = batch[-1]["seq"]
+            cur.execute(
+                "UPDATE ingest_wal_checkpoints SET last_seq = GREATEST(last_seq, %s), updated_at = NOW() "
+                "WHERE wal_id = %s",
+                (last_seq, self.wal_id),
+            )
+        conn.commit()
+        return last_seq, applied
+
+    def _apply_event(self, cur, event):
+        ts = datetime.fromisoformat(event["ts"]).astimezone(timezone.utc).replace(tzinfo=None)
+        if event["kind"] == "enter":
+            cur.execute(
+                """
+                INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp, vehicle_class, site)
+                VALUES (%s, %s, NULL, %s, %s)
+                RETURNING entry_id, numberplate, enter_timestamp
+                """,
+                (event["numberplate"], ts, event.get("vehicle_class") or "default",
+                 event.get("site") or "default"),
+            )
+        else:
+            cur.execute(
+                """
+                UPDATE car_entries
+                SET exit_timestamp = %s
+                WHERE entry_id = (
+                    SELECT entry_id FROM car_entries
+                    WHERE exit_timestamp IS NULL
+                    ORDER BY enter_timestamp ASC
+                    LIMIT 1
+                )
+                RETURNING entry_id, numberplate, enter_timestamp, exit_timestamp,
+                          minutes_elapsed, carbon_produced
+                """,
+                (ts,),
+            )
+        return cur.fetchone()
+
+    def _quarantine(self, event, error):
+        """Set a rejected event aside (before its batch commits, so it is never lost)."""
+        logger.error("Quarantined ingest event seq=%s: %s", event["seq"], error)
+        with open(self.quarantine_path, "a") as fh:
+            fh.write(json.dumps({**event, "error": str(error).strip()}) + "\n")
+
+    def flush_once(self, conn):
+        """Flush up to MAX_BATCH pending events. Returns number flushed."""
+        with self._lock:
+            batch = self._pending[:MAX_BATCH]
+        if not batch:
+            return 0
+        try:
+            last_seq, applied = self._apply(conn, batch)
+        except (psycopg2.DataError, psycopg2.ProgrammingError) as e:
+            if not is_bad_event_error(e):
+                raise
+            # Some event in the batch is bad data: redo it event by event to find it.
+            conn.rollback()
+            last_seq, applied = self._apply(conn, batch, isolate=True)
+        with self._lock:
+            del self._pending[:len(batch)]
+        self._checkpoint(last_seq)
+        if self.on_applied:
+            for kind, row in applied:
+                try:
+                    self.on_applied(kind, row)
+                except Exception:
+                    logger.exception("Ingest on_applied callback failed")
+        return len(batch)
+
+    def _run(self):
+        conn = None
+        retry = FLUSH_INTERVAL_SECONDS
+        while True:
+            self._wake.wait(FLUSH_INTERVAL_SECONDS)
+            self._wake.clear()
+            try:
+                if conn is None or conn.closed:
+                    conn = self._connect()
+                    with conn.cursor() as cur:
+                        cur.execute(SCHEMA_SQL)
+                    conn.commit()
+                while self.flush_once(conn) == MAX_BATCH:
+                    pass
+                retry = FLUSH_INTERVAL_SECONDS
+            except Exception as e:
+                logger.warning("Ingest flush failed (%d pending), retrying in %.1fs: %s", self.backlog(), retry, e)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+                conn = None
+                time.sleep(retry)
+                retry = min(MAX_RETRY_SECONDS, retry * 2)
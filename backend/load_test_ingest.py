@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Burst-load test for ingest admission control against a running API server.
+
+Simulates many cameras reconnecting at once (each posting enter/exit as fast as it
+can) while dashboards poll analytics routes, then reports latency percentiles and
+429 rates per class. With admission control, ingest p99 should stay bounded and
+analytics should be shed first.
+
+    python load_test_ingest.py --url http://localhost:8000 --devices 50 --seconds 10
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+ANALYTICS_PATHS = ("/metrics", "/hotspots", "/trends", "/idle-distribution")
+
+
+def _request(url, method="GET", body=None, headers=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json",
+                                                                          **(headers or {})})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, TimeoutError):
+        status = 0
+    return status, time.perf_counter() - start
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def run(url, devices, dashboards, seconds):
+    results = {"ingest": [], "analytics": []}
+    lock = threading.Lock()
+    stop = time.monotonic() + seconds
+
+    def camera(device):
+        n = 0
+        while time.monotonic() < stop:
+            path, body = ("/car-entries/enter", {"numberplate": f"LOAD-{device}-{n}"}) if n % 2 == 0 \
+                else ("/car-entries/exit", {})
+            status, elapsed = _request(url + path, "POST", body, {"X-Device-Id": f"load-{device}"})
+            with lock:
+                results["ingest"].append((status, elapsed))
+            n += 1
+
+    def dashboard(i):
+        n = 0
+        while time.monotonic() < stop:
+            status, elapsed = _request(url + ANALYTICS_PATHS[(i + n) % len(ANALYTICS_PATHS)])
+            with lock:
+                results["analytics"].append((status, elapsed))
+            n += 1
+
+    threads = [threading.Thread(target=camera, args=(d,)) for d in range(devices)]
+    threads += [threading.Thread(target=dashboard, args=(i,)) for i in range(dashboards)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    report = {}
+    for name, samples in results.items():
+        admitted = [e * 1000 for s, e in samples if 200 <= s < 300 or s == 400]
+        report[name] = {
+            "requests": len(samples),
+            "admitted": len(admitted),
+            "rejected_429": sum(1 for s, _ in samples if s == 429),
+            "errors": sum(1 for s, _ in samples if s == 0 or s >= 500),
+            "p50_ms": round(_percentile(admitted, 50), 1) if admitted else None,
+            "p99_ms": round(_percentile(admitted, 99), 1) if admitted else None,
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Burst-load test for ingest admission control.")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--dashboards", type=int, default=10)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+    print(json.dumps(run(args.url.rstrip("/"), args.devices, args.dashboards, args.seconds), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Response encodings and a short-lived response cache for polled JSON routes.
+
+Clients pick the body format with Accept (application/msgpack when the optional
+msgpack package is installed, else JSON) and the compression with Accept-Encoding
+(the highest q-value among br, when the optional brotli package is installed, gzip
+and identity). MessagePack is only sent when it is smaller than the JSON body: it
+stores every float as 8 bytes, so float-heavy payloads like /hotspots stay JSON.
+Bodies smaller than COMPRESS_MIN_BYTES go out uncompressed.
+
+@cached routes keep their JSON body for RESPONSE_CACHE_SECONDS and memoize every
+encoded variant next to it, so N pollers cost one query and one compression per
+variant per TTL. Other JSON responses are encoded per request by an after_request
+hook (install()).
+
+Configuration (environment):
+    RESPONSE_CACHE_SECONDS  TTL for @cached routes (default 2, 0 disables caching)
+    COMPRESS_MIN_BYTES      smallest body worth compressing (default 1024)
+"""
+import gzip
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack")
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+MAX_CACHE_ENTRIES = 256
+
+CACHE_SECONDS = float(os.environ.get("RESPONSE_CACHE_SECONDS", "2"))
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+
+
+def _parse_qvalues(header):
+    """'gzip;q=0.5, br' -> {'gzip': 0.5, 'br': 1.0}."""
+    values = {}
+    for part in (header or "").split(","):
+        token, _, params = part.strip().partition(";")
+        if not token:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        values[token.strip().lower()] = q
+    return values
+
+
+def choose_format(accept):
+    """MessagePack only when the client asks for it (and prefers it to JSON)."""
+    if msgpack is None:
+        return JSON
+    types = _parse_qvalues(accept)
+    q_msgpack = max(types.get(t, 0) for t in MSGPACK_TYPES)
+    return MSGPACK if q_msgpack > 0 and q_msgpack >= types.get(JSON, 0) else JSON
+
+
+def choose_encoding(accept_encoding):
+    """
+    Supported coding with the highest q-value (ties prefer br, then gzip). Unlisted
+    identity ranks below any accepted compression; it is also the last resort.
+    """
+    codings = _parse_qvalues(accept_encoding)
+    wildcard = codings.get("*")
+    supported = (["br"] if brotli is not None else []) + ["gzip", "identity"]
+
+    def rank(coding):
+        q = codings.get(coding, wildcard)
+        if q is None:
+            q = 0.001 if coding == "identity" else 0.0
+        return q, -supported.index(coding)
+
+    best = max(supported, key=rank)
+    return best if rank(best)[0] > 0 else "identity"
+
+
+def encode(json_body, fmt=JSON, coding="identity"):
+    """
+    Re-encode a JSON body; returns (body, content_type, content_encoding or None).
+    MessagePack falls back to JSON when it would not be smaller.
+    """
+    body = json_body
+    if fmt == MSGPACK:
+        body = msgpack.packb(json.loads(json_body))
+        if len(body) >= len(json_body):
+            body, fmt = json_body, JSON
+    if coding == "identity" or len(body) < COMPRESS_MIN_BYTES:
+        return body, fmt, None
+    if coding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY), fmt, "br"
+    return gzip.compress(body, compresslevel=GZIP_LEVEL), fmt, "gzip"
+
+
+def _response(body, content_type, content_encoding, status=200):
+    response = Response(body, status=status, content_type=content_type)
+    if content_encoding:
+        response.headers["Content-Encoding"] = content_encoding
+    response.vary.update(("Accept", "Accept-Encoding"))
+    response.negotiated = True
+    return response
+
+
+class _CachedBody:
+    def __init__(self, json_body, expires):
+        self.json_body = json_body
+        self.expires = expires
+        self.variants = {}
+        self._lock = threading.Lock()
+
+    def variant(self, fmt, coding):
+        key = (fmt, coding)
+        with self._lock:
+            if key not in self.variants:
+                self.variants[key] = encode(self.json_body, fmt, coding)
+            return self.variants[key]
+
+
+class ResponseCache:
+    """TTL cache of successful JSON bodies by path + query string, with encoded variants."""
+
+    def __init__(self, ttl, max_entries=MAX_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, load):
+        """
+        Cached body for key, else the result of load() -> JSON bytes, or None when load()
+        returns None (not cached). Concurrent misses on one key wait for a single load.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.expires > time.monotonic():
+                    self.hits += 1
+                    return entry
+                pending = self._loading.get(key)
+                if pending is None:
+                    pending = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            pending.wait()
+        try:
+            json_body = load()
+            if json_body is None:
+                return None
+            entry = _CachedBody(json_body, time.monotonic() + self.ttl)
+            with self._lock:
+                if len(self._entries) >= self.max_entries:
+                    now = time.monotonic()
+                    self._entries = {k: e for k, e in self._entries.items() if e.expires > now}
+                    while len(self._entries) >= self.max_entries:
+                        self._entries.pop(next(iter(self._entries)))
+                self._entries[key] = entry
+            return entry
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            pending.set()
+
+    def clear(self):
+        """Drop every cached body (in-flight loads still complete and are cached)."""
+        with self._lock:
+            self._entries = {}
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "ttl": self.ttl}
+
+
+cache = ResponseCache(CACHE_SECONDS)
+
+
+def cached(fn):
+    """
+    Route decorator: serve the route's 200 JSON body from the cache in the negotiated
+    format/encoding. Error responses pass through uncached. Place it above @admit so
+    cache hits skip admission and the DB entirely.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if cache.ttl <= 0:
+            return fn(*args, **kwargs)
+        result = {}
+
+        def load():
+            response = fn(*args, **kwargs)
+            if not isinstance(response, Response) or response.status_code != 200 \
+                    or response.mimetype != JSON:
+                result["passthrough"] = response
+                return None
+            return response.get_data()
+
+        entry = cache.get_or_load((request.path, request.query_string), load)
+        if entry is None:
+            return result["passthrough"]
+        fmt = choose_format(request.headers.get("Accept"))
+        coding = choose_encoding(request.headers.get("Accept-Encoding"))
+        return _response(*entry.variant(fmt, coding))
+    return wrapper
+
+
+def _negotiate(response):
+    """after_request: encode uncached JSON responses (cached ones are already done)."""
+    if (getattr(response, "negotiated", False) or response.direct_passthrough or response.is_streamed
+            or response.mimetype != JSON or "Content-Encoding" in response.headers):
+        return response
+    fmt = choose_format(request.headers.get("Accept"))
+    coding = choose_encoding(request.headers.get("Accept-Encoding"))
+    response.vary.update(("Accept", "Accept-Encoding"))
+    if fmt == JSON and coding == "identity":
+        return response
+    body, content_type, content_encoding = encode(response.get_data(), fmt, coding)
+    response.set_data(body)
+    response.content_type = content_type
+    if content_encoding:
+        response.headers["Content-Encoding"] = content_encoding
+    return response
+
+
+def install(app):
+    app.after_request(_negotiate)
@@ -0,0 +1,330 @@
+"""
+Asynchronous, batched carbon-offset purchases (1 CO2 kg = 1 credit).
+
+Purchases are written to the offset_purchases table and acknowledged immediately.
+A background worker coalesces due purchases into one provider call per batch and
+retries failures with exponential backoff, so request latency never depends on the
+provider. Batches left 'submitted' by a crashed worker are re-queued.
+
+A batch is persisted (offset_purchase_batches) with its member purchases the first
+time it is claimed, and every retry resends exactly that batch under the same
+batch_id, which providers receive as the Idempotency-Key. A purchase the provider
+completed but whose response was lost (timeout, crash) is therefore never bought
+twice.
+
+Providers are pluggable: SimulatedProvider (default, no key) or CloverlyProvider
+(CLOVERLY_API_KEY, CLOVERLY_API_URL). Point CLOVERLY_API_URL at fake_cloverly.py
+to exercise the HTTP path locally.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import psycopg2
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 2
+BACKOFF_MAX_SECONDS = 600
+LINGER_SECONDS = 0.25
+POLL_SECONDS = 1.0
+STALE_SUBMITTED = "5 minutes"
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS offset_purchases (
+    purchase_id SERIAL PRIMARY KEY,
+    credits DECIMAL(12, 2) NOT NULL CHECK (credits > 0 AND credits <> 'NaN'),
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    batch_id VARCHAR(32),
+    provider_reference VARCHAR(100),
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS offset_purchase_batches (
+    batch_id VARCHAR(32) PRIMARY KEY,
+    co2_kg DECIMAL(14, 2) NOT NULL,
+    purchases INTEGER NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'submitted',
+    attempts INTEGER NOT NULL DEFAULT 1,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    provider_reference VARCHAR(100),
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS offset_purchase_batches_due
+    ON offset_purchase_batches (next_attempt_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS offset_purchases_unbatched
+    ON offset_purchases (purchase_id) WHERE status = 'pending' AND batch_id IS NULL;
+"""
+
+
+class ProviderError(Exception):
+    """Provider call failed; the batch will be retried."""
+
+
+class SimulatedProvider:
+    """Sandbox provider: accepts every purchase without network calls."""
+
+    name = "simulated"
+
+    def purchase(self, batch_id, co2_kg):
+        return {"reference": f"sim-{batch_id}", "co2_kg": co2_kg}
+
+
+class CloverlyProvider:
+    """Cloverly carbon purchase API (or a compatible stand-in such as fake_cloverly.py)."""
+
+    name = "cloverly"
+
+    def __init__(self, api_key, base_url="https://api.cloverly.com", timeout=10):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def purchase(self, batch_id, co2_kg):
+        body = json.dumps({
+            "weight": {"value": round(co2_kg, 3), "units": "kg"},
+            "metadata": {"batch_id": batch_id},
+        }).encode()
+        req = urllib.request.Request(
+            f"{self.base_url}/2021-10/purchases/carbon",
+            data=body,
+            method="POST",
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+                "Idempotency-Key": batch_id,
+            },
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                data = json.loads(resp.read() or b"{}")
+        except (urllib.error.URLError, TimeoutError, ValueError) as e:
+            raise ProviderError(str(e)) from e
+        return {"reference": data.get("slug") or data.get("id"), "co2_kg": co2_kg}
+
+
+def get_provider():
+    api_key = os.environ.get("CLOVERLY_API_KEY")
+    if api_key:
+        return CloverlyProvider(api_key, os.environ.get("CLOVERLY_API_URL", "https://api.cloverly.com"))
+    return SimulatedProvider()
+
+
+def ensure_schema(conn):
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL)
+    conn.commit()
+
+
+def enqueue(conn, credits):
+    """Queue a purchase. Returns (purchase_id, created_at)."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO offset_purchases (credits) VALUES (%s) RETURNING purchase_id, created_at", (credits,)
+        )
+        row = cur.fetchone()
+    conn.commit()
+    return row
+
+
+def get_balance(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(SUM(credits), 0) FROM offset_purchases WHERE status = 'completed'")
+        return float(cur.fetchone()[0])
+
+
+def get_history(conn, limit=20):
+    """Latest purchases, oldest first, with the confirmed balance after each."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT * FROM (
+                SELECT purchase_id, credits, created_at, status,
+                       SUM(CASE WHEN status = 'completed' THEN credits ELSE 0 END)
+                           OVER (ORDER BY purchase_id) AS balance_after
+                FROM offset_purchases
+                ORDER BY purchase_id DESC
+                LIMIT %s
+            ) recent
+            ORDER BY purchase_id
+        """, (limit,))
+        return cur.fetchall()
+
+
+def get_purchase(conn, purchase_id):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT purchase_id, credits, status, attempts, provider_reference, error,
+                   created_at, completed_at, next_attempt_at
+            FROM offset_purchases WHERE purchase_id = %s
+        """, (purchase_id,))
+        return cur.fetchone()
+
+
+def _claim_batch(conn):
+    """
+    Claim one batch: a persisted batch that is due for retry, else a new batch of queued
+    purchases. Returns (batch_id, co2_kg), or (None, 0) when nothing is due.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            WITH stale AS (
+                UPDATE offset_purchase_batches SET status = 'pending', updated_at = NOW()
+                WHERE status = 'submitted' AND updated_at < NOW() - INTERVAL '{STALE_SUBMITTED}'
+                RETURNING batch_id
+            )
+            UPDATE offset_purchases SET status = 'pending', updated_at = NOW()
+            WHERE batch_id IN (SELECT batch_id FROM stale)
+        """)
+        cur.execute("""
+            SELECT batch_id, co2_kg FROM offset_purchase_batches
+            WHERE status = 'pending' AND next_attempt_at <= NOW()
+            ORDER BY next_attempt_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """)
+        row = cur.fetchone()
+        if row:
+            batch_id, co2_kg = row
+            cur.execute("""
+                UPDATE offset_purchase_batches
+                SET status = 'submitted', attempts = attempts + 1, updated_at = NOW()
+                WHERE batch_id = %s
+            """, (batch_id,))
+            cur.execute("""
+                UPDATE offset_purchases
+                SET status = 'submitted', attempts = attempts + 1, updated_at = NOW()
+                WHERE batch_id = %s
+            """, (batch_id,))
+        else:
+            batch_id = uuid.uuid4().hex
+            cur.execute("""
+                WITH picked AS (
+                    SELECT purchase_id FROM offset_purchases
+                    WHERE status = 'pending' AND batch_id IS NULL
+                    ORDER BY purchase_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE offset_purchases p
+                SET status = 'submitted', batch_id = %s, attempts = attempts + 1, updated_at = NOW()
+                FROM picked
+                WHERE p.purchase_id = picked.purchase_id
+                RETURNING p.credits
+            """, (BATCH_SIZE, batch_id))
+            credits = [r[0] for r in cur.fetchall()]
+            if not credits:
+                conn.commit()
+                return None, 0
+            co2_kg = sum(credits)
+            cur.execute(
+                "INSERT INTO offset_purchase_batches (batch_id, co2_kg, purchases) VALUES (%s, %s, %s)",
+                (batch_id, co2_kg, len(credits)),
+            )
+    conn.commit()
+    return batch_id, float(co2_kg)
+
+
+def _complete_batch(conn, batch_id, reference):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE offset_purchase_batches
+            SET status = 'completed', provider_reference = %s, error = NULL, updated_at = NOW()
+            WHERE batch_id = %s AND status = 'submitted'
+        """, (reference, batch_id))
+        cur.execute("""
+            UPDATE offset_purchases
+            SET status = 'completed', provider_reference = %s, error = NULL,
+                completed_at = NOW(), updated_at = NOW()
+            WHERE batch_id = %s AND status = 'submitted'
+        """, (reference, batch_id))
+    conn.commit()
+
+
+def _fail_batch(conn, batch_id, error):
+    """Queue the same batch for retry with jittered exponential backoff, or fail it for good."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE offset_purchase_batches
+            SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+                next_attempt_at = NOW() + LEAST(%s, %s * POWER(2, attempts - 1))
+                    * (0.5 + random() / 2) * INTERVAL '1 second',
+                error = %s,
+                updated_at = NOW()
+            WHERE batch_id = %s AND status = 'submitted'
+            RETURNING status, next_attempt_at
+        """, (MAX_ATTEMPTS, BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS, error[:500], batch_id))
+        row = cur.fetchone()
+        if row:
+            cur.execute("""
+                UPDATE offset_purchases
+                SET status = %s, next_attempt_at = %s, error = %s, updated_at = NOW()
+                WHERE batch_id = %s AND status = 'submitted'
+            """, (row[0], row[1], error[:500], batch_id))
+    conn.commit()
+
+
+def process_batch(conn, provider):
+    """Claim a due batch, buy it in one provider call, record the outcome. Returns batches bought."""
+    batch_id, co2_kg = _claim_batch(conn)
+    if batch_id is None:
+        return 0
+    try:
+        result = provider.purchase(batch_id, co2_kg)
+    except Exception as e:
+        _fail_batch(conn, batch_id, str(e))
+        return 0
+    _complete_batch(conn, batch_id, result.get("reference"))
+    return 1
+
+
+class PurchaseWorker:
+    """Background thread that drains the purchase queue."""
+
+    def __init__(self, connect, provider=None):
+        self._connect = connect
+        self.provider = provider or get_provider()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="offset-purchases", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def notify(self):
+        """Wake the worker after a new purchase; it lingers briefly to coalesce a batch."""
+        self._wake.set()
+
+    def _run(self):
+        conn = None
+        while True:
+            if self._wake.wait(POLL_SECONDS):
+                self._wake.clear()
+                time.sleep(LINGER_SECONDS)
+            try:
+                if conn is None or conn.closed:
+                    conn = self._connect()
+                while process_batch(conn, self.provider):
+                    pass
+            except Exception:
+                logger.exception("Offset purchase worker failed; retrying")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+                conn = None
+                time.sleep(POLL_SECONDS)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Indexed plate lookup and repeat-visitor analytics.
+
+plate_stats holds one row per normalized plate (plate_key(): upper case, no
+whitespace, mirroring normalize_plate()) with visits, closed visits, dwell minutes,
+CO2 and first/last seen, and plate_visit_counters holds global counters; both are
+maintained by a trigger on car_entries, so lookups and repeat-visitor stats never
+aggregate car_entries. The counters are split over SUMMARY_SHARDS rows (picked by
+backend pid) so concurrent ingests don't queue on a single row; readers sum them.
+Exact and prefix search use a varchar_pattern_ops index on plate_stats, fuzzy search
+a pg_trgm GIN index, and visit history an index on car_entries (plate_key(numberplate),
+enter_timestamp).
+
+Usage:
+    python plates.py migrate    # extension, indexes (CONCURRENTLY), trigger, backfill
+    python plates.py rebuild    # recompute plate_stats (blocks writes while it runs)
+
+After an emission-factor recompute only total_co2_g changes; recompute_co2() redoes
+it a batch of plates at a time without blocking ingest.
+"""
+import argparse
+
+MODES = ("exact", "prefix", "fuzzy")
+FUZZY_THRESHOLD = 0.3
+SUMMARY_SHARDS = 16
+CO2_BATCH_SIZE = 1000
+
+SCHEMA_SQL = """
+CREATE OR REPLACE FUNCTION plate_key(plate TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT UPPER(REGEXP_REPLACE(plate, '\\s+', '', 'g'))
+$$;
+
+CREATE TABLE IF NOT EXISTS plate_stats (
+    numberplate VARCHAR(20) PRIMARY KEY,
+    visit_count INTEGER NOT NULL DEFAULT 0,
+    closed_visits INTEGER NOT NULL DEFAULT 0,
+    total_minutes DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    total_co2_g DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    first_seen TIMESTAMP,
+    last_seen TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS plate_visit_counters (
+    shard SMALLINT PRIMARY KEY,
+    unique_plates BIGINT NOT NULL DEFAULT 0,
+    repeat_plates BIGINT NOT NULL DEFAULT 0,
+    total_visits BIGINT NOT NULL DEFAULT 0,
+    repeat_visits BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO plate_visit_counters (shard)
+SELECT generate_series(0, %(shards)s - 1) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION car_entries_update_plate_stats() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    visits INTEGER;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO plate_stats AS p (numberplate, visit_count, first_seen, last_seen)
+        VALUES (plate_key(NEW.numberplate), 1, NEW.enter_timestamp, NEW.enter_timestamp)
+        ON CONFLICT (numberplate) DO UPDATE SET
+            visit_count = p.visit_count + 1,
+            first_seen = LEAST(p.first_seen, EXCLUDED.first_seen),
+            last_seen = GREATEST(p.last_seen, EXCLUDED.last_seen)
+        RETURNING p.visit_count INTO visits;
+        UPDATE plate_visit_counters SET
+            total_visits = total_visits + 1,
+            unique_plates = unique_plates + (visits = 1)::int,
+            repeat_plates = repeat_plates + (visits = 2)::int,
+            repeat_visits = repeat_visits + CASE WHEN visits = 2 THEN 2 WHEN visits > 2 THEN 1 ELSE 0 END
+        WHERE shard = pg_backend_pid() %% %(shards)s;
+    END IF;
+    IF NEW.exit_timestamp IS NOT NULL AND (TG_OP = 'INSERT' OR OLD.exit_timestamp IS NULL) THEN
+        UPDATE plate_stats SET
+            closed_visits = closed_visits + 1,
+            total_minutes = total_minutes + COALESCE(NEW.minutes_elapsed, 0),
+            total_co2_g = total_co2_g + COALESCE(NEW.carbon_produced, 0),
+            last_seen = GREATEST(last_seen, NEW.exit_timestamp)
+        WHERE numberplate = plate_key(NEW.numberplate);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS car_entries_plate_stats ON car_entries;
+CREATE TRIGGER car_entries_plate_stats
+    AFTER INSERT OR UPDATE OF exit_timestamp ON car_entries
+    FOR EACH ROW EXECUTE FUNCTION car_entries_update_plate_stats();
+"""
+
+# CREATE INDEX CONCURRENTLY cannot run inside a transaction block.
+INDEX_SQL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS car_entries_numberplate_enter "
+    "ON car_entries (plate_key(numberplate), enter_timestamp DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS plate_stats_prefix ON plate_stats (numberplate varchar_pattern_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS plate_stats_trgm ON plate_stats USING gin (numberplate gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS plate_stats_visits ON plate_stats (visit_count DESC)",
+)
+
+_STATS_COLUMNS = """
+    numberplate, visit_count, closed_visits,
+    CASE WHEN closed_visits > 0 THEN total_minutes / closed_visits END,
+    total_co2_g / 1000.0, first_seen, last_seen
+"""
+
+
+def normalize_plate(plate):
+    """Python twin of the plate_key() SQL function."""
+    return "".join((plate or "").split()).upper()
+
+
+def ensure_schema(conn):
+    """Create tables and trigger, then build indexes without blocking writes."""
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL % {"shards": SUMMARY_SHARDS})
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for statement in INDEX_SQL:
+                cur.execute(statement)
+    finally:
+        conn.autocommit = autocommit
+
+
+def rebuild(conn):
+    """
+    Recompute plate_stats and the counters from car_entries in one transaction (writes
+    wait until it commits). Returns the number of plates.
+    """
+    with conn.cursor() as cur:
+        cur.execute("LOCK TABLE car_entries IN SHARE MODE")
+        cur.execute("TRUNCATE plate_stats")
+        cur.execute("""
+            INSERT INTO plate_stats
+                (numberplate, visit_count, closed_visits, total_minutes, total_co2_g, first_seen, last_seen)
+            SELECT plate_key(numberplate), COUNT(*), COUNT(exit_timestamp),
+                   COALESCE(SUM(minutes_elapsed), 0), COALESCE(SUM(carbon_produced), 0),
+                   MIN(enter_timestamp), GREATEST(MAX(enter_timestamp), MAX(exit_timestamp))
+            FROM car_entries
+            GROUP BY 1
+        """)
+        plate_count = cur.rowcount
+        cur.execute("""
+            UPDATE plate_visit_counters SET
+                unique_plates = CASE WHEN shard = 0 THEN s.unique_plates ELSE 0 END,
+                repeat_plates = CASE WHEN shard = 0 THEN s.repeat_plates ELSE 0 END,
+                total_visits = CASE WHEN shard = 0 THEN s.total_visits ELSE 0 END,
+                repeat_visits = CASE WHEN shard = 0 THEN s.repeat_visits ELSE 0 END
+            FROM (
+                SELECT COUNT(*) AS unique_plates,
+                       COUNT(*) FILTER (WHERE visit_count > 1) AS repeat_plates,
+                       COALESCE(SUM(visit_count), 0) AS total_visits,
+                       COALESCE(SUM(visit_count) FILTER (WHERE visit_count > 1), 0) AS repeat_visits
+                FROM plate_stats
+            ) s
+        """)
+    conn.commit()
+    return plate_count
+
+
+def recompute_co2(conn, batch_size=CO2_BATCH_SIZE):
+    """
+    Recompute total_co2_g from car_entries (e.g. after new emission factors are
+    published), one short transaction per batch of plates. Each batch locks its
+    plate_stats rows before summing, so exits racing with it are either already
+    visible to the sum or added by the trigger after it commits. Returns plates updated.
+    """
+    updated = 0
+    last = ""
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT numberplate FROM plate_stats
+                WHERE numberplate > %s
+                ORDER BY numberplate
+                LIMIT %s
+                FOR UPDATE
+            """, (last, batch_size))
+            keys = [r[0] for r in cur.fetchall()]
+            if not keys:
+                conn.rollback()
+                return updated
+            cur.execute("""
+                UPDATE plate_stats p SET total_co2_g = s.co2
+                FROM (
+                    SELECT k.numberplate, COALESCE(SUM(c.carbon_produced), 0) AS co2
+                    FROM UNNEST(%s::varchar[]) AS k(numberplate)
+                    LEFT JOIN car_entries c ON plate_key(c.numberplate) = k.numberplate
+                    GROUP BY k.numberplate
+                ) s
+                WHERE p.numberplate = s.numberplate
+            """, (keys,))
+            updated += cur.rowcount
+        conn.commit()
+        last = keys[-1]
+
+
+def _stats_dict(row, similarity=None):
+    stats = {
+        "numberplate": row[0],
+        "visit_count": row[1],
+        "closed_visits": row[2],
+        "avg_dwell_minutes": round(float(row[3]), 2) if row[3] is not None else None,
+        "total_co2_kg": round(float(row[4]), 3),
+        "first_seen": row[5],
+        "last_seen": row[6],
+    }
+    if similarity is not None:
+        stats["similarity"] = round(float(similarity), 3)
+    return stats
+
+
+def search(conn, plate, mode="exact", limit=20):
+    """Matching plates with their aggregates (most similar / most recent first)."""
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    plate = normalize_plate(plate)
+    if not plate:
+        raise ValueError("plate is required")
+    with conn.cursor() as cur:
+        if mode == "exact":
+            cur.execute(f"SELECT {_STATS_COLUMNS} FROM plate_stats WHERE numberplate = %s", (plate,))
+            return [_stats_dict(r) for r in cur.fetchall()]
+        if mode == "prefix":
+            pattern = plate.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            cur.execute(f"""
+                SELECT {_STATS_COLUMNS} FROM plate_stats
+                WHERE numberplate LIKE %s
+                ORDER BY numberplate
+                LIMIT %s
+            """, (pattern, limit))
+            return [_stats_dict(r) for r in cur.fetchall()]
+        cur.execute("SET LOCAL pg_trgm.similarity_threshold = %s", (FUZZY_THRESHOLD,))
+        cur.execute(f"""
+            SELECT {_STATS_COLUMNS}, similarity(numberplate, %s) AS sim FROM plate_stats
+            WHERE numberplate %% %s
+            ORDER BY sim DESC, last_seen DESC
+            LIMIT %s
+        """, (plate, plate, limit))
+        return [_stats_dict(r[:-1], similarity=r[-1]) for r in cur.fetchall()]
+
+
+def visit_history(conn, plate, limit=50):
+    """Most recent visits for one plate (uses the plate_key, enter_timestamp index)."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT entry_id, enter_timestamp, exit_timestamp, minutes_elapsed, carbon_produced
+            FROM car_entries
+            WHERE plate_key(numberplate) = %s
+            ORDER BY enter_timestamp DESC
+            LIMIT %s
+        """, (normalize_plate(plate), limit))
+        return cur.fetchall()
+
+
+def repeat_visitors(conn, limit=10):
+    """Global repeat-visitor counters plus the most frequent plates."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT COALESCE(SUM(unique_plates), 0)::bigint, COALESCE(SUM(repeat_plates), 0)::bigint,
+                   COALESCE(SUM(total_visits), 0)::bigint, COALESCE(SUM(repeat_visits), 0)::bigint
+            FROM plate_visit_counters
+        """)
+        unique_plates, repeat_plates, total_visits, repeat_visits = cur.fetchone()
+        cur.execute(f"""
+            SELECT {_STATS_COLUMNS} FROM plate_stats
+            WHERE visit_count > 1
+            ORDER BY visit_count DESC
+            LIMIT %s
+        """, (limit,))
+        top = [_stats_dict(r) for r in cur.fetchall()]
+    return {
+        "unique_plates": unique_plates,
+        "repeat_plates": repeat_plates,
+        "repeat_plate_share": round(repeat_plates / unique_plates, 4) if unique_plates else 0,
+        "total_visits": total_visits,
+        "repeat_visit_share": round(repeat_visits / total_visits, 4) if total_visits else 0,
+        "top_repeat_visitors": top,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plate lookup indexes and aggregates.")
+    parser.add_argument("command", choices=("migrate", "rebuild"))
+    args = parser.parse_args()
+
+    from db import get_connection
+
+    conn = get_connection()
+    try:
+        ensure_schema(conn)
+        if args.command == "migrate":
+            print("Plate indexes and trigger ready.")
+        print(f"Backfilled stats for {rebuild(conn)} plates.")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
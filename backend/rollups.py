@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Multi-resolution emission rollups for long-range charts.
+
+A trigger on car_entries adds every closed entry to 1 min / 15 min / 1 h / 1 day
+buckets (by exit_timestamp, like /emissions-timeseries) as it arrives. get_series()
+picks the finest resolution that fits the requested max_points, so a year-long
+chart reads as few rows as an hour-long one; optional LTTB downsampling keeps the
+visual shape when even daily buckets are too many.
+
+During an emission-factor recompute the same buckets are built from the *_next
+columns in emission_rollups_next: each recompute chunk adds its entries, and the
+trigger follows entries whose chunk is already done. Publishing the job swaps the
+two tables in the same transaction as the columns, so charts never mix factors.
+
+Usage:
+    python rollups.py rebuild [--days N]   # backfill existing entries
+"""
+import argparse
+import math
+from datetime import datetime, timedelta, timezone
+
+RESOLUTIONS_MINUTES = (1, 15, 60, 1440)
+METRICS = ("cars", "idle_minutes", "co2_kg", "fuel_g")
+LTTB_OVERSAMPLE = 4
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS emission_rollups (
+    resolution_minutes INTEGER NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    cars INTEGER NOT NULL DEFAULT 0,
+    idle_minutes DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    co2_g DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    fuel_g DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (resolution_minutes, bucket_start)
+);
+
+CREATE OR REPLACE FUNCTION rollup_bucket(ts TIMESTAMP, resolution INTEGER) RETURNS TIMESTAMP
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT TO_TIMESTAMP(FLOOR(EXTRACT(EPOCH FROM ts) / (resolution * 60)) * resolution * 60)
+        AT TIME ZONE 'UTC'
+$$;
+
+CREATE TABLE IF NOT EXISTS emission_rollups_next (LIKE emission_rollups INCLUDING ALL);
+
+CREATE OR REPLACE FUNCTION rollup_add(shadow BOOLEAN, ts TIMESTAMP, n INTEGER,
+                                      minutes DECIMAL, co2 DECIMAL, fuel DECIMAL) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    resolution INTEGER;
+BEGIN
+    FOREACH resolution IN ARRAY ARRAY[%(resolutions)s] LOOP
+        IF shadow THEN
+            INSERT INTO emission_rollups_next AS r
+                (resolution_minutes, bucket_start, cars, idle_minutes, co2_g, fuel_g)
+            VALUES (resolution, rollup_bucket(ts, resolution), n, minutes, co2, fuel)
+            ON CONFLICT (resolution_minutes, bucket_start) DO UPDATE SET
+                cars = r.cars + EXCLUDED.cars,
+                idle_minutes = r.idle_minutes + EXCLUDED.idle_minutes,
+                co2_g = r.co2_g + EXCLUDED.co2_g,
+                fuel_g = r.fuel_g + EXCLUDED.fuel_g;
+        ELSE
+            INSERT INTO emission_rollups AS r
+                (resolution_minutes, bucket_start, cars, idle_minutes, co2_g, fuel_g)
+            VALUES (resolution, rollup_bucket(ts, resolution), n, minutes, co2, fuel)
+            ON CONFLICT (resolution_minutes, bucket_start) DO UPDATE SET
+                cars = r.cars + EXCLUDED.cars,
+                idle_minutes = r.idle_minutes + EXCLUDED.idle_minutes,
+                co2_g = r.co2_g + EXCLUDED.co2_g,
+                fuel_g = r.fuel_g + EXCLUDED.fuel_g;
+        END IF;
+    END LOOP;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION car_entries_update_rollups() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    was_closed BOOLEAN := TG_OP = 'UPDATE' AND OLD.exit_timestamp IS NOT NULL;
+    shadow BOOLEAN;
+BEGIN
+    IF was_closed THEN
+        PERFORM rollup_add(FALSE, OLD.exit_timestamp, -1, -COALESCE(OLD.minutes_elapsed, 0),
+                           -COALESCE(OLD.carbon_produced, 0), -COALESCE(OLD.fuel_used, 0));
+    END IF;
+    IF NEW.exit_timestamp IS NOT NULL THEN
+        PERFORM rollup_add(FALSE, NEW.exit_timestamp, 1, COALESCE(NEW.minutes_elapsed, 0),
+                           COALESCE(NEW.carbon_produced, 0), COALESCE(NEW.fuel_used, 0));
+    END IF;
+    IF NOT was_closed AND NEW.exit_timestamp IS NULL THEN
+        RETURN NULL;
+    END IF;
+    shadow := emission_recompute_covers(NEW.entry_id);
+    IF shadow AND was_closed THEN
+        PERFORM rollup_add(TRUE, OLD.exit_timestamp, -1, -COALESCE(OLD.minutes_elapsed, 0),
+                           -COALESCE(OLD.carbon_produced_next, 0), -COALESCE(OLD.fuel_used_next, 0));
+    END IF;
+    IF shadow AND NEW.exit_timestamp IS NOT NULL THEN
+        PERFORM rollup_add(TRUE, NEW.exit_timestamp, 1, COALESCE(NEW.minutes_elapsed, 0),
+                           COALESCE(NEW.carbon_produced_next, 0), COALESCE(NEW.fuel_used_next, 0));
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS car_entries_rollups ON car_entries;
+CREATE TRIGGER car_entries_rollups
+    AFTER INSERT OR UPDATE OF exit_timestamp ON car_entries
+    FOR EACH ROW EXECUTE FUNCTION car_entries_update_rollups();
+"""
+
+
+def ensure_schema(conn):
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL % {"resolutions": ", ".join(str(r) for r in RESOLUTIONS_MINUTES)})
+    conn.commit()
+
+
+def reset_shadow(conn):
+    """Empty emission_rollups_next for a new recompute job (caller commits)."""
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE emission_rollups_next")
+
+
+def add_to_shadow(conn, start_id, end_id):
+    """
+    Add closed entries in [start_id, end_id] to emission_rollups_next using their *_next
+    values, in the caller's transaction (the one that recomputed them).
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO emission_rollups_next AS r
+                (resolution_minutes, bucket_start, cars, idle_minutes, co2_g, fuel_g)
+            SELECT res, rollup_bucket(c.exit_timestamp, res), COUNT(*),
+                   COALESCE(SUM(c.minutes_elapsed), 0), COALESCE(SUM(c.carbon_produced_next), 0),
+                   COALESCE(SUM(c.fuel_used_next), 0)
+            FROM car_entries c CROSS JOIN UNNEST(%s) AS res
+            WHERE c.entry_id BETWEEN %s AND %s
+              AND c.exit_timestamp IS NOT NULL
+            GROUP BY 1, 2
+            ON CONFLICT (resolution_minutes, bucket_start) DO UPDATE SET
+                cars = r.cars + EXCLUDED.cars,
+                idle_minutes = r.idle_minutes + EXCLUDED.idle_minutes,
+                co2_g = r.co2_g + EXCLUDED.co2_g,
+                fuel_g = r.fuel_g + EXCLUDED.fuel_g
+        """, (list(RESOLUTIONS_MINUTES), start_id, end_id))
+
+
+def swap_shadow(conn):
+    """Make emission_rollups_next live (caller commits, with the factor column swap)."""
+    with conn.cursor() as cur:
+        cur.execute("ALTER TABLE emission_rollups RENAME TO emission_rollups_swap")
+        cur.execute("ALTER TABLE emission_rollups_next RENAME TO emission_rollups")
+        cur.execute("ALTER TABLE emission_rollups_swap RENAME TO emission_rollups_next")
+
+
+def rebuild(conn, start=None, end=None, chunk=timedelta(days=1)):
+    """
+    Recompute rollups from car_entries for [start, end) in one short transaction per
+    chunk (all history by default). Returns chunks processed.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT MIN(exit_timestamp), MAX(exit_timestamp) FROM car_entries")
+        lo, hi = cur.fetchone()
+    conn.commit()
+    if lo is None:
+        return 0
+    start = start or lo.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = end or hi + timedelta(minutes=1)
+    chunks = 0
+    while start < end:
+        stop = min(start + chunk, end)
+        with conn.cursor() as cur:
+            for resolution in RESOLUTIONS_MINUTES:
+                # Buckets straddling the chunk edges are recomputed over their full span.
+                params = {"res": resolution, "start": start, "last": stop - timedelta(microseconds=1)}
+                cur.execute("""
+                    DELETE FROM emission_rollups
+                    WHERE resolution_minutes = %(res)s
+                      AND bucket_start >= rollup_bucket(%(start)s, %(res)s)
+                      AND bucket_start <= rollup_bucket(%(last)s, %(res)s)
+                """, params)
+                cur.execute("""
+                    INSERT INTO emission_rollups
+                        (resolution_minutes, bucket_start, cars, idle_minutes, co2_g, fuel_g)
+                    SELECT %(res)s, rollup_bucket(exit_timestamp, %(res)s), COUNT(*),
+                           COALESCE(SUM(minutes_elapsed), 0), COALESCE(SUM(carbon_produced), 0),
+                           COALESCE(SUM(fuel_used), 0)
+                    FROM car_entries
+                    WHERE exit_timestamp >= rollup_bucket(%(start)s, %(res)s)
+                      AND exit_timestamp < rollup_bucket(%(last)s, %(res)s) + %(res)s * INTERVAL '1 minute'
+                    GROUP BY 2
+                """, params)
+        conn.commit()
+        chunks += 1
+        start = stop
+    return chunks
+
+
+def choose_resolution(span_minutes, max_points, lttb=False):
+    """Finest resolution whose bucket count fits max_points (LTTB allows oversampling)."""
+    budget = max_points * (LTTB_OVERSAMPLE if lttb else 1)
+    for resolution in RESOLUTIONS_MINUTES:
+        if math.ceil(span_minutes / resolution) <= budget:
+            return resolution
+    return RESOLUTIONS_MINUTES[-1]
+
+
+def lttb(points, threshold, key):
+    """Largest-Triangle-Three-Buckets: keep `threshold` points preserving the shape of points[key]."""
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return points
+    sampled = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = (avg_start + avg_end - 1) / 2
+        avg_y = sum(points[j][key] for j in range(avg_start, avg_end)) / max(1, avg_end - avg_start)
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        ay = points[a][key]
+        best, best_area = range_start, -1.0
+        for j in range(range_start, range_end):
+            area = abs((a - avg_x) * (points[j][key] - ay) - (a - j) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def get_series(conn, start, end, max_points=500, downsample=False, metric="co2_kg"):
+    """
+    Zero-filled series between start and end (naive UTC datetimes). Returns
+    (resolution_minutes, points); points hold time plus every metric. With downsample,
+    or whenever daily buckets still exceed max_points, LTTB on `metric` trims the result.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+    if end <= start:
+        raise ValueError("end must be after start")
+    span = (end - start).total_seconds() / 60
+    resolution = choose_resolution(span, max_points, lttb=downsample)
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT b.bucket_start, COALESCE(r.cars, 0), COALESCE(r.idle_minutes, 0),
+                   COALESCE(r.co2_g, 0) / 1000.0, COALESCE(r.fuel_g, 0)
+            FROM generate_series(rollup_bucket(%s, %s), %s, %s * INTERVAL '1 minute') AS b(bucket_start)
+            LEFT JOIN emission_rollups r
+                ON r.resolution_minutes = %s AND r.bucket_start = b.bucket_start
+            ORDER BY b.bucket_start
+        """, (start, resolution, end - timedelta(microseconds=1), resolution, resolution))
+        rows = cur.fetchall()
+    points = [
+        {
+            "time": r[0].replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z"),
+            "cars": int(r[1]),
+            "idle_minutes": round(float(r[2]), 2),
+            "co2_kg": round(float(r[3]), 3),
+            "fuel_g": round(float(r[4]), 1),
+        }
+        for r in rows
+    ]
+    if len(points) > max_points:
+        points = lttb(points, max_points, metric)
+    return resolution, points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emission rollups maintenance.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild_cmd = sub.add_parser("rebuild")
+    rebuild_cmd.add_argument("--days", type=int, help="Only the last N days (default: all history)")
+    args = parser.parse_args()
+
+    from db import get_connection
+
+    conn = get_connection()
+    try:
+        ensure_schema(conn)
+        start = None
+        if args.days:
+            start = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=args.days)
+        print(f"Rebuilt rollups in {rebuild(conn, start=start)} chunks.")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Monte Carlo drive-through queue simulator for what-if CO2 analysis.
+
+Each scenario (lane count + service-time distribution) is replayed many times as a
+FIFO multi-lane queue. Arrivals are Poisson at the historical rate for an hour of
+the week (from car_entries) or at an explicit rate. Cars idle from arrival until
+they leave the window, at 12 g/min fuel and 27 g/min CO2.
+
+Replications are vectorized with NumPy and spread across worker processes. The pool
+uses forkserver (spawn where unavailable), never plain fork, because /simulate calls
+it from the threaded API server; this module is the worker entry point and importing
+it has no side effects.
+
+Usage:
+    python simulator.py --lanes 1 2 --service-mean 4 --service-cv 0.5 --runs 100000
+    python simulator.py --hour-of-week 12 --distribution gamma   # Monday 12:00 local
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from efficiency import compute_efficiency_score
+
+FUEL_G_PER_MIN = 12
+CO2_G_PER_MIN = 27
+
+DISTRIBUTIONS = ("exponential", "lognormal", "gamma", "fixed")
+MAX_RUNS = 100_000
+MAX_SCENARIOS = 8
+MAX_TOTAL_RUNS = 200_000  # runs x scenarios per request
+MAX_ARRIVALS_PER_HOUR = 300  # 5 cars/minute, far beyond any real lane
+_CHUNK_RUNS = 10_000
+_MAX_CHUNK_ELEMENTS = 2_000_000  # per (runs x cars) array, ~16 MB of float64
+_WARMUP_MINUTES = 60
+_HORIZON_MINUTES = 60
+
+_executor = None
+
+
+def get_arrival_rates(conn, tz="America/Los_Angeles"):
+    """
+    Historical arrivals per hour for each hour of the week (168 values, 0 = Monday 00:00 local).
+    Averages over the number of weeks the data spans.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT
+                (EXTRACT(ISODOW FROM ((enter_timestamp AT TIME ZONE 'UTC') AT TIME ZONE %s))::int - 1) * 24
+                    + EXTRACT(HOUR FROM ((enter_timestamp AT TIME ZONE 'UTC') AT TIME ZONE %s))::int AS how,
+                COUNT(*)
+            FROM car_entries
+            WHERE enter_timestamp IS NOT NULL
+            GROUP BY 1
+        """, (tz, tz))
+        rows = cur.fetchall()
+        cur.execute("""
+            SELECT EXTRACT(EPOCH FROM (MAX(enter_timestamp) - MIN(enter_timestamp))) / 86400.0
+            FROM car_entries
+            WHERE enter_timestamp IS NOT NULL
+        """)
+        span_days = float(cur.fetchone()[0] or 0)
+    weeks = max(1, math.ceil(span_days / 7))
+    rates = [0.0] * 168
+    for how, count in rows:
+        if 0 <= how < 168:
+            rates[how] = count / weeks
+    return rates
+
+
+def current_hour_of_week(tz="America/Los_Angeles"):
+    now = datetime.now(ZoneInfo(tz))
+    return now.weekday() * 24 + now.hour
+
+
+def _validate_scenario(scenario):
+    if not isinstance(scenario, dict):
+        raise ValueError("each scenario must be an object")
+    lanes = int(scenario.get("lanes", 1))
+    distribution = scenario.get("distribution", "lognormal")
+    mean = float(scenario.get("service_mean_minutes", 4.0))
+    cv = float(scenario.get("service_cv", 0.5))
+    if not 1 <= lanes <= 10:
+        raise ValueError("lanes must be between 1 and 10")
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f"distribution must be one of {', '.join(DISTRIBUTIONS)}")
+    if mean <= 0 or cv < 0:
+        raise ValueError("service_mean_minutes must be positive and service_cv non-negative")
+    return {"lanes": lanes, "distribution": distribution, "service_mean_minutes": mean, "service_cv": cv}
+
+
+def _sample_service(rng, size, distribution, mean, cv):
+    if distribution == "fixed" or (cv == 0 and distribution != "exponential"):
+        return np.full(size, mean)
+    if distribution == "exponential":
+        return rng.exponential(mean, size)
+    if distribution == "gamma":
+        return rng.gamma(1.0 / cv ** 2, mean * cv ** 2, size)
+    sigma2 = math.log(1 + cv ** 2)
+    return rng.lognormal(math.log(mean) - sigma2 / 2, math.sqrt(sigma2), size)
+
+
+def _max_cars(arrivals_per_hour):
+    """Cars to draw per run: the expected count over warm-up + horizon plus 6 sigma."""
+    expected = arrivals_per_hour / 60.0 * (_WARMUP_MINUTES + _HORIZON_MINUTES)
+    return int(expected + 6 * math.sqrt(expected) + 10)
+
+
+def _simulate_chunk(args):
+    """
+    Run `runs` replications of one scenario. Returns (cars, idle_minutes) arrays per run,
+    counting only cars arriving after the warm-up period.
+    """
+    runs, arrivals_per_hour, scenario, seed = args
+    if arrivals_per_hour <= 0:
+        return np.zeros(runs), np.zeros(runs)
+    rng = np.random.default_rng(seed)
+    total = _WARMUP_MINUTES + _HORIZON_MINUTES
+    max_cars = _max_cars(arrivals_per_hour)
+
+    arrivals = np.cumsum(rng.exponential(60.0 / arrivals_per_hour, (runs, max_cars)), axis=1)
+    service = _sample_service(
+        rng, (runs, max_cars), scenario["distribution"], scenario["service_mean_minutes"], scenario["service_cv"]
+    )
+    lane_free = np.zeros((runs, scenario["lanes"]))
+    idle = np.empty((runs, max_cars))
+    rows = np.arange(runs)
+    # Cars are sequential within a run, but every run advances in lockstep.
+    for k in range(max_cars):
+        lane = lane_free.argmin(axis=1)
+        finish = np.maximum(arrivals[:, k], lane_free[rows, lane]) + service[:, k]
+        lane_free[rows, lane] = finish
+        idle[:, k] = finish - arrivals[:, k]
+
+    counted = (arrivals >= _WARMUP_MINUTES) & (arrivals < total)
+    return counted.sum(axis=1).astype(np.float64), np.where(counted, idle, 0.0).sum(axis=1)
+
+
+def _mp_context():
+    """Fork-free start method: forking a multi-threaded server can deadlock the child."""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["simulator"])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _get_executor(workers):
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context())
+    return _executor
+
+
+def simulate(scenarios, arrivals_per_hour, runs=MAX_RUNS, workers=None, seed=None):
+    """
+    Simulate each scenario for one hour at arrivals_per_hour. Returns one result dict per
+    scenario with expected cars, idle minutes, fuel, CO2 and efficiency score.
+    """
+    runs = int(runs)
+    if not 1 <= runs <= MAX_RUNS:
+        raise ValueError(f"runs must be between 1 and {MAX_RUNS}")
+    arrivals_per_hour = float(arrivals_per_hour)
+    if not (math.isfinite(arrivals_per_hour) and 0 <= arrivals_per_hour <= MAX_ARRIVALS_PER_HOUR):
+        raise ValueError(f"arrivals_per_hour must be between 0 and {MAX_ARRIVALS_PER_HOUR}")
+    if not isinstance(scenarios, list) or not 1 <= len(scenarios) <= MAX_SCENARIOS:
+        raise ValueError(f"scenarios must be a list of 1 to {MAX_SCENARIOS} scenarios")
+    if runs * len(scenarios) > MAX_TOTAL_RUNS:
+        raise ValueError(f"runs x scenarios must be at most {MAX_TOTAL_RUNS}")
+    scenarios = [_validate_scenario(s) for s in scenarios]
+    workers = workers or int(os.environ.get("SIM_WORKERS", os.cpu_count() or 1))
+
+    seeds = np.random.SeedSequence(seed)
+    chunk_runs = max(1, min(_CHUNK_RUNS, _MAX_CHUNK_ELEMENTS // _max_cars(arrivals_per_hour)))
+    tasks = []
+    for index, scenario in enumerate(scenarios):
+        for start in range(0, runs, chunk_runs):
+            tasks.append((index, (min(chunk_runs, runs - start), arrivals_per_hour, scenario, seeds.spawn(1)[0])))
+
+    if workers > 1 and len(tasks) > 1:
+        outputs = list(_get_executor(workers).map(_simulate_chunk, [t[1] for t in tasks]))
+    else:
+        outputs = [_simulate_chunk(t[1]) for t in tasks]
+
+    results = []
+    for index, scenario in enumerate(scenarios):
+        parts = [out for (i, _), out in zip(tasks, outputs) if i == index]
+        cars = np.concatenate([p[0] for p in parts])
+        idle = np.concatenate([p[1] for p in parts])
+        avg_idle = float(idle.sum() / cars.sum()) if cars.sum() else 0.0
+        total_idle = float(idle.mean())
+        co2_kg = total_idle * CO2_G_PER_MIN / 1000.0
+        results.append({
+            **scenario,
+            "arrivals_per_hour": round(arrivals_per_hour, 2),
+            "runs": runs,
+            "expected_cars": round(float(cars.mean()), 2),
+            "avg_idle_minutes": round(avg_idle, 2),
+            "expected_idle_minutes": round(total_idle, 1),
+            "p90_idle_minutes": round(float(np.percentile(idle, 90)), 1),
+            "expected_fuel_grams": round(total_idle * FUEL_G_PER_MIN, 1),
+            "expected_co2_kg": round(co2_kg, 2),
+            "p90_co2_kg": round(float(np.percentile(idle, 90)) * CO2_G_PER_MIN / 1000.0, 2),
+            "efficiency_score": compute_efficiency_score(co2_kg, avg_idle, float(cars.mean())),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate drive-through idle time and CO2 for what-if scenarios.")
+    parser.add_argument("--lanes", type=int, nargs="+", default=[1])
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--service-mean", type=float, default=4.0, help="Mean service time (minutes)")
+    parser.add_argument("--service-cv", type=float, default=0.5, help="Service time coefficient of variation")
+    parser.add_argument("--runs", type=int, default=MAX_RUNS)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--tz", default="America/Los_Angeles")
+    rate = parser.add_mutually_exclusive_group()
+    rate.add_argument("--arrivals-per-hour", type=float, help="Override historical arrival rate")
+    rate.add_argument("--hour-of-week", type=int, help="0-167, 0 = Monday 00:00 local (default: now)")
+    args = parser.parse_args()
+
+    arrivals = args.arrivals_per_hour
+    if arrivals is None:
+        from db import get_connection
+
+        conn = get_connection()
+        try:
+            rates = get_arrival_rates(conn, tz=args.tz)
+        finally:
+            conn.close()
+        how = args.hour_of_week if args.hour_of_week is not None else current_hour_of_week(args.tz)
+        arrivals = rates[how % 168]
+
+    scenarios = [
+        {"lanes": lanes, "distribution": args.distribution,
+         "service_mean_minutes": args.service_mean, "service_cv": args.service_cv}
+        for lanes in args.lanes
+    ]
+    print(json.dumps(simulate(scenarios, arrivals, runs=args.runs, workers=args.workers, seed=args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Stalled-vehicle detector.
+
+Open entries live in a min-heap keyed by deadline (enter time + threshold). Enter
+events push onto the heap (O(log n)); exits just drop the entry from the open map
+and its heap node is discarded when it surfaces. A single timer thread sleeps until
+the earliest deadline and fires an alert the moment it passes. Alerts go to the
+log, to SSE subscribers, and (if STALL_WEBHOOK_URL is set) to a webhook from a
+separate sender thread, so a slow endpoint never delays detection.
+
+The heap is rebuilt from open car_entries once at startup; after that the detector
+only sees enter/exit events and never queries the database.
+"""
+import heapq
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+
+WEBHOOK_TIMEOUT_SECONDS = 5
+WEBHOOK_ATTEMPTS = 3
+SUBSCRIBER_QUEUE_SIZE = 100
+MAX_RETRY_SECONDS = 30
+
+logger = logging.getLogger(__name__)
+
+
+class StallDetector:
+    """
+    Fires a "stalled" alert when an entry stays open past threshold_seconds, and a
+    "cleared" alert when a stalled entry finally exits. Timestamps are epoch seconds.
+    """
+
+    def __init__(self, threshold_seconds, webhook_url=None, clock=time.time):
+        self.threshold = float(threshold_seconds)
+        self.webhook_url = webhook_url
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._heap = []  # (deadline, entry_id)
+        self._open = {}  # entry_id -> (numberplate, enter_ts)
+        self._stalled = {}  # entry_id -> alert
+        self._loaded = False
+        self._exited_while_loading = set()
+        self._subscribers = set()
+        self._webhook_queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="stall-detector", daemon=True)
+
+    def start(self, connect=None):
+        """Start the timer thread; with connect, first load open entries from the DB."""
+        self._connect = connect
+        self._thread.start()
+        if self.webhook_url:
+            threading.Thread(target=self._send_webhooks, name="stall-webhooks", daemon=True).start()
+        return self
+
+    # --- Events ---
+
+    def observe_enter(self, entry_id, numberplate, enter_ts):
+        with self._cond:
+            if entry_id in self._open:
+                return
+            self._open[entry_id] = (numberplate, enter_ts)
+            deadline = enter_ts + self.threshold
+            heapq.heappush(self._heap, (deadline, entry_id))
+            if self._heap[0][1] == entry_id:
+                self._cond.notify()
+
+    def observe_exit(self, entry_id, exit_ts):
+        with self._cond:
+            if not self._loaded:
+                self._exited_while_loading.add(entry_id)
+            entry = self._open.pop(entry_id, None)
+            alert = self._stalled.pop(entry_id, None)
+        if entry and alert:
+            self._emit({**alert, "event": "cleared", "exit_timestamp": exit_ts,
+                        "minutes_open": round((exit_ts - entry[1]) / 60, 2)})
+
+    def load(self, conn):
+        """Seed the heap with entries that are still open in car_entries."""
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT entry_id, numberplate, EXTRACT(EPOCH FROM enter_timestamp AT TIME ZONE 'UTC')
+                FROM car_entries
+                WHERE exit_timestamp IS NULL
+                """
+            )
+            rows = cur.fetchall()
+        conn.rollback()
+        for entry_id, numberplate, enter_ts in rows:
+            if entry_id not in self._exited_while_loading:
+                self.observe_enter(entry_id, numberplate, float(enter_ts))
+        with self._cond:
+            self._loaded = True
+            self._exited_while_loading.clear()
+            self._cond.notify()
+        logger.info("Stall detector tracking %d open entries", len(rows))
+
+    # --- Timer ---
+
+    def _due(self):
+        """Pop every entry whose deadline has passed; returns (alerts, seconds to next)."""
+        now = self._clock()
+        alerts = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, entry_id = heapq.heappop(self._heap)
+            entry = self._open.get(entry_id)
+            if entry is None or entry_id in self._stalled:
+                continue  # Exited before its deadline.
+            alert = {
+                "event": "stalled",
+                "entry_id": entry_id,
+                "numberplate": entry[0],
+                "enter_timestamp": entry[1],
+                "deadline": deadline,
+                "threshold_minutes": round(self.threshold / 60, 2),
+            }
+            self._stalled[entry_id] = alert
+            alerts.append(alert)
+        return alerts, (self._heap[0][0] - now) if self._heap else None
+
+    def _run(self):
+        retry = 1
+        while self._connect is not None and not self._loaded:
+            try:
+                conn = self._connect()
+                try:
+                    self.load(conn)
+                finally:
+                    conn.close()
+            except Exception as e:
+                logger.warning("Stall detector load failed, retrying in %ds: %s", retry, e)
+                time.sleep(retry)
+                retry = min(MAX_RETRY_SECONDS, retry * 2)
+        with self._cond:
+            self._loaded = True
+        while True:
+            with self._cond:
+                alerts, wait = self._due()
+                if not alerts:
+                    self._cond.wait(wait)
+                    continue
+            for alert in alerts:
+                self._emit(alert)
+
+    # --- Delivery ---
+
+    def _emit(self, alert):
+        if alert["event"] == "stalled":
+            logger.warning("Vehicle %s (entry %s) in lane longer than %.1f min",
+                           alert["numberplate"], alert["entry_id"], alert["threshold_minutes"])
+        else:
+            logger.info("Vehicle %s (entry %s) left after %.1f min",
+                        alert["numberplate"], alert["entry_id"], alert["minutes_open"])
+        with self._cond:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(alert)
+            except queue.Full:
+                pass  # Slow client; it can resync from /stalls.
+        if self.webhook_url:
+            self._webhook_queue.put(alert)
+
+    def _send_webhooks(self):
+        while True:
+            alert = self._webhook_queue.get()
+            body = json.dumps(alert).encode()
+            for attempt in range(WEBHOOK_ATTEMPTS):
+                req = urllib.request.Request(self.webhook_url, data=body, method="POST",
+                                             headers={"Content-Type": "application/json"})
+                try:
+                    with urllib.request.urlopen(req, timeout=WEBHOOK_TIMEOUT_SECONDS):
+                        break
+                except (urllib.error.URLError, OSError) as e:
+                    logger.warning("Stall webhook attempt %d failed: %s", attempt + 1, e)
+                    time.sleep(2 ** attempt)
+
+    def subscribe(self):
+        """Queue receiving every alert from now on; pass it to unsubscribe() when done."""
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._cond:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._cond:
+            self._subscribers.discard(q)
+
+    def stalled(self):
+        """Entries currently past their deadline, oldest first."""
+        with self._cond:
+            return sorted(self._stalled.values(), key=lambda a: a["enter_timestamp"])
+
+    def stats(self):
+        with self._cond:
+            return {"open": len(self._open), "stalled": len(self._stalled), "heap": len(self._heap),
+                    "loaded": self._loaded}
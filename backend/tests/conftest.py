@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class FakeConnection:
+    """
+    DB-API connection stand-in for tests that don't need Postgres. respond(sql, params)
+    is called for every execute() with whitespace-collapsed SQL and returns the result
+    rows (or None); it may raise to simulate a server error. Each execute() sleeps for
+    `delay` seconds first. Statements, commits and rollbacks are recorded.
+    """
+
+    def __init__(self, respond=None, delay=0.0):
+        self.respond = respond or (lambda sql, params: None)
+        self.delay = delay
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        self.connection.statements.append((sql, params))
+        if self.connection.delay:
+            time.sleep(self.connection.delay)
+        self._rows = list(self.connection.respond(sql, params) or [])
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+@pytest.fixture
+def pg_conn():
+    """Connection to TEST_DATABASE_URL with search_path set to a throwaway schema."""
+    url = os.environ.get("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("set TEST_DATABASE_URL to run Postgres-backed tests")
+    import psycopg2
+
+    conn = psycopg2.connect(url)
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"SET search_path TO {schema}, public")
+    conn.commit()
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+@pytest.fixture
+def pg_connect(pg_conn):
+    """Opens more connections to pg_conn's schema, for tests with concurrent transactions."""
+    import psycopg2
+
+    with pg_conn.cursor() as cur:
+        cur.execute("SHOW search_path")
+        search_path = cur.fetchone()[0]
+    pg_conn.commit()
+    opened = []
+
+    def connect():
+        conn = psycopg2.connect(os.environ["TEST_DATABASE_URL"])
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {search_path}")
+        conn.commit()
+        opened.append(conn)
+        return conn
+
+    yield connect
+    for conn in opened:
+        conn.close()
+
+
+@pytest.fixture
+def car_entries_db(pg_conn):
+    """pg_conn with car_entries plus the emission-factor and rollup triggers installed."""
+    import create_car_entries_table
+    import emission_factors
+    import rollups
+
+    with pg_conn.cursor() as cur:
+        cur.execute(create_car_entries_table.CAR_ENTRIES_SQL)
+    pg_conn.commit()
+    emission_factors.ensure_schema(pg_conn)
+    rollups.ensure_schema(pg_conn)
+    return pg_conn
+
+
+@pytest.fixture
+def plates_db(car_entries_db):
+    """car_entries_db plus the plate_stats trigger (search indexes need pg_trgm)."""
+    import psycopg2
+    import plates
+
+    try:
+        plates.ensure_schema(car_entries_db)
+    except psycopg2.errors.FeatureNotSupported:
+        pass  # Tables and trigger are committed before the indexes.
+    return car_entries_db
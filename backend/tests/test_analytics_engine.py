@@ -0,0 +1,187 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from analytics_engine import ColumnarAnalytics
+from conftest import FakeConnection
+
+TZ = "America/Los_Angeles"
+# Los Angeles springs forward at 2026-03-08 10:00 UTC and falls back at 2026-11-01 09:00 UTC.
+A = (1, datetime(2026, 3, 8, 9, 30), 4.99, 1000)  # 01:30 PST, Sunday
+B = (2, datetime(2026, 3, 8, 10, 30), 5.0, 2000)  # 03:30 PDT, Sunday (02:xx never happens)
+C = (3, datetime(2026, 11, 1, 8, 30), 9.99, 1200)  # 01:30 PDT, Sunday
+D = (4, datetime(2026, 11, 1, 9, 30), 10.0, 900)  # 01:30 PST, the repeated hour
+
+
+def _row(entry_id, enter, minutes, carbon, closed=True):
+    exit_ts = enter + timedelta(minutes=minutes) if closed else None
+    return entry_id, enter, exit_ts, minutes if closed else None, minutes * 12 if closed else None, \
+        carbon if closed else None
+
+
+class _FakeDatabase:
+    """Answers the engine's two queries: the active factor version, then car_entries rows."""
+
+    def __init__(self, rows, version=1, block=None):
+        self.rows = rows
+        self.version = version
+        self.block = block
+        self.queries = []
+
+    def __call__(self, sql, params):
+        if "emission_factor_sets" in sql:
+            return [(self.version,)]
+        self.queries.append(params)
+        if self.block:
+            self.block.wait(5)
+        watermark, open_ids = params
+        return [r for r in self.rows if r[0] > watermark or r[0] in open_ids]
+
+
+def _engine(rows=None):
+    engine = ColumnarAnalytics(refresh_seconds=0)
+    engine.refresh(FakeConnection(_FakeDatabase(rows if rows is not None else [_row(*e) for e in (A, B, C, D)])))
+    return engine
+
+
+def test_hotspots_grid_buckets_local_hours_across_dst():
+    grid = _engine().hotspots_grid(tz=TZ)
+    assert grid[6][1] == 3.1  # A, C and D: 01:xx local on Sundays.
+    assert grid[6][3] == 2.0  # B: the skipped 02:00 hour doesn't exist.
+    assert sum(map(sum, grid)) == pytest.approx(5.1)
+
+
+def test_peak_hour_merges_repeated_fall_back_hour():
+    # C and D are both 2026-11-01 01:xx local (1.2 + 0.9 kg) and beat B's 2.0 kg alone.
+    assert _engine().peak_hour(hours=None, tz=TZ) == "01:00-02:00"
+    assert _engine([_row(*e) for e in (A, B, C)]).peak_hour(hours=None, tz=TZ) == "03:00-04:00"
+    assert _engine([]).peak_hour(hours=None, tz=TZ) == ""
+
+
+def test_utc_hour_buckets():
+    now = datetime(2026, 3, 8, 11, 0, tzinfo=timezone.utc).timestamp()
+    engine = _engine([_row(*A), _row(*B)])
+    rows = engine.metrics_last_hours(hours=2, now=now)
+    assert [(r[0], r[1]) for r in rows] == [(datetime(2026, 3, 8, 10), 1), (datetime(2026, 3, 8, 9), 1)]
+    assert rows[0][2:] == pytest.approx((5.0, 2.0, 60.0))
+    assert engine.hourly_trends(hours=2, now=now) == [
+        {"hour": "09:00", "total_cars": 1, "total_idle_seconds": 299},
+        {"hour": "10:00", "total_cars": 1, "total_idle_seconds": 300},
+    ]
+    assert engine.all_time_metrics(hours=2, now=now) == pytest.approx((2, 4.995, 3.0, 119.88))
+
+
+def test_idle_distribution_bucket_edges():
+    assert [r["count"] for r in _engine().idle_distribution()] == [1, 2, 1]
+
+
+def test_refresh_is_incremental_and_tracks_open_entries():
+    rows = [_row(*A), _row(*B, closed=False)]
+    db = _FakeDatabase(rows)
+    conn = FakeConnection(db)
+    engine = ColumnarAnalytics()
+    assert engine.refresh(conn) == 1
+    assert engine.cars_in_drive_through == 1
+    rows[1] = _row(*B)
+    rows.append(_row(*C))
+    assert engine.refresh(conn) == 2
+    assert db.queries[-1] == (2, [2])
+    assert engine.cars_in_drive_through == 0
+    db.version = 2  # New emission factors: reload everything.
+    assert engine.refresh(conn) == 3
+    assert db.queries[-1] == (0, [])
+    assert engine.all_time_metrics(hours=None)[0] == 3
+
+
+def test_refresh_rechecks_ids_that_commit_out_of_order(monkeypatch):
+    rows = [_row(*A), _row(*C, closed=False)]  # Entry 2 has its id but hasn't committed yet.
+    db = _FakeDatabase(rows)
+    engine = ColumnarAnalytics()
+    assert engine.refresh(FakeConnection(db)) == 1
+    rows.insert(1, _row(*B))
+    rows.append(_row(*D))
+    assert engine.refresh(FakeConnection(db)) == 2
+    assert db.queries[-1][0] == 3 and sorted(db.queries[-1][1]) == [2, 3]
+    assert engine.all_time_metrics(hours=None)[0] == 3 and engine.cars_in_drive_through == 1
+    assert engine.refresh(FakeConnection(db)) == 0
+    assert db.queries[-1] == (4, [3])  # Found, so no longer a gap.
+
+    rows.append(_row(6, datetime(2026, 11, 2), 3, 100))  # 5 was rolled back: given up on.
+    monkeypatch.setattr("analytics_engine._GAP_SECONDS", 0)
+    engine.refresh(FakeConnection(db))
+    engine.refresh(FakeConnection(db))
+    assert db.queries[-1] == (6, [3])
+
+
+def test_refresh_if_stale_is_single_flight_and_does_not_block_readers():
+    engine = _engine()
+    block = threading.Event()
+    slow = _FakeDatabase([_row(*e) for e in (A, B, C, D)] + [_row(5, datetime(2026, 11, 2), 3, 100)], block=block)
+    worker = threading.Thread(target=engine.refresh_if_stale, args=(lambda: FakeConnection(slow),))
+    worker.start()
+    while not slow.queries:
+        time.sleep(0.001)  # Wait until the worker is inside the car_entries query.
+    connects = []
+    assert engine.refresh_if_stale(lambda: connects.append(1)) == 0
+    assert connects == []
+    assert engine.all_time_metrics(hours=None)[0] == 4  # Readers see the current snapshot.
+    block.set()
+    worker.join(5)
+    assert engine.all_time_metrics(hours=None)[0] == 5
+
+
+# --- Parity with the SQL helpers in app.py (Postgres) ---
+
+@pytest.fixture
+def parity_rows(car_entries_db):
+    """Closed entries over the last ~16 h plus the DST rows above, one open entry."""
+    conn = car_entries_db
+    with conn.cursor() as cur:
+        cur.execute("SET TIME ZONE 'UTC'")
+        cur.execute("SELECT LOCALTIMESTAMP")
+        now = cur.fetchone()[0]
+        rows = [(now - timedelta(minutes=23 * i + 7), 2 + (7 * i) % 13 + i / 100) for i in range(40)]
+        rows += [(enter, minutes) for _, enter, minutes, _ in (A, B, C, D)]
+        for enter, minutes in rows:
+            cur.execute(
+                "INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp) VALUES ('P', %s, %s)",
+                (enter, enter + timedelta(minutes=minutes)),
+            )
+        cur.execute("INSERT INTO car_entries (numberplate, enter_timestamp) VALUES ('OPEN', %s)", (now,))
+    conn.commit()
+    return conn
+
+
+def test_columnar_matches_sql_helpers(parity_rows):
+    import app
+
+    conn = parity_rows
+    engine = ColumnarAnalytics()
+    engine.refresh(conn)  # Same transaction as the helpers below, so NOW() matches `now`.
+    with conn.cursor() as cur:
+        cur.execute("SELECT EXTRACT(EPOCH FROM NOW())")
+        now = float(cur.fetchone()[0])
+    assert engine.cars_in_drive_through == 1
+
+    sql_hours = [(r[0], r[1], *map(float, r[2:])) for r in app._get_metrics_last_hours(conn, hours=24)]
+    col_hours = engine.metrics_last_hours(hours=24, now=now)
+    assert [r[:2] for r in col_hours] == [r[:2] for r in sql_hours]
+    assert [v for r in col_hours for v in r[2:]] == pytest.approx([v for r in sql_hours for v in r[2:]], abs=1e-6)
+
+    for hours in (2, 24, None):
+        sql_all = app._get_all_time_metrics(conn, hours=hours)
+        col_all = engine.all_time_metrics(hours=hours, now=now)
+        assert col_all[0] == sql_all[0]
+        assert col_all[1:] == pytest.approx([float(v) for v in sql_all[1:]], abs=1e-6)
+
+    for tz in (TZ, "Europe/London", "Asia/Kolkata"):
+        for hours in (168, None):
+            assert engine.peak_hour(hours=hours, tz=tz, now=now) == app._get_peak_hour(conn, hours=hours, tz=tz)
+        sql_grid, col_grid = app._get_hotspots_grid(conn, tz=tz), engine.hotspots_grid(tz=tz)
+        assert [v for row in col_grid for v in row] == pytest.approx([v for row in sql_grid for v in row], abs=0.011)
+
+    assert engine.idle_distribution() == app._get_idle_distribution(conn)
+    key = lambda r: (r["hour"], r["total_cars"])  # noqa: E731
+    assert sorted(engine.hourly_trends(now=now), key=key) == sorted(app._get_hourly_trends(conn), key=key)
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import emission_factors
+
+T0 = datetime(2026, 3, 1, 8, 0)
+FACTORS = [
+    {"fuel_g_per_min": 10, "co2_g_per_min": 20},
+    {"effective_from": "2026-02-01", "fuel_g_per_min": 15, "co2_g_per_min": 30},
+    {"vehicle_class": "truck", "effective_from": "2026-01-01", "fuel_g_per_min": 30, "co2_g_per_min": 60},
+    {"site": "S1", "fuel_g_per_min": 11, "co2_g_per_min": 22},
+    {"vehicle_class": "truck", "site": "S1", "effective_from": "2026-06-01", "fuel_g_per_min": 40,
+     "co2_g_per_min": 80},
+]
+
+
+def _factor(conn, version, vehicle_class, site, ts):
+    with conn.cursor() as cur:
+        cur.execute("SELECT version, fuel_g_per_min FROM emission_factor_for(%s, %s, %s, %s)",
+                    (version, vehicle_class, site, ts))
+        row = cur.fetchone()
+    conn.rollback()
+    return row and (row[0], float(row[1]))
+
+
+@pytest.mark.parametrize("vehicle_class, site, ts, fuel", [
+    ("car", "X", datetime(2026, 1, 15), 10),  # default/default, before the February row
+    ("car", "X", datetime(2026, 3, 1), 15),  # latest effective_from <= enter time
+    ("truck", "X", datetime(2025, 12, 31), 10),  # truck row not yet effective
+    ("truck", "X", datetime(2026, 3, 1), 30),
+    ("car", "S1", datetime(2026, 3, 1), 11),  # site match beats a newer default/default row
+    ("truck", "S1", datetime(2026, 3, 1), 30),  # class match ranks above site match
+    ("truck", "S1", datetime(2026, 7, 1), 40),
+])
+def test_emission_factor_for_falls_back_to_default(car_entries_db, vehicle_class, site, ts, fuel):
+    version = emission_factors.create_version(car_entries_db, FACTORS)
+    assert _factor(car_entries_db, version, vehicle_class, site, ts) == (version, fuel)
+
+
+def test_trigger_uses_active_version(car_entries_db):
+    conn = car_entries_db
+    emission_factors.create_version(conn, FACTORS)  # A draft: not used until published.
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp, vehicle_class)
+            VALUES ('AB12', %s, %s, 'truck')
+            RETURNING fuel_used, carbon_produced, factor_version, fuel_used_next
+        """, (T0, T0 + timedelta(minutes=10)))
+        assert cur.fetchone() == (120, 270, emission_factors.get_active_version(conn), None)
+    conn.commit()
+
+
+def test_create_version_requires_default_row(car_entries_db):
+    conn = car_entries_db
+    with pytest.raises(ValueError, match="vehicle_class='default', site='default'"):
+        emission_factors.create_version(conn, [{"vehicle_class": "truck", "fuel_g_per_min": 30,
+                                                "co2_g_per_min": 60}])
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM emission_factor_sets")
+        assert cur.fetchone() == (1,)
+
+
+def test_resumed_job_only_processes_unfinished_chunks(car_entries_db, pg_connect):
+    conn = car_entries_db
+    with conn.cursor() as cur:
+        for i in range(20):
+            enter = T0 + timedelta(minutes=5 * i)
+            cur.execute(
+                "INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp, vehicle_class) "
+                "VALUES (%s, %s, %s, %s)",
+                (f"AB{i:02d}", enter, enter + timedelta(minutes=2), "truck" if i % 2 else "car"),
+            )
+    conn.commit()
+    version = emission_factors.create_version(conn, FACTORS)
+    job_id = emission_factors.start_job(conn, version, chunk_size=5)
+    with pytest.raises(ValueError, match="already running"):
+        emission_factors.start_job(conn, version)
+
+    # First run: chunks 0 and 1 finish, then a worker dies part-way through chunk 2.
+    with conn.cursor() as cur:
+        cur.execute("UPDATE emission_recompute_chunks SET status = 'hold' WHERE job_id = %s AND chunk_no >= 2",
+                    (job_id,))
+    conn.commit()
+    assert emission_factors.process_chunks(conn, job_id) == 2
+    with conn.cursor() as cur:
+        cur.execute("UPDATE emission_recompute_chunks SET status = 'pending' WHERE status = 'hold'")
+        cur.execute("SELECT chunk_no, finished_at FROM emission_recompute_chunks WHERE status = 'done'")
+        finished = sorted(cur.fetchall())
+    conn.commit()
+    crashed = pg_connect()
+    with crashed.cursor() as cur:
+        cur.execute("SELECT start_id, end_id FROM emission_recompute_chunks WHERE job_id = %s AND chunk_no = 2",
+                    (job_id,))
+        cur.execute(emission_factors._CHUNK_UPDATE_SQL, (version, *cur.fetchone()))
+    crashed.close()  # Uncommitted: chunk 2 stays pending.
+    assert not emission_factors.publish(conn, job_id)
+
+    status = emission_factors.job_status(conn, job_id)
+    assert (status["done_chunks"], status["total_chunks"], status["progress"]) == (2, 4, 0.5)
+    assert emission_factors.process_chunks(pg_connect(), job_id) == 2
+    with conn.cursor() as cur:
+        cur.execute("SELECT chunk_no, finished_at FROM emission_recompute_chunks WHERE chunk_no < 2")
+        assert sorted(cur.fetchall()) == finished
+    conn.commit()
+
+    assert emission_factors.publish(conn, job_id)
+    assert emission_factors.get_active_version(conn) == version
+    with conn.cursor() as cur:
+        cur.execute("SELECT vehicle_class, fuel_used, factor_version, COUNT(*) FROM car_entries GROUP BY 1, 2, 3")
+        assert sorted(cur.fetchall()) == [("car", 30, version, 10), ("truck", 60, version, 10)]
+    assert emission_factors.job_status(conn, job_id)["status"] == "done"
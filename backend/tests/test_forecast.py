@@ -0,0 +1,100 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import forecast
+from conftest import FakeConnection
+from forecast import HourOfWeekForecaster
+
+H0 = int(datetime(2026, 3, 2, 17, tzinfo=timezone.utc).timestamp()) // 3600  # Mon 09:00 in LA
+
+
+def test_hour_rollover_folds_in_empty_hours():
+    model = HourOfWeekForecaster()
+    assert not model.observe_enter(H0 * 3600 + 60)
+    assert not model.observe_enter(H0 * 3600 + 120)
+    assert not model.observe_exit(H0 * 3600 + 600, 8, 216)
+    assert model.observe_enter((H0 + 3) * 3600 + 5)  # Closes H0 and the two empty hours after it.
+
+    assert model.hours_seen == 3 and model.current_hour == H0 + 3
+    assert model.current == {"cars": 1.0, "idle_minutes": 0.0, "co2_kg": 0.0}
+    # cars: y = 2, 0, 0 with alpha 0.1, gamma 0.3, beta 0.1.
+    assert model.level["cars"] == pytest.approx(0.162)
+    assert model.season["cars"][model.hour_of_week(H0)] == pytest.approx(0.54)
+    assert model.season["cars"][model.hour_of_week(H0 + 1)] == pytest.approx(-0.054)
+    assert model.season["cars"][model.hour_of_week(H0 + 2)] == pytest.approx(-0.0486)
+    assert model.variance["cars"] == pytest.approx(0.00684)
+    assert model.level["co2_kg"] == pytest.approx(0.0216 * 0.81)
+
+
+def test_hour_of_week_is_local():
+    model = HourOfWeekForecaster(tz="America/Los_Angeles")
+    assert model.hour_of_week(H0) == 9  # Monday 09:00
+    assert HourOfWeekForecaster(tz="UTC").hour_of_week(H0) == 17
+
+
+def test_state_round_trips_through_json(tmp_path):
+    model = HourOfWeekForecaster(tz="Europe/London", alpha=0.2)
+    for h in range(30):
+        model.observe_enter((H0 + h) * 3600 + 10)
+        model.observe_exit((H0 + h) * 3600 + 900, 5 + h % 4, 135)
+
+    restored = HourOfWeekForecaster.from_dict(json.loads(json.dumps(model.to_dict())))
+    assert restored.to_dict() == model.to_dict()
+    assert restored.predict(H0 + 40) == model.predict(H0 + 40)
+
+    path = tmp_path / "state.json"
+    model.save(path)
+    assert HourOfWeekForecaster.load(path).to_dict() == model.to_dict()
+    assert [p.name for p in tmp_path.iterdir()] == ["state.json"]
+
+
+def _history(hours):
+    """One car per hour, entering at :01 and leaving at :10 (9 minutes, 243 g CO2)."""
+    enters = [(datetime.fromtimestamp(h * 3600 + 60, timezone.utc).replace(tzinfo=None),)
+              for h in range(H0, H0 + hours)]
+    exits = [(datetime.fromtimestamp(h * 3600 + 600, timezone.utc).replace(tzinfo=None), 9, 243)
+             for h in range(H0, H0 + hours)]
+
+    def respond(sql, params):
+        assert params == (0.0,)
+        return enters if sql.startswith("SELECT enter_timestamp") else exits
+    return FakeConnection(respond)
+
+
+def test_backtest_scores_hours_after_warmup():
+    report = forecast.backtest(_history(336), warmup_hours=168)
+    # Hour k is scored with k hours folded in; the last hour never closes.
+    assert report["hours_evaluated"] == 336 - 1 - 168
+    assert set(report) == {"hours_evaluated", *forecast.SERIES}
+    for name in forecast.SERIES:
+        assert report[name]["rmse"] >= report[name]["mae"] > 0
+    assert report["cars"]["mae"] < 0.1  # A flat series is learned within the warmup.
+
+
+def test_backtest_without_history():
+    assert forecast.backtest(FakeConnection()) == {"hours_evaluated": 0}
+
+
+def test_failed_state_save_does_not_fail_a_committed_enter(monkeypatch):
+    import admission
+    import app as app_module
+
+    class ReadOnlyState(HourOfWeekForecaster):
+        def save(self, path=None):
+            raise OSError(30, "Read-only file system")
+
+    model = ReadOnlyState()
+    model.observe_enter(H0 * 3600)  # Any enter now closes an hour and saves.
+    entered = datetime(2026, 3, 2, 18, 0, 1)
+    conn = FakeConnection(lambda sql, params: [(7, params[0], entered)])
+    monkeypatch.setattr(app_module, "_background_started", True)
+    monkeypatch.setattr(app_module, "_forecaster", model)
+    monkeypatch.setattr(app_module, "get_connection", lambda: conn)
+    monkeypatch.setattr(admission, "buckets", admission.TokenBucketRegistry(rate=1000, burst=1000))
+
+    response = app_module.app.test_client().post("/car-entries/enter", json={"numberplate": "AB12"})
+    assert response.status_code == 200
+    assert response.get_json()["entry_id"] == 7
+    assert conn.commits == 1 and model.current["cars"] == 1
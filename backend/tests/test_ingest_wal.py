@@ -0,0 +1,133 @@
+"""Write-behind ingest log: replay, torn writes and bad-event quarantine (no Postgres needed)."""
+import json
+
+import psycopg2
+import psycopg2.errors
+import pytest
+
+from conftest import FakeConnection
+from ingest_wal import WriteBehindIngest
+
+
+def _no_db():
+    raise AssertionError("flusher must not connect in these tests")
+
+
+def _open(path):
+    return WriteBehindIngest(_no_db, path=path)
+
+
+def test_replays_unflushed_events(tmp_path):
+    path = tmp_path / "ingest.wal"
+    wal = _open(path)
+    for plate in ("A1", "A2", "A3"):
+        wal.append("enter", numberplate=plate)
+    wal.close()
+
+    reopened = _open(path)
+    assert [r["seq"] for r in reopened._pending] == [1, 2, 3]
+    assert [r["numberplate"] for r in reopened._pending] == ["A1", "A2", "A3"]
+
+
+def test_replay_skips_checkpointed_events(tmp_path):
+    path = tmp_path / "ingest.wal"
+    wal = _open(path)
+    for plate in ("A1", "A2", "A3"):
+        wal.append("enter", numberplate=plate)
+    wal._checkpoint(2)
+    wal.close()
+
+    assert [r["seq"] for r in _open(path)._pending] == [3]
+
+
+def test_torn_write_is_truncated_before_appending(tmp_path):
+    path = tmp_path / "ingest.wal"
+    wal = _open(path)
+    for plate in ("A1", "A2", "A3"):
+        wal.append("enter", numberplate=plate)
+    wal.close()
+    with open(path, "a") as fh:
+        fh.write('{"seq": 4, "kind": "ent')  # Crash mid-append: never acknowledged.
+
+    wal = _open(path)
+    assert [r["seq"] for r in wal._pending] == [1, 2, 3]
+    wal.append("enter", numberplate="B4")
+    wal.append("exit")
+    wal.close()
+
+    replayed = _open(path)._pending
+    assert [r["seq"] for r in replayed] == [1, 2, 3, 4, 5]
+    assert replayed[3]["numberplate"] == "B4"
+    assert replayed[4]["kind"] == "exit"
+
+
+def test_torn_header_starts_a_new_log(tmp_path):
+    path = tmp_path / "ingest.wal"
+    path.write_text('{"wal_id": "ab')
+
+    wal = _open(path)
+    assert wal.wal_id and wal._pending == []
+    wal.append("exit")
+    wal.close()
+    assert [r["seq"] for r in _open(path)._pending] == [1]
+
+
+class _FakeDatabase:
+    """Answers the flusher's statements: checkpoint read, inserts, checkpoint update."""
+
+    def __init__(self):
+        self.db_seq = 0
+        self.next_id = 0
+
+    def __call__(self, sql, params):
+        if sql.startswith("SELECT last_seq"):
+            return [(self.db_seq,)]
+        if sql.startswith("INSERT INTO car_entries"):
+            plate = params[0]
+            if not isinstance(plate, str):
+                raise psycopg2.ProgrammingError(f"can't adapt type '{type(plate).__name__}'")
+            if len(plate) > 20:
+                raise psycopg2.errors.StringDataRightTruncation("value too long for type character varying(20)")
+            self.next_id += 1
+            return [(self.next_id, plate, params[1])]
+        if sql.startswith("UPDATE ingest_wal_checkpoints"):
+            self.db_seq = max(self.db_seq, params[0])
+        return None
+
+
+def test_bad_events_are_quarantined_not_retried(tmp_path):
+    path = tmp_path / "ingest.wal"
+    applied = []
+    wal = WriteBehindIngest(_no_db, path=path, on_applied=lambda kind, row: applied.append(row[1]))
+    wal.append("enter", numberplate="GOOD1")
+    wal.append("enter", numberplate="X" * 40)
+    wal.append("enter", numberplate={"not": "scalar"})
+    wal.append("enter", numberplate="GOOD2")
+
+    db = _FakeDatabase()
+    conn = FakeConnection(db)
+    assert wal.flush_once(conn) == 4
+    assert applied == ["GOOD1", "GOOD2"]
+    assert db.db_seq == 4 and wal.flushed_seq == 4 and wal.backlog() == 0
+    assert ("ROLLBACK TO SAVEPOINT ingest_event", None) in conn.statements
+    quarantined = [json.loads(line) for line in wal.quarantine_path.read_text().splitlines()]
+    assert [q["seq"] for q in quarantined] == [2, 3]
+
+
+def test_schema_errors_are_retried_not_quarantined(tmp_path):
+    wal = _open(tmp_path / "ingest.wal")
+    wal.append("enter", numberplate="GOOD1")
+
+    class UndefinedTable(psycopg2.errors.UndefinedTable):
+        pgcode = "42P01"  # Raised by the server, so it carries a SQLSTATE.
+
+    db = _FakeDatabase()
+
+    def missing_table(sql, params):
+        if sql.startswith("INSERT INTO car_entries"):
+            raise UndefinedTable('relation "car_entries" does not exist')
+        return db(sql, params)
+
+    with pytest.raises(psycopg2.ProgrammingError):
+        wal.flush_once(FakeConnection(missing_table))
+    assert wal.backlog() == 1 and not wal.quarantine_path.exists()
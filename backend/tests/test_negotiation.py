@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+import negotiation
+
+
+@pytest.fixture
+def with_brotli(monkeypatch):
+    monkeypatch.setattr(negotiation, "brotli", object())  # choose_encoding only checks presence.
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, deflate, br", "br"),
+    ("br;q=0.5, gzip", "gzip"),
+    ("gzip;q=0.2, br;q=0.9", "br"),
+    ("br;q=0, gzip;q=0.1", "gzip"),
+    ("identity, gzip;q=0.5", "identity"),
+    ("*", "br"),
+    ("*;q=0.5, gzip", "gzip"),
+    ("br;q=0.8", "br"),
+    ("deflate", "identity"),
+    ("gzip;q=0, br;q=0", "identity"),
+    (None, "identity"),
+])
+def test_choose_encoding_follows_qvalues(with_brotli, header, expected):
+    assert negotiation.choose_encoding(header) == expected
+
+
+def test_choose_encoding_without_brotli(monkeypatch):
+    monkeypatch.setattr(negotiation, "brotli", None)
+    assert negotiation.choose_encoding("br, gzip;q=0.1") == "gzip"
+    assert negotiation.choose_encoding("br") == "identity"
+
+
+def test_msgpack_falls_back_to_json_when_larger():
+    msgpack = pytest.importorskip("msgpack")
+    floats = (json.dumps({"grid": [[1.25, 3.5, 0.75] * 8] * 7}, separators=(",", ":")) + "\n").encode()
+    body, content_type, _ = negotiation.encode(floats, negotiation.MSGPACK)
+    assert (body, content_type) == (floats, negotiation.JSON)
+
+    rows = (json.dumps([{"numberplate": f"AB{i:02d} CDE", "cars": i} for i in range(20)]) + "\n").encode()
+    body, content_type, _ = negotiation.encode(rows, negotiation.MSGPACK)
+    assert content_type == negotiation.MSGPACK and len(body) < len(rows)
+    assert msgpack.unpackb(body) == json.loads(rows)
@@ -0,0 +1,72 @@
+"""Offset purchase batches: retries must reuse the batch and its idempotency key."""
+import pytest
+
+import admission
+import offset_purchases
+from offset_purchases import ProviderError
+
+
+class FlakyProvider:
+    """Completes every purchase but loses the first response (like a client timeout)."""
+
+    def __init__(self):
+        self.calls = []
+
+    def purchase(self, batch_id, co2_kg):
+        self.calls.append((batch_id, co2_kg))
+        if len(self.calls) == 1:
+            raise ProviderError("timed out")
+        return {"reference": f"ref-{batch_id}", "co2_kg": co2_kg}
+
+
+def _make_due(conn):
+    with conn.cursor() as cur:
+        cur.execute("UPDATE offset_purchase_batches SET next_attempt_at = NOW() - INTERVAL '1 second'")
+    conn.commit()
+
+
+def test_retry_resends_same_batch_and_key(pg_conn):
+    offset_purchases.ensure_schema(pg_conn)
+    for credits in (1.5, 2.5, 3):
+        offset_purchases.enqueue(pg_conn, credits)
+    provider = FlakyProvider()
+
+    assert offset_purchases.process_batch(pg_conn, provider) == 0
+    offset_purchases.enqueue(pg_conn, 10)  # Arrives while the first batch waits to retry.
+    _make_due(pg_conn)
+    assert offset_purchases.process_batch(pg_conn, provider) == 1
+
+    first, retry = provider.calls[:2]
+    assert first == retry == (first[0], 7.0)
+    assert offset_purchases.get_balance(pg_conn) == 7.0
+
+    assert offset_purchases.process_batch(pg_conn, provider) == 1
+    assert provider.calls[2][0] != first[0] and provider.calls[2][1] == 10.0
+    assert offset_purchases.get_balance(pg_conn) == 17.0
+
+
+def test_stale_submitted_batch_is_requeued_under_same_key(pg_conn):
+    offset_purchases.ensure_schema(pg_conn)
+    offset_purchases.enqueue(pg_conn, 4)
+    batch_id, co2_kg = offset_purchases._claim_batch(pg_conn)  # Worker crashes after claiming.
+    with pg_conn.cursor() as cur:
+        cur.execute("UPDATE offset_purchase_batches SET updated_at = NOW() - INTERVAL '1 hour'")
+    pg_conn.commit()
+
+    provider = FlakyProvider()
+    provider.calls.append(None)  # Succeed on the next call.
+    assert offset_purchases.process_batch(pg_conn, provider) == 1
+    assert provider.calls[1] == (batch_id, co2_kg)
+
+
+@pytest.mark.parametrize("body", [b'{"credits": "nan"}', b'{"credits": NaN}', b'{"credits": "inf"}'])
+def test_purchase_rejects_non_finite_credits(monkeypatch, body):
+    import app as app_module
+
+    monkeypatch.setattr(app_module, "_background_started", True)
+    monkeypatch.setattr(admission, "write_buckets", admission.TokenBucketRegistry(rate=1000, burst=1000))
+    monkeypatch.setattr(app_module, "get_connection", lambda: pytest.fail("must not reach the database"))
+    response = app_module.app.test_client().post(
+        "/carbon-neutral/purchase", data=body, content_type="application/json")
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Invalid credits value"}
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import plates
+
+T0 = datetime(2026, 3, 2, 12, 0)
+VISITS = ["AB12 CDE", "ab12cde", "XY99 ZZZ", "AB12CDE", "QQ11 QQQ", "xy99zzz"]
+
+
+def _insert_visits(conn):
+    with conn.cursor() as cur:
+        for i, plate in enumerate(VISITS):
+            enter = T0 + timedelta(minutes=10 * i)
+            cur.execute(
+                "INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp) VALUES (%s, %s, %s)",
+                (plate, enter, enter + timedelta(minutes=4) if i != 4 else None),
+            )
+    conn.commit()
+
+
+def _stats(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT numberplate, visit_count, closed_visits, total_co2_g FROM plate_stats ORDER BY 1")
+        return cur.fetchall()
+
+
+def test_normalize_plate_matches_plate_key():
+    assert plates.normalize_plate(" ab12\tcde ") == "AB12CDE"
+    assert plates.normalize_plate(None) == ""
+
+
+def test_repeat_visitors_sum_counter_shards(plates_db):
+    _insert_visits(plates_db)
+    stats = plates.repeat_visitors(plates_db)
+    assert (stats["unique_plates"], stats["total_visits"]) == (3, 6)
+    assert stats["repeat_plate_share"] == round(2 / 3, 4)
+    assert stats["repeat_visit_share"] == round(5 / 6, 4)
+    assert [p["numberplate"] for p in stats["top_repeat_visitors"]] == ["AB12CDE", "XY99ZZZ"]
+
+
+def test_rebuild_returns_plate_count_and_keeps_counters(plates_db):
+    _insert_visits(plates_db)
+    before, summary = _stats(plates_db), plates.repeat_visitors(plates_db)
+    assert plates.rebuild(plates_db) == 3
+    assert _stats(plates_db) == before
+    assert plates.repeat_visitors(plates_db) == summary
+
+
+def test_recompute_co2_in_batches(plates_db):
+    _insert_visits(plates_db)
+    with plates_db.cursor() as cur:  # As if new emission factors were published.
+        cur.execute("UPDATE car_entries SET carbon_produced = carbon_produced * 2")
+    plates_db.commit()
+    before = _stats(plates_db)
+    assert plates.recompute_co2(plates_db, batch_size=2) == 3
+    after = _stats(plates_db)
+    assert [r[:3] for r in after] == [r[:3] for r in before]
+    assert [r[3] for r in after] == [2 * r[3] for r in before]
+
@@ -0,0 +1,150 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import emission_factors
+import rollups
+
+T0 = datetime(2026, 3, 1, 8, 0)
+
+
+def _rollups(conn, table="emission_rollups"):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT resolution_minutes, bucket_start, cars, co2_g, fuel_g FROM {table}
+            WHERE cars <> 0 ORDER BY 1, 2
+        """)
+        return cur.fetchall()
+
+
+def _expected(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT res, rollup_bucket(exit_timestamp, res), COUNT(*),
+                   COALESCE(SUM(carbon_produced), 0), COALESCE(SUM(fuel_used), 0)
+            FROM car_entries CROSS JOIN UNNEST(%s) AS res
+            WHERE exit_timestamp IS NOT NULL
+            GROUP BY 1, 2 ORDER BY 1, 2
+        """, (list(rollups.RESOLUTIONS_MINUTES),))
+        return cur.fetchall()
+
+
+def _wait_for_lock(conn, other):
+    """Block until `other`'s backend is waiting on a lock."""
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with conn.cursor() as cur:
+            cur.execute("SELECT wait_event_type FROM pg_stat_activity WHERE pid = %s", (other.get_backend_pid(),))
+            waiting = cur.fetchone() == ("Lock",)
+        conn.rollback()
+        if waiting:
+            return
+        time.sleep(0.01)
+    raise AssertionError("backend never waited on a lock")
+
+
+def test_choose_resolution_picks_finest_that_fits():
+    assert rollups.choose_resolution(60, 500) == 1
+    assert rollups.choose_resolution(24 * 60, 500) == 15
+    assert rollups.choose_resolution(24 * 60, 100, lttb=True) == 15
+    assert rollups.choose_resolution(365 * 24 * 60, 500) == 1440
+
+
+def test_lttb_keeps_endpoints_and_peak():
+    points = [{"t": i, "v": 100 if i == 37 else 0} for i in range(100)]
+    sampled = rollups.lttb(points, 10, "v")
+    assert len(sampled) == 10
+    assert sampled[0] is points[0] and sampled[-1] is points[-1]
+    assert points[37] in sampled
+
+
+def test_recompute_swaps_rollups_built_for_new_factors(car_entries_db):
+    conn = car_entries_db
+    with conn.cursor() as cur:
+        for i in range(30):
+            enter = T0 + timedelta(minutes=7 * i)
+            cur.execute(
+                "INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp) VALUES (%s, %s, %s)",
+                (f"AB{i:02d}", enter, enter + timedelta(minutes=3 + i % 5) if i % 4 else None),
+            )
+    conn.commit()
+    version = emission_factors.create_version(conn, [{"fuel_g_per_min": 20, "co2_g_per_min": 50}])
+    job_id = emission_factors.start_job(conn, version, chunk_size=8)
+
+    # Half the chunks, then exits on both sides of the processed range, then the rest.
+    with conn.cursor() as cur:
+        cur.execute("UPDATE emission_recompute_chunks SET status = 'hold' WHERE job_id = %s AND chunk_no >= 2",
+                    (job_id,))
+    conn.commit()
+    emission_factors.process_chunks(conn, job_id)
+    with conn.cursor() as cur:
+        cur.execute("UPDATE emission_recompute_chunks SET status = 'pending' WHERE status = 'hold'")
+        cur.execute("UPDATE car_entries SET exit_timestamp = enter_timestamp + INTERVAL '9 minutes' "
+                    "WHERE exit_timestamp IS NULL")
+        cur.execute("INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp) VALUES (%s, %s, %s)",
+                    ("ZZ99", T0, T0 + timedelta(minutes=4)))
+    conn.commit()
+    emission_factors.process_chunks(conn, job_id)
+    before = _rollups(conn)
+    assert before == _expected(conn)
+
+    assert emission_factors.publish(conn, job_id)
+    after = _rollups(conn)
+    assert after == _expected(conn)
+    assert [r[:3] for r in after] == [r[:3] for r in before] and after != before
+
+    with conn.cursor() as cur:  # The trigger writes to the swapped-in table afterwards.
+        cur.execute("INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp) VALUES (%s, %s, %s)",
+                    ("ZZ98", T0, T0 + timedelta(minutes=2)))
+    conn.commit()
+    assert _rollups(conn) == _expected(conn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT factor_version FROM car_entries WHERE exit_timestamp IS NOT NULL")
+        assert cur.fetchall() == [(version,)]
+
+
+def test_exit_inside_chunk_being_processed(car_entries_db, pg_connect, monkeypatch):
+    conn = car_entries_db
+    with conn.cursor() as cur:
+        for i in range(6):
+            enter = T0 + timedelta(minutes=7 * i)
+            cur.execute(
+                "INSERT INTO car_entries (numberplate, enter_timestamp, exit_timestamp) VALUES (%s, %s, %s)",
+                (f"AB{i:02d}", enter, enter + timedelta(minutes=3) if i != 2 else None),
+            )
+        cur.execute("SELECT MIN(entry_id) FILTER (WHERE exit_timestamp IS NULL), MAX(entry_id) FROM car_entries")
+        open_id, closed_id = cur.fetchone()
+    conn.commit()
+    version = emission_factors.create_version(conn, [{"fuel_g_per_min": 20, "co2_g_per_min": 50}])
+    job_id = emission_factors.start_job(conn, version, chunk_size=100)
+    worker, ingest = pg_connect(), pg_connect()
+    errors, retries = [], []
+    monkeypatch.setattr(emission_factors, "time", SimpleNamespace(sleep=retries.append))
+
+    def work():
+        try:
+            emission_factors.process_chunks(worker, job_id)
+        except Exception as e:  # noqa: BLE001 - reported by the assertion below
+            errors.append(e)
+
+    # An exit (or an exit-time correction) locks its entry before its rollup trigger
+    # checks the chunk row; hold that state while a worker starts on the chunk.
+    with ingest.cursor() as cur:
+        cur.execute("SELECT 1 FROM car_entries WHERE entry_id IN (%s, %s) FOR UPDATE", (open_id, closed_id))
+    thread = threading.Thread(target=work)
+    thread.start()
+    _wait_for_lock(conn, worker)
+    with ingest.cursor() as cur:
+        cur.execute("UPDATE car_entries SET exit_timestamp = enter_timestamp + INTERVAL '5 minutes' "
+                    "WHERE entry_id IN (%s, %s)", (open_id, closed_id))
+    ingest.commit()
+    thread.join(10)
+
+    assert errors == [] and retries == []  # No deadlock, on either side.
+    assert emission_factors.job_status(conn, job_id)["done_chunks"] == 1
+    assert emission_factors.publish(conn, job_id)
+    assert _rollups(conn) == _expected(conn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*), SUM(minutes_elapsed) FROM car_entries WHERE exit_timestamp IS NOT NULL")
+        assert cur.fetchone() == (6, 4 * 3 + 2 * 5)
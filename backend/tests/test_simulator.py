@@ -0,0 +1,66 @@
+import pytest
+
+import simulator
+
+SCENARIO = {"lanes": 1, "distribution": "fixed", "service_mean_minutes": 1.0, "service_cv": 0}
+
+
+def test_validate_scenario_fills_defaults():
+    assert simulator._validate_scenario({}) == {
+        "lanes": 1, "distribution": "lognormal", "service_mean_minutes": 4.0, "service_cv": 0.5,
+    }
+
+
+@pytest.mark.parametrize("scenario, message", [
+    ([1], "must be an object"),
+    ({"lanes": 0}, "lanes must be between 1 and 10"),
+    ({"lanes": 11}, "lanes must be between 1 and 10"),
+    ({"distribution": "weibull"}, "distribution must be one of"),
+    ({"service_mean_minutes": 0}, "service_mean_minutes must be positive"),
+    ({"service_cv": -0.1}, "service_cv non-negative"),
+])
+def test_validate_scenario_rejects(scenario, message):
+    with pytest.raises(ValueError, match=message):
+        simulator._validate_scenario(scenario)
+
+
+@pytest.mark.parametrize("kwargs, message", [
+    ({"runs": 0}, "runs must be between"),
+    ({"runs": simulator.MAX_RUNS + 1}, "runs must be between"),
+    ({"arrivals_per_hour": -1}, "arrivals_per_hour must be between"),
+    ({"arrivals_per_hour": float("nan")}, "arrivals_per_hour must be between"),
+    ({"arrivals_per_hour": simulator.MAX_ARRIVALS_PER_HOUR + 1}, "arrivals_per_hour must be between"),
+    ({"scenarios": []}, "scenarios must be a list"),
+    ({"scenarios": SCENARIO}, "scenarios must be a list"),
+    ({"scenarios": [SCENARIO] * (simulator.MAX_SCENARIOS + 1)}, "scenarios must be a list"),
+    ({"scenarios": [SCENARIO] * 3, "runs": simulator.MAX_RUNS}, "runs x scenarios must be at most"),
+    ({"scenarios": [{"lanes": 20}]}, "lanes must be between"),
+])
+def test_simulate_rejects_out_of_bounds_requests(kwargs, message):
+    args = {"scenarios": [SCENARIO], "arrivals_per_hour": 10, "runs": 10, **kwargs}
+    with pytest.raises(ValueError, match=message):
+        simulator.simulate(args.pop("scenarios"), args.pop("arrivals_per_hour"), workers=1, **args)
+
+
+def test_seeded_low_traffic_run_has_no_queueing():
+    results = simulator.simulate([SCENARIO], arrivals_per_hour=1, runs=5000, workers=1, seed=7)
+    assert results == simulator.simulate([SCENARIO], arrivals_per_hour=1, runs=5000, workers=1, seed=7)
+    [result] = results
+    assert result["expected_cars"] == pytest.approx(1.0, abs=0.05)
+    # M/D/1 at rho = 1/60: 1 min of service plus a mean wait of rho / (2 (1 - rho)) = 0.0085 min.
+    assert result["avg_idle_minutes"] == pytest.approx(1.0085, abs=0.01)
+    assert result["expected_co2_kg"] == pytest.approx(result["expected_idle_minutes"] * 27 / 1000, abs=0.01)
+
+
+def test_no_arrivals_means_no_idle():
+    [result] = simulator.simulate([SCENARIO], arrivals_per_hour=0, runs=10, workers=1, seed=1)
+    assert (result["expected_cars"], result["expected_idle_minutes"], result["expected_co2_kg"]) == (0, 0, 0)
+
+
+def test_more_lanes_never_increase_expected_idle():
+    scenarios = [{"lanes": lanes, "distribution": "exponential", "service_mean_minutes": 4.0}
+                 for lanes in range(1, 6)]
+    results = simulator.simulate(scenarios, arrivals_per_hour=40, runs=2000, workers=1, seed=3)
+    idle = [r["expected_idle_minutes"] for r in results]
+    assert idle == sorted(idle, reverse=True)
+    assert idle[0] > 2 * idle[-1]
@@ -0,0 +1,104 @@
+import queue
+import time
+
+import pytest
+
+from conftest import FakeConnection
+from stall_detector import StallDetector
+
+T0 = 1_780_000_000.0
+
+
+class Clock:
+    def __init__(self, now=T0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _detector(threshold=600):
+    clock = Clock()
+    detector = StallDetector(threshold, clock=clock)
+    detector._loaded = True  # As after start() without a database.
+    return detector, clock, detector.subscribe()
+
+
+def _tick(detector):
+    """One pass of the timer loop: emit due alerts, return seconds until the next deadline."""
+    with detector._cond:
+        alerts, wait = detector._due()
+    for alert in alerts:
+        detector._emit(alert)
+    return wait
+
+
+def _drain(q):
+    alerts = []
+    while not q.empty():
+        alerts.append(q.get_nowait())
+    return alerts
+
+
+def test_stalled_alert_fires_at_the_deadline():
+    detector, clock, alerts = _detector()
+    detector.observe_enter(1, "AB12", T0 - 60)
+    assert _tick(detector) == 540
+    clock.now = T0 + 539.9
+    assert _tick(detector) is not None and _drain(alerts) == []
+
+    clock.now = T0 + 540
+    assert _tick(detector) is None
+    [alert] = _drain(alerts)
+    assert alert == {"event": "stalled", "entry_id": 1, "numberplate": "AB12", "enter_timestamp": T0 - 60,
+                     "deadline": T0 + 540, "threshold_minutes": 10.0}
+    assert detector.stalled() == [alert]
+    clock.now += 3600
+    _tick(detector)
+    assert _drain(alerts) == []  # Fires once.
+
+
+def test_exit_before_deadline_fires_nothing():
+    detector, clock, alerts = _detector()
+    detector.observe_enter(1, "AB12", T0)
+    detector.observe_exit(1, T0 + 300)
+    clock.now = T0 + 3600
+    _tick(detector)
+    assert _drain(alerts) == [] and detector.stalled() == []
+    assert detector.stats()["open"] == 0 and detector.stats()["heap"] == 0
+
+
+def test_stalled_then_exited_is_cleared():
+    detector, clock, alerts = _detector()
+    detector.observe_enter(1, "AB12", T0)
+    detector.observe_enter(2, "CD34", T0 + 100)
+    clock.now = T0 + 650
+    _tick(detector)
+    detector.observe_exit(1, T0 + 900)
+    stalled, cleared = _drain(alerts)
+    assert stalled["event"] == "stalled" and stalled["entry_id"] == 1
+    assert cleared == {**stalled, "event": "cleared", "exit_timestamp": T0 + 900, "minutes_open": 15.0}
+    assert detector.stalled() == [] and detector.stats()["open"] == 1
+
+
+def test_load_skips_entries_that_exited_while_loading():
+    detector = StallDetector(600, clock=Clock())
+    detector.observe_exit(2, T0)  # Committed after the load query's snapshot.
+    rows = [(1, "AB12", T0 - 100), (2, "CD34", T0 - 50), (3, "EF56", T0)]
+    conn = FakeConnection(lambda sql, params: rows)
+    detector.load(conn)
+    assert conn.rollbacks == 1
+    assert sorted(detector._open) == [1, 3]
+    assert detector.stats() == {"open": 2, "stalled": 0, "heap": 2, "loaded": True}
+    assert detector._exited_while_loading == set()
+
+
+def test_timer_thread_wakes_for_a_new_earliest_deadline():
+    detector = StallDetector(0.05).start()
+    alerts = detector.subscribe()
+    entered = time.time()
+    detector.observe_enter(1, "AB12", entered)
+    alert = alerts.get(timeout=2)
+    assert alert["event"] == "stalled" and time.time() >= entered + 0.05
+    with pytest.raises(queue.Empty):
+        alerts.get(timeout=0.1)
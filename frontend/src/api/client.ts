@@ -92,7 +92,7 @@ export const fetchTrends = async (): Promise<TrendData[]> => {
 
 export interface CarbonCreditsAccount {
     credits_balance: number;
-    purchase_history: { credits: number; timestamp: string; balance_after: number }[];
+    purchase_history: { credits: number; timestamp: string; balance_after: number; status?: string }[];
 }
 
 export const fetchCarbonCreditsAccount = async (): Promise<CarbonCreditsAccount> => {
@@ -100,7 +100,7 @@ export const fetchCarbonCreditsAccount = async (): Promise<CarbonCreditsAccount>
     return response.data;
 };
 
-export const purchaseCarbonCredits = async (credits: number): Promise<{ success: boolean; credits_purchased: number; new_balance: number }> => {
+export const purchaseCarbonCredits = async (credits: number): Promise<{ success: boolean; purchase_id: number; status: string; credits_purchased: number; new_balance: number }> => {
     const response = await apiClient.post('/carbon-neutral/purchase', { credits });
     return response.data;
 };
@@ -65,7 +65,7 @@ const GoCarbonNeutral = () => {
         setPurchaseSuccess(null);
         try {
             const result = await purchaseCarbonCredits(credits);
-            setPurchaseSuccess(`Purchased ${result.credits_purchased} credits. New balance: ${result.new_balance}`);
+            setPurchaseSuccess(`Queued ${result.credits_purchased} credits (purchase #${result.purchase_id}). Confirmed balance: ${result.new_balance}`);
             setPurchaseAmount('');
             await loadAccount();
         } catch (err: unknown) {